@@ -0,0 +1,131 @@
+"""Measures server link bursts (server/peer.py) with many users.
+
+Starts a server with a link port, links a fake server to it and bursts --users users in --channels
+channels, then PINGs over the link: the PONG comes back once the server has applied the whole
+burst. A second fake server then links and times the burst the server sends it, from its SERVER
+line to EOB, with the number of lines and bytes. A local client on one of the channels sees the
+JOINs of the burst. Closing the first link then times the netsplit of its users.
+
+Usage: python bench/burst.py [--users 100000] [--channels 1000] [--out results.json]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+PASSWORD = "bench"
+
+SERVER_CODE = f"""
+import sys
+import config
+config.LINK_PASSWORD = {PASSWORD!r}
+config.METRICS_ADDR = None
+config.FLOOD_CONTROL = False
+config.HOSTNAME = "hub.bench"
+from server import Server
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.bind_links("127.0.0.1", int(sys.argv[2]), False)
+srv.run()
+"""
+
+
+def start_server(port: int, link_port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), str(link_port)], cwd=SERVER_DIR,
+                            stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", link_port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def read_until(conn: socket.socket, marker: bytes) -> tuple[bytes, float]:
+    """Reads until a line starting with marker, returns everything read and when the marker arrived"""
+    data = b""
+    while True:
+        received = conn.recv(1 << 20)
+        if not received:
+            raise ConnectionError("link closed")
+        data += received
+        if data.startswith(marker) or b"\n" + marker in data:
+            return data, time.perf_counter()
+
+
+def link(link_port: int, name: str) -> socket.socket:
+    conn = socket.create_connection(("127.0.0.1", link_port))
+    conn.sendall(f"SERVER {name} {PASSWORD} :bench\r\n".encode("UTF-8"))
+    return conn
+
+
+def make_burst(users: int, channels: int) -> bytes:
+    lines = [f"U u{i} user{i} host{i}.example leaf.bench :User number {i}" for i in range(users)]
+    per_channel = users // channels
+    for c in range(channels):
+        nicknames = [f"u{i}" for i in range(c * per_channel, (c + 1) * per_channel)]
+        # Stay well below LINK_MAX_LINE
+        for start in range(0, len(nicknames), 50):
+            lines.append(f"C #c{c} :" + " ".join(nicknames[start:start + 50]))
+        lines.append(f"T #c{c} :Topic of channel {c}")
+    lines.append("EOB")
+    return ("\r\n".join(lines) + "\r\n").encode("UTF-8")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=16900)
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"users": args.users, "channels": args.channels}
+    burst = make_burst(args.users, args.channels)
+    server = start_server(args.port, args.port + 1)
+    try:
+        local = socket.create_connection(("127.0.0.1", args.port))
+        local.sendall(b"NICK watcher\r\nUSER watcher 0 * :watcher\r\nJOIN #c0\r\n")
+        read_until(local, b":watcher!")
+
+        leaf = link(args.port + 1, "leaf.bench")
+        read_until(leaf, b"EOB")
+        start = time.perf_counter()
+        leaf.sendall(burst + b"PING applied\r\n")
+        _, done = read_until(leaf, b"PONG")
+        results["receive"] = {"lines": burst.count(b"\n"), "bytes": len(burst),
+                              "applied_ms": round((done - start) * 1000, 1)}
+
+        other = link(args.port + 1, "other.bench")
+        start = time.perf_counter()
+        data, done = read_until(other, b"EOB")
+        results["send"] = {"lines": data.count(b"\n"), "bytes": len(data), "ms": round((done - start) * 1000, 1)}
+
+        # The watcher shares #c0 with the users of the first fake server
+        start = time.perf_counter()
+        leaf.close()
+        read_until(other, b"SQUIT")
+        # The users are gone once the loop gets to the PING
+        other.sendall(b"PING split\r\n")
+        _, done = read_until(other, b"PONG")
+        results["split_ms"] = round((done - start) * 1000, 1)
+        for conn in (other, local):
+            conn.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Measures channel PRIVMSG throughput of cluster.py with a growing number of workers.
+
+Every load process owns a set of two member channels. The sender of each channel pipelines
+messages and the receiver counts them, so most messages cross workers through the hub.
+Throughput should grow with the number of workers until the cores run out.
+
+Usage: python bench/cluster_scaling.py [--workers 1,2,4] [--procs 4] [--pairs 25] [--messages 2000]
+"""
+import argparse
+import multiprocessing
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+
+def start_cluster(workers: int, port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "cluster.py", "--workers", str(workers), "--host", "127.0.0.1",
+                             "--port", str(port), "--no-flood-control"], cwd=SERVER_DIR, stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            time.sleep(0.5)  # give every worker the time to bind
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("cluster did not start")
+
+
+def register(port: int, nick: str, channel: str) -> socket.socket:
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(f"NICK {nick}\r\nUSER {nick} 0 * :{nick}\r\nJOIN {channel}\r\n".encode("UTF-8"))
+    return conn
+
+
+def drain(conn: socket.socket, token: bytes) -> None:
+    data = b""
+    while token not in data:
+        data = data[-64:] + conn.recv(65536)
+
+
+def load(args: tuple[int, int, int, int]) -> tuple[int, float]:
+    """Runs in its own process. Returns the number of received messages and the time it took"""
+    index, port, pairs, messages = args
+    senders, receivers = [], []
+    for i in range(pairs):
+        channel = f"#l{index}x{i}"
+        receivers.append(register(port, f"r{index}x{i}", channel))
+        senders.append(register(port, f"s{index}x{i}", channel))
+    for conn in receivers + senders:
+        drain(conn, b" 366 ")
+    time.sleep(0.5)  # let the joins reach every worker
+
+    selector = selectors.DefaultSelector()
+    for conn in receivers:
+        conn.setblocking(False)
+        selector.register(conn, selectors.EVENT_READ)
+    line = b" :benchmark message\r\n"
+
+    start = time.perf_counter()
+    expected = pairs * messages
+    received = 0
+    sent = 0
+    while received < expected:
+        if sent < messages:
+            batch = min(100, messages - sent)
+            for i, conn in enumerate(senders):
+                conn.sendall((f"PRIVMSG #l{index}x{i}".encode("UTF-8") + line) * batch)
+            sent += batch
+        for key, _ in selector.select(0 if sent < messages else 5):
+            data = key.fileobj.recv(1 << 20)
+            received += data.count(b" PRIVMSG ")
+    elapsed = time.perf_counter() - start
+
+    for conn in senders + receivers:
+        conn.close()
+    return received, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4) if n <= (os.cpu_count() or 1)) or "1")
+    parser.add_argument("--procs", type=int, default=4, help="load generating processes")
+    parser.add_argument("--pairs", type=int, default=25, help="channels per load process")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per channel")
+    parser.add_argument("--port", type=int, default=16667)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'messages':>10} {'msg/s':>10}")
+    for workers in (int(n) for n in args.workers.split(",")):
+        cluster = start_cluster(workers, args.port)
+        try:
+            with multiprocessing.Pool(args.procs) as pool:
+                results = pool.map(load, [(i, args.port, args.pairs, args.messages) for i in range(args.procs)])
+        finally:
+            cluster.terminate()
+            cluster.wait()
+        received = sum(r for r, _ in results)
+        elapsed = max(e for _, e in results)
+        print(f"{workers:>8} {received:>10} {received / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Measures the cost of one channel PRIVMSG fanned out to a large channel.
+
+Compares formatting and encoding the line for every recipient (the previous behaviour)
+with Channel.broadcast, which encodes once and queues the same bytes for every member.
+Connections are stubs, so only the server side work is measured.
+
+Usage: python bench/fanout.py [--members 5000] [--messages 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import config  # noqa: E402
+from client import Client  # noqa: E402
+from dispatch import Dispatcher  # noqa: E402
+from ircmessage import IRCMessage  # noqa: E402
+
+
+class StubConnection:
+    """Accepts everything and remembers which distinct buffers it was given"""
+
+    def __init__(self, seen: dict[int, bytes]) -> None:
+        self.seen = seen
+
+    def send(self, data: bytes) -> int:
+        # Holding on to the buffer keeps its id from being reused
+        self.seen[id(data)] = data
+        return len(data)
+
+    def fileno(self) -> int:
+        return 1
+
+    def close(self) -> None:
+        pass
+
+
+def make_server(members: int, seen: dict[int, bytes]) -> tuple[Dispatcher, Client]:
+    server = Dispatcher()
+    clients = []
+    for i in range(members):
+        client = Client(StubConnection(seen))  # type: ignore[arg-type]
+        client.nickname = f"user{i}"
+        client.username = f"user{i}"
+        server.clients[client.nickname] = client
+        server.join_channel(client, "#big")
+        clients.append(client)
+    return server, clients[0]
+
+
+def per_recipient(server: Dispatcher, sender: Client, text: str) -> None:
+    for target in server.channels["#big"].users:
+        if target is not sender:
+            target.send(f":{sender.nickname}!{sender.username}@{config.HOSTNAME} PRIVMSG #big :{text}")
+
+
+def broadcast(server: Dispatcher, sender: Client, text: str) -> None:
+    server.cmd_PRIVMSG(sender, IRCMessage.parse(f"PRIVMSG #big :{text}"))
+
+
+def run(name: str, members: int, messages: int, fn) -> None:
+    seen: dict[int, bytes] = {}
+    server, sender = make_server(members, seen)
+    elapsed = 0.0
+    encodes = 0
+    for i in range(messages):
+        seen.clear()
+        start = time.perf_counter()
+        fn(server, sender, f"message number {i}")
+        elapsed += time.perf_counter() - start
+        encodes += len(seen)
+    print(f"{name:>14} {elapsed / messages * 1e3:>10.3f} ms/msg {encodes / messages:>10.0f} encodes/msg")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    run("per-recipient", args.members, args.messages, per_recipient)
+    run("broadcast", args.members, args.messages, broadcast)
+
+
+if __name__ == "__main__":
+    main()
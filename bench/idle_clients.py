@@ -0,0 +1,109 @@
+"""Measures PING round-trip latency of one active client while N idle clients are connected.
+
+With the selector based event loop the latency should stay flat as the number of idle
+connections grows, since only ready sockets are looked at on each wakeup.
+
+Usage: python bench/idle_clients.py [--counts 100,1000,5000,10000] [--pings 500] [--engine asyncio]
+"""
+import argparse
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+SERVER_CODE = """
+import sys
+import config
+# The pings are sent back to back
+config.FLOOD_CONTROL = False
+if sys.argv[2] == "asyncio":
+    from async_server import AsyncServer as Server
+else:
+    from server import Server
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.run()
+"""
+
+
+def start_server(port: int, engine: str) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), engine], cwd=SERVER_DIR)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def register(port: int, nick: str) -> socket.socket:
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(f"NICK {nick}\r\nUSER {nick} 0 * :{nick}\r\n".encode("UTF-8"))
+    return conn
+
+
+def read_until(conn: socket.socket, token: bytes) -> None:
+    data = b""
+    while token not in data:
+        chunk = conn.recv(4096)
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        data += chunk
+
+
+def measure(port: int, pings: int) -> list[float]:
+    conn = register(port, "active")
+    read_until(conn, b" 251 ")  # greeting, the MOTD may follow
+    samples = []
+    for i in range(pings):
+        start = time.perf_counter()
+        conn.sendall(f"PING {i}\r\n".encode("UTF-8"))
+        read_until(conn, b"PONG")
+        samples.append(time.perf_counter() - start)
+    conn.close()
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", default="100,1000,5000,10000")
+    parser.add_argument("--pings", type=int, default=500)
+    parser.add_argument("--port", type=int, default=16667)
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors")
+    args = parser.parse_args()
+    counts = [int(c) for c in args.counts.split(",")]
+
+    # Every idle client needs a descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if max(counts) + 64 > hard:
+        print(f"[BENCH] Open file limit is {hard}, counts above {hard - 64} will fail")
+
+    proc = start_server(args.port, args.engine)
+    idle: list[socket.socket] = []
+    try:
+        print(f"{'idle':>8} {'p50 (us)':>10} {'p99 (us)':>10} {'mean (us)':>10}")
+        for count in counts:
+            while len(idle) < count:
+                idle.append(register(args.port, f"i{len(idle)}"))
+            time.sleep(0.5)  # let the server finish the registrations
+            samples = sorted(measure(args.port, args.pings))
+            p50 = samples[len(samples) // 2] * 1e6
+            p99 = samples[int(len(samples) * 0.99)] * 1e6
+            print(f"{count:>8} {p50:>10.1f} {p99:>10.1f} {statistics.mean(samples) * 1e6:>10.1f}")
+    finally:
+        proc.terminate()
+        proc.wait()
+        for conn in idle:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Measures LIST (Dispatcher.cmd_LIST, channel.ChannelSizes) on a server with many channels.
+
+A fake linked server bursts --channels channels into the server: every --big-every-th channel has
+--big-size users, the others have one. A client then LISTs every channel, and the time to its 323
+and the growth of the server's peak memory (VmHWM) are recorded. Filtered LISTs (>N, a name mask)
+are timed the same way. Finally a client which reads its LIST slowly holds one in progress while
+another client PINGs the server, to show the LIST does not hold up the loop.
+
+Usage: python bench/list.py [--channels 100000] [--out results.json]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+PASSWORD = "bench"
+
+SERVER_CODE = f"""
+import sys
+import config
+config.LINK_PASSWORD = {PASSWORD!r}
+config.METRICS_ADDR = None
+config.FLOOD_CONTROL = False
+from server import Server
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.bind_links("127.0.0.1", int(sys.argv[2]), False)
+srv.run()
+"""
+
+
+def start_server(port: int, link_port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), str(link_port)], cwd=SERVER_DIR,
+                            stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", link_port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def read_until(conn: socket.socket, marker: bytes) -> bytes:
+    data = b""
+    while marker not in data:
+        received = conn.recv(1 << 20)
+        if not received:
+            raise ConnectionError("connection closed")
+        data += received
+    return data
+
+
+def peak_memory(pid: int) -> int:
+    """VmHWM of a process in kB"""
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def make_burst(channels: int, big_every: int, big_size: int) -> bytes:
+    users = channels + big_size
+    lines = [f"U u{i} user{i} host{i}.example leaf.bench :User number {i}" for i in range(users)]
+    for c in range(channels):
+        members = [f"u{i}" for i in range(channels, users)] if c % big_every == 0 else [f"u{c}"]
+        # Stay well below LINK_MAX_LINE
+        for start in range(0, len(members), 50):
+            lines.append(f"C #c{c} :" + " ".join(members[start:start + 50]))
+    lines.append("T #c1 :the topic of #c1")
+    lines.append("EOB")
+    return ("\r\n".join(lines) + "\r\n").encode("UTF-8")
+
+
+def client(port: int, nickname: str) -> socket.socket:
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(f"NICK {nickname}\r\nUSER {nickname} 0 * :{nickname}\r\n".encode("UTF-8"))
+    read_until(conn, b" 001 ")
+    return conn
+
+
+def timed_list(conn: socket.socket, query: str) -> dict:
+    start = time.perf_counter()
+    conn.sendall(f"{query}\r\n".encode("UTF-8"))
+    data = read_until(conn, b" 323 ")
+    return {"query": query, "replies": data.count(b" 322 "), "bytes": len(data),
+            "ms": round((time.perf_counter() - start) * 1000, 1)}
+
+
+def slow_list(port: int, seconds: float) -> None:
+    """Keeps a LIST in progress by reading a little at a time"""
+    conn = client(port, "slow")
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    conn.sendall(b"LIST\r\n")
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        conn.recv(4096)
+        time.sleep(0.001)
+    conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=100000)
+    parser.add_argument("--big-every", type=int, default=100, help="every n-th channel is a big one")
+    parser.add_argument("--big-size", type=int, default=50, help="users of the big channels")
+    parser.add_argument("--port", type=int, default=17200)
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"channels": args.channels}
+    server = start_server(args.port, args.port + 1)
+    try:
+        leaf = socket.create_connection(("127.0.0.1", args.port + 1))
+        leaf.sendall(f"SERVER leaf.bench {PASSWORD} :bench\r\n".encode("UTF-8"))
+        read_until(leaf, b"EOB")
+        leaf.sendall(make_burst(args.channels, args.big_every, args.big_size) + b"PING applied\r\n")
+        read_until(leaf, b"PONG")
+
+        conn = client(args.port, "lister")
+        before = peak_memory(server.pid)
+        results["full"] = timed_list(conn, "LIST")
+        results["full"]["peak_memory_growth_kb"] = peak_memory(server.pid) - before
+        results["filtered"] = [timed_list(conn, query) for query in (f"LIST >{args.big_size - 1}", "LIST #c1234*",
+                                                                     "LIST T:*topic*", "LIST #c1,#c2,#c3")]
+
+        slow = threading.Thread(target=slow_list, args=(args.port, 2.0))
+        slow.start()
+        time.sleep(0.2)
+        samples = []
+        while slow.is_alive():
+            start = time.perf_counter()
+            conn.sendall(b"PING :probe\r\n")
+            read_until(conn, b"PONG")
+            samples.append(time.perf_counter() - start)
+            time.sleep(0.005)
+        samples.sort()
+        results["ping_during_slow_list"] = {"pings": len(samples), "p50_ms": round(samples[len(samples) // 2] * 1000, 2),
+                                            "max_ms": round(samples[-1] * 1000, 2)}
+        conn.close()
+        leaf.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
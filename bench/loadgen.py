@@ -0,0 +1,529 @@
+"""Drives the IRC server with synthetic clients and writes the results as JSON.
+
+The server is started as a subprocess (or on a thread with --in-process) for every scenario.
+All synthetic clients run in one selectors loop, their input is framed with the server's
+own LineBuffer. Latencies are end to end: every request carries its send time.
+
+Scenarios, and the handler each one exercises:
+  idle     connect rate, RSS per connection and PING latency next to N idle clients
+           (Server.run, Dispatcher.cmd_PING)
+  channel  PRIVMSG fan-out in one big channel (Dispatcher.cmd_PRIVMSG, Channel.broadcast)
+  pm       private message storm between random pairs (Dispatcher.cmd_PRIVMSG, send_privmsg_line)
+  who      WHO flood on a big channel (Dispatcher.cmd_WHO)
+  names    NAMES flood on a big channel (Dispatcher.cmd_NAMES, Channel.names)
+  abuse    PING latency of well-behaved members while one member pipelines WHO on the big
+           channel, run it with and without --flood-control (Dispatcher.admit)
+
+With --restart-at the server is hot restarted (SIGHUP, see server/restart.py) that many seconds
+into every scenario, disconnects and missing deliveries then show whether any session dropped.
+
+Usage: python bench/loadgen.py [--scenarios idle,channel,pm,who,names] [--clients 2000]
+                               [--channel-size 500] [--rate 200] [--duration 5]
+                               [--engine asyncio] [--in-process] [--flood-control] [--restart-at 3]
+                               [--out results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+
+from framing import LineBuffer  # noqa: E402
+
+SERVER_CODE = """
+import signal
+import sys
+import config
+config.FLOOD_CONTROL = sys.argv[3] == "1"
+if sys.argv[2] == "asyncio":
+    from async_server import AsyncServer as Server
+else:
+    from server import Server
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+signal.signal(signal.SIGHUP, lambda signum, frame: srv.request_restart())
+srv.run()
+"""
+
+CONNECT_BATCH = 100  # stays below the listen backlog
+
+
+class ServerProcess:
+    """The server under test, either a subprocess or a thread of this process"""
+    pid: int  # changes when the server hot restarts
+    proc: subprocess.Popen | None
+    restarts: int
+
+    def __init__(self, port: int, engine: str, in_process: bool, flood_control: bool) -> None:
+        self.proc = None
+        self.restarts = 0
+        if in_process:
+            os.chdir(SERVER_DIR)
+            import config
+            config.FLOOD_CONTROL = flood_control
+            if engine == "asyncio":
+                from async_server import AsyncServer as Server
+            else:
+                from server import Server
+            srv = Server()
+            srv.bind("127.0.0.1", port, False)
+            # There is no way to stop a server, the thread ends with the process
+            threading.Thread(target=srv.run, daemon=True).start()
+            self.pid = os.getpid()
+        else:
+            self.proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), engine, str(int(flood_control))],
+                                         cwd=SERVER_DIR, stdout=subprocess.PIPE, text=True)
+            self.pid = self.proc.pid
+            # The process taking over after a hot restart inherits the pipe, its pid is announced on it
+            threading.Thread(target=self.follow, daemon=True).start()
+
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                return
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("server did not start")
+
+    def rss(self) -> int | None:
+        """Resident set size in bytes, only available on Linux"""
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def follow(self) -> None:
+        for line in self.proc.stdout:
+            print(line, end="", file=sys.stderr)
+            match = re.search(r"over to pid (\d+)", line)
+            if match:
+                self.pid = int(match.group(1))
+                self.restarts += 1
+
+    def restart(self) -> None:
+        print("[BENCH] Hot restarting the server", file=sys.stderr)
+        os.kill(self.pid, signal.SIGHUP)
+
+    def stop(self) -> None:
+        if self.proc is not None:
+            if self.pid != self.proc.pid:
+                try:
+                    os.kill(self.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            self.proc.terminate()
+            self.proc.wait()
+
+
+class LoadClient:
+    nick: str
+    conn: socket.socket
+    inbuf: LineBuffer
+    outbuf: bytearray
+    registered: bool
+    closed: bool
+    pending: deque[int]  # send times of requests which have not been answered yet
+
+    def __init__(self, nick: str, conn: socket.socket) -> None:
+        self.nick = nick
+        self.conn = conn
+        self.inbuf = LineBuffer(64 * 1024)
+        self.outbuf = bytearray()
+        self.registered = False
+        self.closed = False
+        self.pending = deque()
+
+
+class Pool:
+    """Synthetic clients sharing one selector. Scenarios get every received line through on_line"""
+    port: int
+    selector: selectors.BaseSelector
+    clients: list[LoadClient]
+    on_line: Callable[[LoadClient, str], None] | None
+    bytes_in: int
+    lines_in: int
+    disconnects: int  # clients the server closed the connection of
+
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.on_line = None
+        self.bytes_in = 0
+        self.lines_in = 0
+        self.disconnects = 0
+
+    def connect(self, count: int, prefix: str, join: str = "") -> list[LoadClient]:
+        """Connects and registers count clients, in batches so the listen backlog does not overflow"""
+        joined = []
+        for start in range(0, count, CONNECT_BATCH):
+            batch = []
+            for i in range(start, min(start + CONNECT_BATCH, count)):
+                conn = socket.create_connection(("127.0.0.1", self.port))
+                conn.setblocking(False)
+                client = LoadClient(f"{prefix}{i}", conn)
+                self.selector.register(conn, selectors.EVENT_READ, client)
+                handshake = f"NICK {client.nick}\r\nUSER {client.nick} 0 * :{client.nick}\r\n"
+                if join:
+                    handshake += f"JOIN {join}\r\n"
+                self.send(client, handshake)
+                batch.append(client)
+            self.clients.extend(batch)
+            self.pump_until(lambda: all(c.registered for c in batch), 30)
+            joined.extend(batch)
+        return joined
+
+    def send(self, client: LoadClient, data: str) -> None:
+        if client.closed:
+            return
+        if client.outbuf:
+            client.outbuf += data.encode("UTF-8")
+            return
+        encoded = data.encode("UTF-8")
+        try:
+            sent = client.conn.send(encoded)
+        except BlockingIOError:
+            sent = 0
+        if sent < len(encoded):
+            client.outbuf += encoded[sent:]
+            self.selector.modify(client.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def pump(self, timeout: float) -> None:
+        for key, mask in self.selector.select(timeout):
+            client: LoadClient = key.data
+            if mask & selectors.EVENT_WRITE:
+                try:
+                    sent = client.conn.send(client.outbuf)
+                except ConnectionError:
+                    client.outbuf.clear()
+                    sent = 0
+                del client.outbuf[:sent]
+                if not client.outbuf:
+                    self.selector.modify(client.conn, selectors.EVENT_READ, client)
+            if mask & selectors.EVENT_READ:
+                self.read(client)
+
+    def read(self, client: LoadClient) -> None:
+        try:
+            received = client.inbuf.recv_from(client.conn)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            received = 0
+        if received <= 0:
+            print(f"[BENCH] The server closed the connection of {client.nick}", file=sys.stderr)
+            self.selector.unregister(client.conn)
+            client.closed = True
+            self.disconnects += 1
+            return
+        self.bytes_in += received
+        for line in client.inbuf.lines():
+            self.lines_in += 1
+            if not client.registered and " 001 " in line:
+                client.registered = True
+            elif self.on_line is not None:
+                self.on_line(client, line)
+
+    def pump_until(self, done: Callable[[], bool], timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not done():
+            if time.monotonic() > deadline:
+                return False
+            self.pump(0.05)
+        return True
+
+    def settle(self, quiet: float = 0.5, timeout: float = 60) -> None:
+        """Reads until the server has been silent for a while, e.g. after the JOIN burst of a big channel"""
+        deadline = time.monotonic() + timeout
+        last = -1
+        while self.lines_in != last and time.monotonic() < deadline:
+            last = self.lines_in
+            end = time.monotonic() + quiet
+            while time.monotonic() < end:
+                self.pump(0.05)
+
+    def drive(self, rate: float, duration: float, fire: Callable[[int], None]) -> float:
+        """Calls fire(n) rate times per second for duration seconds, returns the elapsed time"""
+        start = time.monotonic()
+        fired = 0
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= duration:
+                return elapsed
+            # Catch up in bursts rather than drifting when a pump took longer than the interval
+            while fired < int(elapsed * rate) + 1:
+                fire(fired)
+                fired += 1
+            self.pump(min(1 / rate, 0.01))
+
+    def close(self) -> None:
+        for client in self.clients:
+            if not client.closed:
+                self.selector.unregister(client.conn)
+            client.conn.close()
+        self.selector.close()
+
+
+def percentiles(samples_ns: list[int]) -> dict[str, float | int | None]:
+    """p50/p99/p999 in microseconds"""
+    samples = sorted(samples_ns)
+    result: dict[str, float | int | None] = {"samples": len(samples)}
+    for name, q in (("p50_us", 0.5), ("p99_us", 0.99), ("p999_us", 0.999)):
+        result[name] = round(samples[min(int(len(samples) * q), len(samples) - 1)] / 1000, 1) if samples else None
+    return result
+
+
+def timestamp_latencies(samples: list[int]) -> Callable[[LoadClient, str], None]:
+    """Line handler for PRIVMSGs whose text is the send time"""
+    def on_line(client: LoadClient, line: str) -> None:
+        if " PRIVMSG " in line:
+            samples.append(time.perf_counter_ns() - int(line.rpartition(":")[2]))
+    return on_line
+
+
+def reply_latencies(samples: list[int], marker: str) -> Callable[[LoadClient, str], None]:
+    """Line handler matching the last line of a reply with the oldest outstanding request of the client"""
+    def on_line(client: LoadClient, line: str) -> None:
+        if marker in line and client.pending:
+            samples.append(time.perf_counter_ns() - client.pending.popleft())
+    return on_line
+
+
+def scenario_idle(pool: Pool, server: ServerProcess, args: argparse.Namespace) -> dict:
+    rss_before = server.rss()
+    start = time.monotonic()
+    pool.connect(args.clients, "i")
+    connect_time = time.monotonic() - start
+    pool.settle(0.2)
+    rss_after = server.rss()
+
+    active = pool.connect(1, "active")[0]
+    samples: list[int] = []
+    pool.on_line = reply_latencies(samples, "PONG")
+    for i in range(args.pings):
+        active.pending.append(time.perf_counter_ns())
+        pool.send(active, f"PING {i}\r\n")
+        pool.pump_until(lambda: not active.pending, 10)
+
+    return {
+        "clients": args.clients,
+        "connect_per_s": round(args.clients / connect_time, 1),
+        "rss_per_connection": (rss_after - rss_before) // args.clients if rss_before and rss_after else None,
+        "ping_latency": percentiles(samples),
+    }
+
+
+def scenario_channel(pool: Pool, server: ServerProcess, args: argparse.Namespace) -> dict:
+    members = pool.connect(args.channel_size, "m", join="#big")
+    pool.settle()
+    senders = members[:args.senders]
+    samples: list[int] = []
+    pool.on_line = timestamp_latencies(samples)
+    sent = 0
+
+    def fire(n: int) -> None:
+        nonlocal sent
+        pool.send(senders[n % len(senders)], f"PRIVMSG #big :{time.perf_counter_ns()}\r\n")
+        sent += 1
+
+    elapsed = pool.drive(args.rate, args.duration, fire)
+    pool.settle()
+    return {
+        "members": args.channel_size,
+        "messages_per_s": args.rate,
+        "deliveries": len(samples),
+        "expected_deliveries": sent * (args.channel_size - 1),
+        "fanout_per_s": round(len(samples) / elapsed, 1),
+        "latency": percentiles(samples),
+    }
+
+
+def scenario_pm(pool: Pool, server: ServerProcess, args: argparse.Namespace) -> dict:
+    clients = pool.connect(args.clients, "p")
+    pool.settle()
+    samples: list[int] = []
+    pool.on_line = timestamp_latencies(samples)
+    rng = random.Random(12)
+    sent = 0
+
+    def fire(n: int) -> None:
+        nonlocal sent
+        sender, target = rng.sample(clients, 2)
+        pool.send(sender, f"PRIVMSG {target.nick} :{time.perf_counter_ns()}\r\n")
+        sent += 1
+
+    elapsed = pool.drive(args.rate, args.duration, fire)
+    pool.settle()
+    return {
+        "clients": args.clients,
+        "messages_per_s": args.rate,
+        "delivered": len(samples),
+        "sent": sent,
+        "sent_per_s": round(sent / elapsed, 1),
+        "delivered_per_s": round(len(samples) / elapsed, 1),
+        "latency": percentiles(samples),
+    }
+
+
+def request_flood(pool: Pool, args: argparse.Namespace, request: str, marker: str) -> dict:
+    """Floods the big channel with a request, measuring the time until the end of each reply"""
+    members = pool.connect(args.channel_size, "m", join="#big")
+    pool.settle()
+    flooders = members[:args.senders]
+    samples: list[int] = []
+    pool.on_line = reply_latencies(samples, marker)
+    bytes_before = pool.bytes_in
+
+    def fire(n: int) -> None:
+        flooder = flooders[n % len(flooders)]
+        flooder.pending.append(time.perf_counter_ns())
+        pool.send(flooder, request)
+
+    elapsed = pool.drive(args.rate, args.duration, fire)
+    pool.settle()
+    return {
+        "members": args.channel_size,
+        "requests_per_s": args.rate,
+        "replies": len(samples),
+        "received_mb_per_s": round((pool.bytes_in - bytes_before) / elapsed / 1e6, 2),
+        "latency": percentiles(samples),
+    }
+
+
+def scenario_who(pool: Pool, server: ServerProcess, args: argparse.Namespace) -> dict:
+    return request_flood(pool, args, "WHO #big\r\n", " 315 ")
+
+
+def scenario_names(pool: Pool, server: ServerProcess, args: argparse.Namespace) -> dict:
+    return request_flood(pool, args, "NAMES #big\r\n", " 366 ")
+
+
+def scenario_abuse(pool: Pool, server: ServerProcess, args: argparse.Namespace) -> dict:
+    members = pool.connect(args.channel_size, "m", join="#big")
+    abuser = pool.connect(1, "abuser", join="#big")[0]
+    pool.settle()
+    pingers = members[:args.senders]
+    samples: list[int] = []
+    abuser_replies = 0
+
+    def on_line(client: LoadClient, line: str) -> None:
+        nonlocal abuser_replies
+        if client is abuser:
+            abuser_replies += " 315 " in line
+        elif "PONG" in line and client.pending:
+            samples.append(time.perf_counter_ns() - client.pending.popleft())
+
+    def fire(n: int) -> None:
+        pinger = pingers[n % len(pingers)]
+        pinger.pending.append(time.perf_counter_ns())
+        pool.send(pinger, f"PING {n}\r\n")
+        # The abuser keeps as many WHOs in flight as the server accepts
+        if not abuser.outbuf:
+            pool.send(abuser, "WHO #big\r\n" * 50)
+
+    pool.on_line = on_line
+    elapsed = pool.drive(args.rate, args.duration, fire)
+    pool.settle()
+    return {
+        "members": args.channel_size,
+        "pings_per_s": args.rate,
+        "abuser_who_per_s": round(abuser_replies / elapsed, 1),
+        "abuser_disconnected": abuser.closed,
+        "ping_latency": percentiles(samples),
+    }
+
+
+SCENARIOS = {
+    "idle": scenario_idle,
+    "channel": scenario_channel,
+    "pm": scenario_pm,
+    "who": scenario_who,
+    "names": scenario_names,
+    "abuse": scenario_abuse,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--clients", type=int, default=2000, help="clients of the idle and pm scenarios")
+    parser.add_argument("--channel-size", type=int, default=500)
+    parser.add_argument("--senders", type=int, default=10, help="members sending in the channel, who and names scenarios")
+    parser.add_argument("--rate", type=float, default=200, help="messages or requests per second")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--pings", type=int, default=500)
+    parser.add_argument("--port", type=int, default=16700)
+    parser.add_argument("--engine", choices=["selectors", "asyncio"], default="selectors")
+    parser.add_argument("--in-process", action="store_true",
+                        help="run the server on a thread, it then competes with the load for the GIL and its RSS "
+                             "includes the synthetic clients")
+    parser.add_argument("--flood-control", action="store_true",
+                        help="keep the flood control of config.py, it is off by default as the scenarios pipeline requests")
+    parser.add_argument("--restart-at", type=float, help="hot restart the server this many seconds into every scenario")
+    parser.add_argument("--out", help="JSON file to write, printed to stdout otherwise")
+    args = parser.parse_args()
+    if args.restart_at is not None and (args.in_process or args.engine != "selectors"):
+        parser.error("--restart-at needs the selectors engine in a subprocess")
+
+    # Every client needs a descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = {
+        "engine": args.engine,
+        "in_process": args.in_process,
+        "flood_control": args.flood_control,
+        "python": platform.python_version(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scenarios": {},
+    }
+    for index, name in enumerate(args.scenarios.split(",")):
+        # Every scenario gets a fresh server, in-process servers can not be stopped so each needs its own port
+        port = args.port + index
+        server = ServerProcess(port, args.engine, args.in_process, args.flood_control)
+        pool = Pool(port)
+        timer = None
+        if args.restart_at is not None:
+            timer = threading.Timer(args.restart_at, server.restart)
+            timer.start()
+        try:
+            print(f"[BENCH] {name}...", file=sys.stderr)
+            results["scenarios"][name] = SCENARIOS[name](pool, server, args)
+            results["scenarios"][name]["disconnects"] = pool.disconnects
+            if timer is not None:
+                results["scenarios"][name]["restarts"] = server.restarts
+        finally:
+            if timer is not None:
+                timer.cancel()
+            pool.close()
+            server.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as out:
+            out.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Measures the server side memory of idle clients, channels and channel memberships.
+
+Clients are registered by feeding NICK/USER lines to a Dispatcher, with stub connections
+standing in for sockets, so the numbers cover exactly what the server keeps per user.
+Allocations are counted with tracemalloc.
+
+Usage: python bench/memory.py [--clients 20000] [--channels 1000] [--joins 5]
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from client import Client  # noqa: E402
+from dispatch import Dispatcher  # noqa: E402
+
+
+class StubConnection:
+    """Accepts and drops everything"""
+
+    def send(self, data: bytes) -> int:
+        return len(data)
+
+    def fileno(self) -> int:
+        return 1
+
+    def close(self) -> None:
+        pass
+
+
+def allocated() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--joins", type=int, default=5, help="channels joined by every client")
+    args = parser.parse_args()
+
+    server = Dispatcher()
+    conn = StubConnection()
+    tracemalloc.start()
+
+    before = allocated()
+    clients = []
+    for i in range(args.clients):
+        client = Client(conn)  # type: ignore[arg-type]
+        server.add_client(client)
+        server.handle_lines(client, [f"NICK u{i}", f"USER u{i} 0 * :User {i}"])
+        clients.append(client)
+    per_client = (allocated() - before) / args.clients
+
+    before = allocated()
+    server.handle_lines(clients[0], [f"JOIN #c{i}" for i in range(args.channels)])
+    per_channel = (allocated() - before) / args.channels
+
+    before = allocated()
+    for i, client in enumerate(clients[1:], 1):
+        channels = ",".join(f"#c{(i + j) % args.channels}" for j in range(args.joins))
+        # The NAMES replies are dropped by the stub, only the membership stays allocated
+        server.handle_lines(client, [f"JOIN {channels}"])
+    per_membership = (allocated() - before) / ((args.clients - 1) * args.joins)
+
+    print(f"{'idle client':>20} {per_client:>10.0f} bytes")
+    print(f"{'channel':>20} {per_channel:>10.0f} bytes")
+    print(f"{'channel membership':>20} {per_membership:>10.0f} bytes")
+
+
+if __name__ == "__main__":
+    main()
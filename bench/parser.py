@@ -0,0 +1,126 @@
+"""Microbenchmark of IRC line parsing and dispatch over a recorded corpus of client lines.
+
+Compares the previous split(" ") + match + join_message_tail path with IRCMessage.parse
+followed by a lookup in a handler table like Dispatcher.handlers.
+Then --fuzz N randomly mutated lines are thrown at the parser, which must never raise, parse
+parameters consistent with the line, and give an equal message back for IRCMessage.line(), which
+hot restarts and linked servers rely on. --fuzz 0 skips it.
+
+Usage: python bench/parser.py [--corpus bench/corpus.txt] [--rounds 200] [--fuzz 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "server"))
+
+from ircmessage import IRCMessage  # noqa: E402
+
+
+def join_message_tail(msg: list[str]) -> str:
+    message = ' '.join(msg)[1:] if msg[0].startswith(":") else msg[0]
+    return message.strip()
+
+
+def handler(msg) -> None:
+    pass
+
+
+HANDLERS = {command: (handler, False) for command in
+            ("NICK", "USER", "PING", "PONG", "CAP", "QUIT", "JOIN", "PART", "WHO", "PRIVMSG")}
+
+
+def split_parse(line: str) -> None:
+    """What handle_message and the handlers used to do with every line"""
+    msg = line.split(" ")
+    if len(msg) == 0 or len(msg[0]) == 0:
+        return
+    msg[0] = msg[0].upper()
+    match msg[0]:
+        case "NICK" | "USER" | "PING" | "QUIT" | "JOIN" | "WHO":
+            handler(msg)
+        case "PART" | "PRIVMSG":
+            handler(msg)
+            if len(msg) > 2:
+                join_message_tail(msg[2:])
+        case "PONG" | "CAP":
+            pass
+        case _:
+            handler(msg)
+
+
+def table_parse(line: str) -> None:
+    msg = IRCMessage.parse(line)
+    if msg is not None:
+        entry = HANDLERS.get(msg.command)
+        if entry is not None:
+            entry[0](msg)
+
+
+def measure(name: str, fn, lines: list[str], rounds: int) -> None:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for line in lines:
+            fn(line)
+    elapsed = time.perf_counter() - start
+    count = rounds * len(lines)
+    print(f"{name:>14} {elapsed / count * 1e9:>8.0f} ns/line {count / elapsed:>12.0f} lines/s")
+
+
+def mutate(line: str, rng: random.Random) -> str:
+    chars = list(line)
+    for _ in range(rng.randint(1, 4)):
+        op = rng.random()
+        pos = rng.randint(0, len(chars))
+        if op < 0.4:
+            chars.insert(pos, rng.choice(" ::\t\x00é!@#,"))
+        elif op < 0.7 and chars:
+            del chars[min(pos, len(chars) - 1)]
+        elif chars:
+            chars[min(pos, len(chars) - 1)] = chr(rng.randint(0, 0x2FF))
+    return "".join(chars)
+
+
+def fields(msg: IRCMessage) -> tuple:
+    return msg.prefix, msg.command, msg.params, msg.trailing
+
+
+def fuzz(lines: list[str], count: int) -> None:
+    rng = random.Random(0)
+    for _ in range(count):
+        line = mutate(rng.choice(lines), rng)
+        msg = IRCMessage.parse(line)
+        if msg is None:
+            continue
+        assert msg.command and " " not in msg.command, line
+        assert msg.command == msg.command.upper(), line
+        middle = msg.params[:-1] if msg.trailing is not None else msg.params
+        assert all(p and " " not in p and not p.startswith(":") for p in middle), line
+        if msg.trailing is not None:
+            assert msg.params[-1] is msg.trailing and line.endswith(msg.trailing), line
+        again = IRCMessage.parse(msg.line())
+        assert again is not None and fields(again) == fields(msg), (line, msg.line())
+    print(f"{'fuzz':>14} {count} mutated lines parsed and round tripped without errors")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus.txt"))
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--fuzz", type=int, default=20000)
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="UTF-8") as f:
+        lines = f.read().splitlines()
+
+    measure("split", split_parse, lines, args.rounds)
+    measure("IRCMessage", table_parse, lines, args.rounds)
+    if args.fuzz:
+        fuzz(lines, args.fuzz)
+
+
+if __name__ == "__main__":
+    main()
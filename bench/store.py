@@ -0,0 +1,131 @@
+"""Measures the channel store (server/store.py) with many stored channels.
+
+Builds a snapshot of --channels topics plus a journal of --journal changes, then reports the time
+to open the store, the latency of the lookup JOIN does for a new channel, what recording a change
+costs the loop, how long a compaction takes, and how long a server using the store takes from
+process start to accepting connections. Reading the whole snapshot into a dict is timed next to it
+for comparison.
+
+Usage: python bench/store.py [--channels 100000] [--journal 10000] [--lookups 10000] [--out results.json]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+sys.path.insert(0, SERVER_DIR)
+
+from store import SNAPSHOT, ChannelStore, format_record, parse_record  # noqa: E402
+
+SERVER_CODE = """
+import sys
+import config
+config.CHANNEL_STORE = sys.argv[2]
+config.METRICS_ADDR = None
+from server import Server
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.run()
+"""
+
+
+def build(directory: str, channels: int, journal: int) -> None:
+    records = sorted((f"#channel{i}", "topic", f"Topic of channel {i}, set a while ago") for i in range(channels))
+    with open(os.path.join(directory, SNAPSHOT), "wb") as file:
+        file.writelines(format_record(*record) for record in records)
+    store = ChannelStore(directory, 0.0, 1 << 40)
+    for i in range(journal):
+        store.set(f"#channel{i * 7 % channels}", "topic", f"Changed {i}")
+    store.close()
+
+
+def percentiles(samples_ns: list[int]) -> dict[str, float]:
+    samples = sorted(samples_ns)
+    return {name: round(samples[min(int(len(samples) * q), len(samples) - 1)] / 1000, 1)
+            for name, q in (("p50_us", 0.5), ("p99_us", 0.99), ("max_us", 1.0))}
+
+
+def server_startup(directory: str, port: int) -> float:
+    """Seconds from spawning a server with the store until it accepts a connection"""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), directory], cwd=SERVER_DIR,
+                            stdout=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                return time.perf_counter() - start
+            except ConnectionRefusedError:
+                if proc.poll() is not None:
+                    raise RuntimeError("server exited")
+                time.sleep(0.005)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=100000)
+    parser.add_argument("--journal", type=int, default=10000, help="changes in the journal, replayed at startup")
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=16800)
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"channels": args.channels, "journal": args.journal}
+    with tempfile.TemporaryDirectory() as directory:
+        build(directory, args.channels, args.journal)
+        results["snapshot_bytes"] = os.path.getsize(os.path.join(directory, SNAPSHOT))
+
+        start = time.perf_counter()
+        store = ChannelStore(directory, 0.05, 1 << 40)
+        results["open_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        start = time.perf_counter()
+        with open(os.path.join(directory, SNAPSHOT), "rb") as file:
+            eager = {parse_record(line)[0]: line for line in file}
+        results["eager_load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        del eager
+
+        rng = random.Random(1)
+        samples = []
+        for _ in range(args.lookups):
+            key = f"#channel{rng.randrange(args.channels * 2)}"  # half of them miss
+            t = time.perf_counter_ns()
+            store.get(key)
+            samples.append(time.perf_counter_ns() - t)
+        results["lookup"] = percentiles(samples)
+
+        samples = []
+        for i in range(args.lookups):
+            t = time.perf_counter_ns()
+            store.set(f"#channel{i}", "topic", f"Set by the bench {i}")
+            samples.append(time.perf_counter_ns() - t)
+        results["set"] = percentiles(samples)
+        start = time.perf_counter()
+        store.sync()
+        results["sync_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        start = time.perf_counter()
+        store.compact()
+        store.sync()
+        results["compact_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        store.close()
+
+        results["server_startup_ms"] = round(server_startup(directory, args.port) * 1000, 1)
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
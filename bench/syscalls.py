@@ -0,0 +1,154 @@
+"""Counts the send system calls the server makes per delivered message, with and without corked output.
+
+Every run starts a server (selectors engine) with config.CORK_OUTPUT on or off. --clients clients
+join one channel, then each client joins --joins more channels (JOIN echo, topic reply and NAMES
+for every one), and --senders of them pipeline --burst channel messages each, --rounds times.
+The send/sendmsg calls come from the server's irc_send_calls_total counter and the messages from
+irc_writes_out_total (one per buffer queued for a recipient), both read from /metrics before and
+after the measured phase.
+
+Usage: python bench/syscalls.py [--clients 200] [--senders 50] [--burst 10] [--rounds 20] [--joins 5]
+                                [--out results.json]
+"""
+import argparse
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+SERVER_CODE = """
+import sys
+import config
+config.FLOOD_CONTROL = False
+config.CORK_OUTPUT = sys.argv[3] == "1"
+config.METRICS_ADDR = ("127.0.0.1", int(sys.argv[2]))
+import metrics
+from server import Server
+metrics.serve(*config.METRICS_ADDR)
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.run()
+"""
+
+
+def start_server(port: int, metrics_port: int, cork: bool) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), str(metrics_port), "1" if cork else "0"],
+                            cwd=SERVER_DIR, stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def counters(metrics_port: int) -> dict[str, int]:
+    """Totals of the counters, summed over their labels"""
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics") as response:
+        text = response.read().decode("UTF-8")
+    totals = {"irc_send_calls_total": 0, "irc_writes_out_total": 0}
+    for line in text.splitlines():
+        name = line.split("{", 1)[0].split(" ", 1)[0]
+        if name in totals:
+            totals[name] += int(float(line.rsplit(" ", 1)[1]))
+    return totals
+
+
+class Clients:
+    """The synthetic clients, read in one selectors loop"""
+
+    def __init__(self, port: int, count: int) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.conns = []
+        self.tails = {}
+        for i in range(count):
+            conn = socket.create_connection(("127.0.0.1", port))
+            conn.sendall(f"NICK c{i}\r\nUSER c{i} 0 * :c{i}\r\n".encode("UTF-8"))
+            conn.setblocking(False)
+            self.selector.register(conn, selectors.EVENT_READ)
+            self.conns.append(conn)
+            self.tails[conn] = b""
+        self.wait(b" 001 ", count)
+
+    def wait(self, marker: bytes, expected: int, timeout: float = 60.0) -> None:
+        """Reads until expected lines containing marker have arrived over all clients"""
+        seen = 0
+        end = time.monotonic() + timeout
+        while seen < expected:
+            if time.monotonic() > end:
+                raise TimeoutError(f"{seen} of {expected} {marker!r} lines")
+            for key, _ in self.selector.select(1.0):
+                data = self.tails[key.fileobj] + key.fileobj.recv(1 << 20)
+                lines = data.split(b"\n")
+                self.tails[key.fileobj] = lines.pop()
+                seen += sum(marker in line for line in lines)
+
+    def close(self) -> None:
+        for conn in self.conns:
+            conn.close()
+
+
+def run(port: int, metrics_port: int, cork: bool, args: argparse.Namespace) -> dict:
+    server = start_server(port, metrics_port, cork)
+    try:
+        clients = Clients(port, args.clients)
+        for conn in clients.conns:
+            conn.sendall(b"JOIN #bench\r\n")
+        clients.wait(b" 366 ", args.clients)
+
+        before = counters(metrics_port)
+        start = time.perf_counter()
+        for conn in clients.conns:
+            conn.sendall("".join(f"JOIN #room{j}\r\n" for j in range(args.joins)).encode("UTF-8"))
+        clients.wait(b" 366 ", args.clients * args.joins)
+        burst = "".join(f"PRIVMSG #bench :message {i} of the burst\r\n" for i in range(args.burst)).encode("UTF-8")
+        for _ in range(args.rounds):
+            for conn in clients.conns[:args.senders]:
+                conn.sendall(burst)
+            clients.wait(b" PRIVMSG #bench ", args.senders * args.burst * (args.clients - 1))
+        elapsed = time.perf_counter() - start
+        after = counters(metrics_port)
+        clients.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    calls = after["irc_send_calls_total"] - before["irc_send_calls_total"]
+    messages = after["irc_writes_out_total"] - before["irc_writes_out_total"]
+    return {"cork": cork, "send_calls": calls, "messages": messages,
+            "calls_per_message": round(calls / messages, 4), "messages_per_s": round(messages / elapsed)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=10, help="messages each sender pipelines per round")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--joins", type=int, default=5, help="channels every client joins, besides the shared one")
+    parser.add_argument("--port", type=int, default=17000)
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for i, cork in enumerate((False, True)):
+        result = run(args.port + 2 * i, args.port + 2 * i + 1, cork, args)
+        results.append(result)
+        print(f"cork={'on ' if cork else 'off'} {result['send_calls']:>9} send calls for {result['messages']:>9} messages"
+              f"  {result['calls_per_message']:>7} per message  {result['messages_per_s']:>8} messages/s")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Measures TLS connect rate, and the latency of plaintext users next to it, during a reconnect storm.
+
+The server listens for TLS with a throwaway self-signed certificate made by openssl. Connections
+which never start their handshake (--stalled) stand in for slow or malicious peers; with them open,
+the time a new plaintext client takes from connecting to its 001 is measured, since its hostname
+lookup must not wait behind them. Then storm processes connect, complete the handshake, register
+and disconnect in a loop, while a plaintext client PINGs the server to show whether the event loop
+stalls. Every run is repeated for each number of stalled connections, and for each number of
+handshake threads (config.TLS_THREADS, 0 runs the handshakes on the loop).
+
+Usage: python bench/tls_storm.py [--stalled 0,16] [--tls-threads 0,4] [--procs 4] [--duration 5]
+                                 [--openssl openssl] [--out results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+SERVER_CODE = """
+import sys
+import config
+from server import Server
+import tls
+config.FLOOD_CONTROL = False
+config.TLS_THREADS = int(sys.argv[5])
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.bind_tls(tls.create_context(sys.argv[3], sys.argv[4]), "127.0.0.1", int(sys.argv[2]), False)
+srv.run()
+"""
+
+
+def make_certificate(openssl: str, directory: str) -> tuple[str, str]:
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run([openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                    "-days", "1", "-subj", "/CN=localhost"], check=True, capture_output=True)
+    return cert, key
+
+
+def start_server(port: int, tls_port: int, cert: str, key: str, threads: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), str(tls_port), cert, key, str(threads)],
+                            cwd=SERVER_DIR, stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", tls_port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def storm(args: tuple[int, int, float]) -> tuple[int, int]:
+    """Runs in its own process. Returns the number of completed and failed connections"""
+    index, tls_port, duration = args
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    completed = failed = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        nick = f"s{index}x{completed % 1000}"
+        try:
+            with context.wrap_socket(socket.create_connection(("127.0.0.1", tls_port), timeout=10)) as conn:
+                conn.sendall(f"NICK {nick}\r\nUSER {nick} 0 * :{nick}\r\n".encode("UTF-8"))
+                data = b""
+                while b" 001 " not in data:
+                    received = conn.recv(4096)
+                    if not received:
+                        raise ConnectionError("closed before the greeting")
+                    data += received
+                conn.sendall(b"QUIT :bye\r\n")
+            completed += 1
+        except OSError:
+            failed += 1
+    return completed, failed
+
+
+def register_probe(port: int, nick: str = "probe") -> socket.socket:
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(f"NICK {nick}\r\nUSER {nick} 0 * :{nick}\r\n".encode("UTF-8"))
+    data = b""
+    while b" 001 " not in data:
+        data += conn.recv(4096)
+    return conn
+
+
+def registration_ms(port: int, count: int = 5) -> float:
+    """Slowest time from connecting to the 001 of a few plaintext clients"""
+    slowest = 0.0
+    for i in range(count):
+        start = time.perf_counter()
+        register_probe(port, f"reg{i}").close()
+        slowest = max(slowest, time.perf_counter() - start)
+    return round(slowest * 1000, 2)
+
+
+def probe(conn: socket.socket, duration: float, interval: float = 0.01) -> list[int]:
+    """PINGs the server from a registered plaintext client, returns the round trip times in ns"""
+    samples = []
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        start = time.perf_counter_ns()
+        conn.sendall(b"PING :probe\r\n")
+        data = b""
+        while b"PONG" not in data:
+            data += conn.recv(4096)
+        samples.append(time.perf_counter_ns() - start)
+        time.sleep(interval)
+    conn.close()
+    return samples
+
+
+def percentiles(samples_ns: list[int]) -> dict[str, float | int | None]:
+    samples = sorted(samples_ns)
+    result: dict[str, float | int | None] = {"samples": len(samples)}
+    for name, q in (("p50_us", 0.5), ("p99_us", 0.99), ("max_us", 1.0)):
+        result[name] = round(samples[min(int(len(samples) * q), len(samples) - 1)] / 1000, 1) if samples else None
+    return result
+
+
+def run(procs: int, stalled: int, threads: int, duration: float, cert: str, key: str, port: int) -> dict:
+    server = start_server(port, port + 1, cert, key, threads)
+    idle = []
+    try:
+        conn = register_probe(port)
+        # Connected but silent, the server waits for their ClientHello until TLS_HANDSHAKE_TIMEOUT
+        idle = [socket.create_connection(("127.0.0.1", port + 1)) for _ in range(stalled)]
+        time.sleep(0.2)
+        registration = registration_ms(port)
+        with multiprocessing.Pool(procs) as pool:
+            result = pool.map_async(storm, [(i, port + 1, duration) for i in range(procs)])
+            ping = probe(conn, duration)
+            counts = result.get()
+    finally:
+        for conn in idle:
+            conn.close()
+        server.terminate()
+        server.wait()
+    completed = sum(c for c, _ in counts)
+    failed = sum(f for _, f in counts)
+    return {"stalled": stalled, "tls_threads": threads, "registration_ms": registration, "connects_per_s": round(completed / duration, 1),
+            "failed": failed, "ping": percentiles(ping)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--procs", type=int, default=4, help="storm processes")
+    parser.add_argument("--stalled", default="0,16", help="comma separated numbers of connections which never start "
+                                                          "a handshake")
+    parser.add_argument("--tls-threads", default="0,4", help="comma separated numbers of handshake threads")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=16700)
+    parser.add_argument("--openssl", default=shutil.which("openssl") or "openssl")
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(args.openssl, directory)
+        runs = [(int(s), int(t)) for s in args.stalled.split(",") for t in args.tls_threads.split(",")]
+        for i, (stalled, threads) in enumerate(runs):
+            result = run(args.procs, stalled, threads, args.duration, cert, key, args.port + 2 * i)
+            results.append(result)
+            ping = result["ping"]
+            print(f"stalled={stalled:<4} threads={threads:<3} registration {result['registration_ms']:>8} ms  "
+                  f"{result['connects_per_s']:>8} connects/s {result['failed']:>5} failed   "
+                  f"PING p50 {ping['p50_us']} us  p99 {ping['p99_us']} us  max {ping['max_us']} us")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
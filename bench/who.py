@@ -0,0 +1,112 @@
+"""Measures WHO <mask> on a server with many users (Dispatcher.who_mask, registry.Registry).
+
+A fake linked server bursts --users users into the server, then an operator sends every mask
+--repeat times and the time until its 315 is recorded. Each mask with a literal start (answered
+from the sorted index) is paired with one covering the same users which starts with a wildcard,
+and so has to look at every user.
+
+Usage: python bench/who.py [--users 50000] [--repeat 20] [--out results.json]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+PASSWORD = "bench"
+
+SERVER_CODE = f"""
+import sys
+import config
+config.LINK_PASSWORD = {PASSWORD!r}
+config.OPERATORS = {{"bench": {PASSWORD!r}}}
+config.METRICS_ADDR = None
+config.FLOOD_CONTROL = False
+from server import Server
+srv = Server()
+srv.bind("127.0.0.1", int(sys.argv[1]), False)
+srv.bind_links("127.0.0.1", int(sys.argv[2]), False)
+srv.run()
+"""
+
+# (label, mask) pairs, the second mask of a pair matches the same users without a literal start
+MASKS = [
+    ("prefix", "user1234*"), ("scan", "?ser1234*"),
+    ("exact", "user12345"), ("exact scan", "*user12345"),
+    ("prefix!user@host", "user12*!*@host7.example"), ("scan!user@host", "?ser12*!*@host7.example"),
+]
+
+
+def start_server(port: int, link_port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port), str(link_port)], cwd=SERVER_DIR,
+                            stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", link_port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def read_until(conn: socket.socket, marker: bytes) -> bytes:
+    data = b""
+    while marker not in data:
+        received = conn.recv(1 << 20)
+        if not received:
+            raise ConnectionError("connection closed")
+        data += received
+    return data
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--port", type=int, default=17100)
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.port + 1)
+    results = {"users": args.users, "masks": []}
+    try:
+        leaf = socket.create_connection(("127.0.0.1", args.port + 1))
+        leaf.sendall(f"SERVER leaf.bench {PASSWORD} :bench\r\n".encode("UTF-8"))
+        read_until(leaf, b"EOB")
+        burst = "".join(f"U user{i} u{i} host{i % 100}.example leaf.bench :User {i}\r\n" for i in range(args.users))
+        leaf.sendall(burst.encode("UTF-8") + b"EOB\r\nPING applied\r\n")
+        read_until(leaf, b"PONG")
+
+        oper = socket.create_connection(("127.0.0.1", args.port))
+        oper.sendall(f"NICK oper\r\nUSER oper 0 * :oper\r\nOPER bench {PASSWORD}\r\n".encode("UTF-8"))
+        read_until(oper, b" 381 ")
+        for label, mask in MASKS:
+            samples = []
+            for _ in range(args.repeat):
+                start = time.perf_counter_ns()
+                oper.sendall(f"WHO {mask}\r\n".encode("UTF-8"))
+                data = read_until(oper, b" 315 ")
+                samples.append(time.perf_counter_ns() - start)
+            samples.sort()
+            result = {"label": label, "mask": mask, "replies": data.count(b" 352 "),
+                      "p50_ms": round(samples[len(samples) // 2] / 1e6, 2), "max_ms": round(samples[-1] / 1e6, 2)}
+            results["masks"].append(result)
+            print(f"{label:<18} {mask:<26} {result['replies']:>5} replies  p50 {result['p50_ms']:>7} ms  "
+                  f"max {result['max_ms']:>7} ms")
+        leaf.close()
+        oper.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,216 +1,404 @@
 import argparse
+import asyncio
 import datetime
+import mmap
+import os
 import random
-import socket
-import time
+import sys
+from array import array
+from collections import deque
+from time import monotonic
+
+# The line framing, message parsing and flood control are shared with the server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from config import COMMAND_COST, COMMAND_COSTS, FLOOD_BURST, FLOOD_RATE
+from flood import TokenBucket
+from framing import MAX_LINE, LineBuffer
+from ircmessage import IRCMessage
 
 # Initialising variables
 PORT = 6667
 HOST = "fc00:1337::17"
 CHANNEL = "#test"
 NICK = "BOT"
-userList = []
-file = "facts.txt"
-
-#Command line arguments for user to enter their own details
-parser = argparse.ArgumentParser(description="Details for IRC bot")
-parser.add_argument("--host",
-                    "--h",
-                    help="Please enter your server's IP address",
-                    required=False,
-                    default=HOST)
-parser.add_argument("--port",
-                    "--p",
-                    help="Please enter your server's port number",
-                    required=False,
-                    default=PORT)
-parser.add_argument("--name",
-                    "--n",
-                    help="Please enter the nickname of the bot",
-                    required=False,
-                    default=NICK)
-parser.add_argument("--channel",
-                    "--c",
-                    help="Please enter the channel you would like to join",
-                    required=False,
-                    default=CHANNEL)
-args = parser.parse_args()
-HOST = args.host
-  #Needs converted to int as # can't be processed in the terminal
-PORT = int(args.port)
-NICK = args.name
-CHANNEL = args.channel
-
-# Initialising the socket
-s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-
-
-# Function to connect to the server
-def connect():
-    try:
-        print("BOT is trying to connect to the server...")
-        s.connect((HOST, PORT))
-        #Alerts the user what HOST and PORT the BOT is connecting to
-        print(f"Connecting at {HOST}/{PORT}")
-
-    # If the BOT cannot to connect to the server
-    except:
-        print("BOT failed to connect to the server, attempting to reconnect...")
-        time.sleep(5)
-        try:
-            s.connect((HOST, PORT))
-        except:
-            print("BOT cannot connect to the server, disconnecting...")
-            exit()
-    try:
-        #Sending client information to the server
-        s.send(bytes("USER " + NICK + " " + NICK + " " + NICK + " :python\r\n", "UTF-8"))
-        s.send(bytes("NICK " + NICK + "\r\n", "UTF-8"))  #Sets the bots nick name
-        print("BOT information has been successfully sent to the server.")
-    except:
-        print("BOT information was unable to be sent to the server, please try again.")
-        exit()
+FACTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "facts.txt")
+RECONNECT_DELAY = 5  # seconds between attempts to reach a server
+OUTBOX_LINES = 1000  # replies queued per connection before new ones are dropped
 
 
-#Function to join the channel
-def join(chan):
-    try:
-        print("Attempting to join channel... ")
-        #Sending join information to the server
-        s.send(bytes("JOIN " + chan + "\r\n", "UTF-8"))
-        print("Successfully joined channel.")
-    except:
-        print("Unable to join channel: ")
-        exit()
+# Facts from a text file, one per line. The file is memory-mapped and only the offsets of the lines are
+# kept, so a large file costs no more memory than a small one. It is mapped again when it changes
+class Facts:
+    def __init__(self, path):
+        self.path = path
+        self.version = None  # (mtime, size) of the mapped file
+        self.data = b""
+        self.offsets = array("Q")  # start of every non-empty line
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            print(f"Unable to read facts: {e}")
+            return
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self.version:
+            return
+        with open(self.path, "rb") as f:
+            # A zero length file can not be mapped
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        offsets = array("Q")
+        start = 0
+        while start < len(data):
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            if data[start:end].strip():
+                offsets.append(start)
+            start = end + 1
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data, self.offsets, self.version = data, offsets, version
+        print(f"Loaded {len(offsets)} facts.")
+
+    def random(self):
+        self.reload()
+        if not self.offsets:
+            return None
+        start = self.offsets[random.randrange(len(self.offsets))]
+        end = self.data.find(b"\n", start)
+        return self.data[start:end if end != -1 else len(self.data)].decode("UTF-8").strip()
+
+
+# Nicknames in the channel: a dict from the lowercase nickname to its position in a list, for O(1) joins,
+# parts and random picks. A part moves the last nickname into the freed position
+class Roster:
+    def __init__(self):
+        self.positions = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, nick):
+        key = nick.lower()
+        if key not in self.positions:
+            self.positions[key] = len(self.names)
+            self.names.append(nick)
+
+    def remove(self, nick):
+        position = self.positions.pop(nick.lower(), None)
+        if position is None:
+            return
+        last = self.names.pop()
+        if position < len(self.names):
+            self.names[position] = last
+            self.positions[last.lower()] = position
+
+    def random(self, exclude=None):
+        """A random nickname other than exclude, None if there is none"""
+        skip = self.positions.get(exclude.lower()) if exclude is not None else None
+        count = len(self.names) - (skip is not None)
+        if count <= 0:
+            return None
+        position = random.randrange(count)
+        if skip is not None and position >= skip:
+            position += 1
+        return self.names[position]
+
+
+# Lines waiting to be sent to a server. They leave at the rate the server's flood control allows (a
+# TokenBucket with its FLOOD_RATE, FLOOD_BURST and COMMAND_COSTS), so the server never has to defer the
+# bot, and every line allowed at one time goes out in a single write
+class Outbox:
+    def __init__(self, writer):
+        self.writer = writer
+        self.lines = deque()
+        self.bucket = TokenBucket(FLOOD_RATE, FLOOD_BURST)
+        self.ready = asyncio.Event()
+
+    def send(self, line, urgent=False):
+        # Urgent lines (PONG) jump the queue, the server disconnects the bot if they are late
+        if urgent:
+            self.lines.appendleft(line)
+        elif len(self.lines) < OUTBOX_LINES:
+            self.lines.append(line)
+        else:
+            print(f"Outbox full, dropping: {line}")
+            return
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.lines:
+                batch = []
+                wait = 0.0
+                while self.lines:
+                    wait = self.bucket.take(cost(self.lines[0]), monotonic())
+                    if wait:
+                        break
+                    batch.append(self.lines.popleft())
+                if batch:
+                    self.writer.write(("\r\n".join(batch) + "\r\n").encode("UTF-8"))
+                    await self.writer.drain()
+                if wait:
+                    await asyncio.sleep(wait)
+
+
+# What the server's flood control charges for a line
+def cost(line):
+    return COMMAND_COSTS.get(line.split(" ", 1)[0].upper(), COMMAND_COST)
+
+
+# One server connection and the channels the bot is in there, each with its own user list
+class Connection:
+    def __init__(self, host, port, nick, channels, facts):
+        self.host = host
+        self.port = port
+        self.nick = nick
+        self.wanted = channels  # channels to join whenever the bot connects
+        self.channels = {}  # {lowercase channel name: Roster}
+        self.facts = facts
+        self.outbox = None
+
+    async def run(self):
+        # Reconnects for as long as the bot runs, other connections carry on meanwhile
+        while True:
+            try:
+                print(f"BOT is trying to connect to {self.host}/{self.port}...")
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                print(f"BOT failed to connect to {self.host}/{self.port}: {e}, retrying in {RECONNECT_DELAY}s")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            self.outbox = Outbox(writer)
+            sender = asyncio.create_task(self.outbox.run())
+            # Sending client information to the server
+            self.send(f"USER {self.nick} {self.nick} {self.nick} :python")
+            self.send(f"NICK {self.nick}")
+            try:
+                if not await self.receive(reader):
+                    return
+                print(f"{self.host}/{self.port} closed the connection, reconnecting in {RECONNECT_DELAY}s")
+            except OSError as e:
+                print(f"Lost {self.host}/{self.port}: {e}, reconnecting in {RECONNECT_DELAY}s")
+            finally:
+                sender.cancel()
+                writer.close()
+                self.channels.clear()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def receive(self, reader):
+        """Handles lines until the server closes the connection, returns False if the bot should not reconnect"""
+        buffer = LineBuffer()
+        while True:
+            data = await reader.read(buffer.free)
+            if not data:
+                return True
+            buffer.feed(data)
+            for line in buffer.lines():
+                msg = IRCMessage.parse(line)
+                handler = HANDLERS.get(msg.command) if msg is not None else None
+                if handler is None:
+                    continue
+                try:
+                    if handler(self, msg) is False:
+                        return False
+                except Exception as e:
+                    # A line the bot does not understand must not take the other channels down with it
+                    print(f"Unable to handle {line!r}: {e!r}")
+
+    def send(self, line, urgent=False):
+        self.outbox.send(line, urgent)
+
+    def join(self, channels):
+        # The server takes a list of channels in one JOIN, and charges for the JOIN once
+        line = ""
+        for channel in channels:
+            if line and len(line) + len(channel) + len(",\r\n") > MAX_LINE:
+                self.send(line)
+                line = ""
+            line = f"{line},{channel}" if line else f"JOIN {channel}"
+        if line:
+            self.send(line)
+
+    def is_me(self, nick):
+        return nick.lower() == self.nick.lower()
+
+
+# Nickname of the sender of a message
+def origin_of(msg):
+    return (msg.prefix or "").split("!", 1)[0]
 
 
 # Function to PING back so that it doesn't ping timeout
-def ping_pong(message):
-    s.send(bytes("PONG :" + message + "\r\n", "UTF-8"))
-
-
-# Splitting the message for ping pong
-def message_split(message):
-    message = message.split(" ")
-    return message
-
-
-# Function to display the users in the channel and store their information
-def display_users(msg):
-    for i in range(5, len(msg)):
-        if i == 5:
-            userList.append(msg[i][1:])
-            continue
-        userList.append(msg[i])
-    print("Current users in the channel: ")
-    userList.remove(NICK)
-    print(userList)
-    return userList
-
-
-# If a user joins the channel, add them to the user list
-def update_users_joining(msg):
-    user = msg[0][1:].split("!", 1)[0]
-    if user not in userList:
-        display_users(msg)
-        userList.append(user)
-        print(userList)
-
-
-# If a user leaves the channel, remove them from the user list
-def update_users_leaving(msg):
-    user = msg[0][1:].split("!", 1)[0]
-    if user in userList:
-        display_users()
-        userList.remove(user)
-        print(userList)
-
-
-# Get random fact from text file
-def get_random_fact():
-    with open('facts.txt', 'r') as f:
-        lines = f.read().splitlines()
-        return random.choice(lines)
-
-
-# Send a message to the desired person
-def send_message(message, target):
-    s.send(bytes("PRIVMSG " + target + " :" + message + "\r\n", "UTF-8"))
-
-
-# Get a random user from the channel
-def get_random_user():
-    user = random.choice(userList)
-    return user
-
-
-# Process messages as per the their string format
-def process_message(msg):
-    origin = msg[0][1:].split("!", 1)[0] # Finds the origin of the message
-    message = msg[3]  # Gets the message
-    destination = msg[2]  # What channel or user the message is directed to
-
-    # Lets us know that the message is either a private message or a channel message
-    if destination.lower() == CHANNEL.lower():
-
-        # Responds appropriately to the hello command
-        if message.find("!hello") != -1:
-            greeting = datetime.datetime.now().strftime('%d-%m-%y %H:%M')
-            send_message("Hello " + origin + " it is currently " + greeting + " ", destination)
-
-        # Responds appropriately to the slap command
-        if message.find("!slap") != -1:
-            # Slaps a random user which is not the bot or themselves
-            randomSlap = origin
-            slapped = randomSlap
-            while slapped == randomSlap:
-                randomSlap = get_random_user() if len(userList) > 1 else "yourself"
-            send_message("Slap " + randomSlap + " around the face with a large trout", destination)
-
-    # Lets us know it is a private message
-    if destination.lower() == NICK.lower():
-        # Hence respond with a random fact
-        if message != -1:
-            fact = get_random_fact()
-            send_message(fact, origin)
-
-
-# Function to handle separate commands
-def handle_commands(msg):
-    try:
-        if msg[0] == "PING":
-            ping_pong(msg[0])
-        # If a PRIVMSG, then process the message
-        elif msg[1] == "PRIVMSG":
-            process_message(msg)
-        # If a 353, then display the users in the channel
-        elif msg[1] == "353":
-            display_users(msg)
-        # If a 433, then the BOT nickname is already in use
-        elif msg[1] == "433":
-            print("BOT nickname is being used, please try again using command line arguments.")
-            exit()
-        elif msg[1] == "JOIN":
-            update_users_joining(msg)
-        elif msg[1] == "QUIT":
-            update_users_leaving(msg)
-    except:
+def on_ping(conn, msg):
+    conn.send("PONG :" + (msg.params[0] if msg.params else ""), urgent=True)
+
+
+# Registered, now the channels can be joined
+def on_welcome(conn, msg):
+    print(f"Registered on {conn.host}/{conn.port} as {conn.nick}, joining {len(conn.wanted)} channels")
+    conn.join(conn.wanted)
+
+
+# If a 433, then the BOT nickname is already in use
+def on_nickname_in_use(conn, msg):
+    print(f"BOT nickname is being used on {conn.host}/{conn.port}, please try again using command line arguments.")
+    return False
+
+
+# Store the users of a 353 (NAMES) reply, a nickname already known is not added again
+def on_names(conn, msg):
+    if len(msg.params) < 4:
+        return
+    users = conn.channels.get(msg.params[2].lower())
+    if users is None:
         return
+    for nick in msg.params[3].split(" "):
+        nick = nick.lstrip("@+")
+        if nick and not conn.is_me(nick):
+            users.add(nick)
+
+
+def on_join(conn, msg):
+    user = origin_of(msg)
+    for channel in msg.params[0].split(",") if msg.params else ():
+        if conn.is_me(user):
+            conn.channels[channel.lower()] = Roster()
+        elif channel.lower() in conn.channels:
+            conn.channels[channel.lower()].add(user)
+
+
+def on_part(conn, msg):
+    user = origin_of(msg)
+    for channel in msg.params[0].split(",") if msg.params else ():
+        if conn.is_me(user):
+            conn.channels.pop(channel.lower(), None)
+        elif channel.lower() in conn.channels:
+            conn.channels[channel.lower()].remove(user)
+
+
+def on_quit(conn, msg):
+    user = origin_of(msg)
+    for users in conn.channels.values():
+        users.remove(user)
+
+
+# If a user changes nickname, keep the user lists up to date
+def on_nick(conn, msg):
+    user = origin_of(msg)
+    if not msg.params:
+        return
+    if conn.is_me(user):
+        conn.nick = msg.params[0]
+        return
+    for users in conn.channels.values():
+        if user.lower() in users.positions:
+            users.remove(user)
+            users.add(msg.params[0])
+
+
+# Channel messages are looked up by their first word in COMMANDS, private messages get a random fact
+def on_privmsg(conn, msg):
+    if len(msg.params) < 2:
+        return
+    origin = origin_of(msg)
+    destination = msg.params[0]
+    if destination.lower() in conn.channels:
+        command = COMMANDS.get(msg.params[1].split(" ", 1)[0].lower())
+        if command is not None:
+            command(conn, destination, origin)
+    elif conn.is_me(destination):
+        fact = conn.facts.random()
+        if fact is not None:
+            conn.send(f"PRIVMSG {origin} :{fact}")
+
+
+# Responds appropriately to the hello command
+def hello(conn, channel, origin):
+    greeting = datetime.datetime.now().strftime('%d-%m-%y %H:%M')
+    conn.send(f"PRIVMSG {channel} :Hello {origin} it is currently {greeting} ")
+
+
+# Slaps a random user which is not the bot or themselves
+def slap(conn, channel, origin):
+    victim = conn.channels[channel.lower()].random(origin) or "yourself"
+    conn.send(f"PRIVMSG {channel} :Slap {victim} around the face with a large trout")
+
+
+HANDLERS = {
+    "PING": on_ping,
+    "001": on_welcome,
+    "433": on_nickname_in_use,
+    "353": on_names,
+    "JOIN": on_join,
+    "PART": on_part,
+    "QUIT": on_quit,
+    "NICK": on_nick,
+    "PRIVMSG": on_privmsg,
+}
+
+COMMANDS = {
+    "!hello": hello,
+    "!slap": slap,
+}
 
 
 # Main function
 def main():
-    connect()
-    join(CHANNEL)
-    #Infinite while loop to keep the bot running
-    while True:
-        #Parses the seperate commands
-        info = s.recv(2048).decode("UTF-8")
-        messages = info.split("\r\n")
-        for msg in messages:
-            print(msg)
-            msg = message_split(msg)
-            handle_commands(msg)
+    #Command line arguments for user to enter their own details
+    parser = argparse.ArgumentParser(description="Details for IRC bot")
+    parser.add_argument("--host",
+                        "--h",
+                        help="Please enter your server's IP address",
+                        required=False,
+                        default=HOST)
+    parser.add_argument("--port",
+                        "--p",
+                        help="Please enter your server's port number",
+                        required=False,
+                        default=PORT)
+    parser.add_argument("--server",
+                        "--s",
+                        help="Another server to connect to as HOST:PORT, may be given many times",
+                        action="append",
+                        default=[])
+    parser.add_argument("--name",
+                        "--n",
+                        help="Please enter the nickname of the bot",
+                        required=False,
+                        default=NICK)
+    parser.add_argument("--channel",
+                        "--c",
+                        help="Please enter the channels you would like to join, separated by commas",
+                        required=False,
+                        default=CHANNEL)
+    parser.add_argument("--facts",
+                        help="Please enter the file with one fact per line",
+                        required=False,
+                        default=FACTS)
+    args = parser.parse_args()
+
+    #Needs converted to int as # can't be processed in the terminal
+    servers = [(args.host, int(args.port))]
+    for server in args.server:
+        host, _, port = server.rpartition(":")
+        servers.append((host.strip("[]"), int(port)))
+    channels = [channel for channel in args.channel.split(",") if channel]
+    facts = Facts(args.facts)
+    facts.reload()
+
+    async def run():
+        # Every connection shares the facts, and joins the same channels
+        await asyncio.gather(*(Connection(host, port, args.name, channels, facts).run() for host, port in servers))
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
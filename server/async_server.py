@@ -0,0 +1,149 @@
+import asyncio
+import ssl
+import sys
+from time import monotonic
+from asyncio import StreamReader, StreamWriter
+from socket import AF_INET, AF_INET6
+from typing import Callable
+
+import config
+import profiler
+from client import Client
+from dispatch import Dispatcher
+from offload import format_host
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class AsyncClient(Client):
+    __slots__ = ("reader", "writer", "resolved")
+    reader: StreamReader
+    writer: StreamWriter
+    resolved: asyncio.Event  # set once the hostname lookup is done, reading starts then
+
+    def __init__(self, reader: StreamReader, writer: StreamWriter, on_sendq: Callable[[Client], None], host: str) -> None:
+        super().__init__(writer.get_extra_info("socket"), on_sendq, host)
+        self.reader = reader
+        self.writer = writer
+        self.resolved = asyncio.Event()
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing()
+
+    def write(self, data: bytes) -> None:
+        # Never blocks, the transport buffers whatever the peer has not read yet
+        if self.quit_reason is not None:
+            return
+        self.writer.write(data)
+        if self.writer.transport.get_write_buffer_size() > self.sendq_max:
+            self.fail("SendQ exceeded")
+
+    def close(self) -> None:
+        if self.quit_reason is not None:
+            # Whatever is still buffered is not going to be read anyway
+            self.writer.transport.abort()
+        else:
+            self.writer.close()
+
+
+class AsyncServer(Dispatcher):
+    """Runs the same command handlers as Server on top of asyncio streams"""
+    addr: str
+    port: int
+    family: int
+    tls_context: ssl.SSLContext | None = None
+    tls_addr: tuple[str, int, int]  # (address, port, family) of the TLS listener
+    tls_server: asyncio.Server
+
+    def bind(self, addr: str = "127.0.0.1", port: int = 6667, ipv6: bool = True) -> None:
+        # The listening socket is created once the event loop is running
+        self.addr = addr
+        self.port = port
+        self.family = AF_INET6 if ipv6 else AF_INET
+
+    def bind_tls(self, context: ssl.SSLContext, addr: str = "127.0.0.1", port: int = 6697, ipv6: bool = True) -> None:
+        """Listens for TLS connections as well. asyncio runs their handshakes on the loop, but never blocks on them"""
+        self.tls_context = context
+        self.tls_addr = (addr, port, AF_INET6 if ipv6 else AF_INET)
+
+    def run(self) -> None:
+        try:
+            if uvloop is not None and sys.platform == "linux":
+                with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                    runner.run(self.serve())
+            else:
+                asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("[SERVER] KeyboardInterrupt received. Quitting...")
+            if self.store is not None:
+                self.store.close()
+
+    async def serve(self) -> None:
+        server = await asyncio.start_server(self.handle_connection, self.addr, self.port, family=self.family)
+        if self.tls_context is not None:
+            addr, port, family = self.tls_addr
+            self.tls_server = await asyncio.start_server(self.handle_connection, addr, port, family=family,
+                                                         ssl=self.tls_context,
+                                                         ssl_handshake_timeout=config.TLS_HANDSHAKE_TIMEOUT)
+        asyncio.get_running_loop().add_reader(self.offloader.wakeup, self.offload_done)
+        async with server:
+            while True:
+                await asyncio.sleep(1)
+                profiler.call(self.check_clients)
+                profiler.call(self.process_pending)
+                profiler.poll()
+
+    def input_ready(self, client: Client) -> None:
+        client.resolved.set()
+
+    def offload_done(self) -> None:
+        self.offloader.on_readable()
+        # Callbacks may have greeted clients
+        self.process_pending()
+
+    async def handle_connection(self, reader: StreamReader, writer: StreamWriter) -> None:
+        address = writer.get_extra_info("peername")[0]
+        client = AsyncClient(reader, writer, self.sendq_changed, format_host(address))
+        self.add_client(client, address)
+
+        try:
+            if client.resolving:
+                await client.resolved.wait()
+            while not client.closed:
+                data = await reader.read(client.inbuf.free)
+                if not data:
+                    self.quit_client(client, "Connection closed")
+                    return
+
+                client.inbuf.feed(data)
+                self.handle_lines(client, client.inbuf.lines())
+                while True:
+                    # Paused by flood control, nothing is read until the deferred message has been handled
+                    while client.deferred is not None and not client.closed:
+                        self.process_pending()
+                        await asyncio.sleep(max(0.0, client.resume_at - monotonic()))
+                        self.resume(client)
+                    self.process_pending()
+                    if client.closed:
+                        return
+                    # Stop reading from a client until the replies it caused have been flushed.
+                    # Only this client waits here, everyone else keeps being served
+                    await writer.drain()
+                    if client not in self.streams:
+                        break
+                    # Long replies go out a batch at a time, each once the previous one has been taken by the
+                    # transport. The lines left in the buffer are handled once they are done, and may defer again
+                    while client in self.streams and not client.closed:
+                        self.continue_stream(client)
+                        self.process_pending()
+                        await writer.drain()
+                        # drain() does not yield while the transport is below its high water mark
+                        await asyncio.sleep(0)
+        except OSError as e:
+            print(f"[CLIENT] Connection error on {client.conn}: {e}")
+            if not client.closed:
+                self.quit_client(client, "Leaving")
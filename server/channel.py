@@ -1,19 +1,168 @@
+import sys
+from bisect import bisect_left, insort
+from typing import Iterable, Iterator
+
+import config
+import metrics
 from client import Client
+from flood import TokenBucket
+from framing import MAX_LINE
 
 
 class Channel:
-    name: str
-    # TODO: this should probably be a {username: (modes, etc.)} dictionary
-    users: set[Client]
+    __slots__ = ("name", "users", "topic", "_names", "names_budget", "sizes", "slot")
+    name: str  # interned, it is the key of Dispatcher.channels and repeated in every line sent to the channel
+    users: dict[Client, str]  # {member: channel modes of the member}, Client.channels is the other side of the index
     topic: str
+    _names: list[str] | None  # cached NAMES payloads, see names()
+    names_budget: int  # longest NAMES payload which fits into a 353 line to any recipient
+    sizes: "ChannelSizes"  # index of every channel by its number of users, kept up to date by add_user and remove_user
+    slot: int  # position in its bucket of sizes
+    fanout: TokenBucket | None = None  # shared by every channel, charged with the bytes broadcasts queue
 
-    def __init__(self, name: str, topic: str = "") -> None:
-        self.name = name
+    def __init__(self, name: str, sizes: "ChannelSizes", topic: str = "") -> None:
+        self.name = sys.intern(name)
         self.topic = topic
-        self.users = set()
+        self.users = {}
+        self._names = None
+        header = f":{config.HOSTNAME} 353 {'x' * config.NICKLEN} = {self.name} :"
+        self.names_budget = MAX_LINE - len("\r\n") - len(header)
+        self.sizes = sizes
+        sizes.insert(self)
 
-    def add_user(self, user: Client) -> None:
-        self.users.add(user)
+    def add_user(self, user: Client, modes: str = "") -> None:
+        if user not in self.users:
+            if self._names is not None:
+                self.append_name(user.nickname)
+            self.users[user] = modes
+            self.sizes.resized(self, len(self.users) - 1)
+        else:
+            self.users[user] = modes
+        user.channels.add(self)
 
     def remove_user(self, user: Client) -> None:
-        self.users.remove(user)
+        del self.users[user]
+        user.channels.discard(self)
+        self._names = None
+        self.sizes.resized(self, len(self.users) + 1)
+
+    def names(self) -> list[str]:
+        """Nicknames of the members, space separated and packed into as few 353 payloads as fit into the line limit.
+        Cached until a member leaves or changes its nickname, a JOIN only extends the last payload"""
+        if self._names is None:
+            self._names = []
+            for user in self.users:
+                self.append_name(user.nickname)
+        return self._names
+
+    def append_name(self, nickname: str) -> None:
+        names = self._names
+        if names and len(names[-1]) + 1 + len(nickname) <= self.names_budget:
+            names[-1] += " " + nickname
+        else:
+            names.append(nickname)
+
+    def invalidate_names(self) -> None:
+        self._names = None
+
+    def broadcast(self, line: str, exclude: Client | None = None) -> None:
+        """Sends a line to every local user of the channel. It is encoded once and the same bytes are queued for everyone.
+        Remote users get it from their own server, see Dispatcher.propagate"""
+        data = (line + "\r\n").encode("UTF-8")
+        count = 0
+        for user in self.users:
+            if user is not exclude and not user.is_remote:
+                user.write(data)
+                count += 1
+        metrics.output(len(data), count)
+        metrics.fanout_recipients.observe(count)
+        if Channel.fanout is not None:
+            Channel.fanout.charge(len(data) * count)
+
+
+class ChannelSizes:
+    """Every channel, bucketed by its number of users, for LIST. Joins and parts move a channel to the next bucket
+    in O(1): buckets are lists, and a channel leaving one is replaced by the last channel of it.
+    Only the sizes themselves are kept sorted, there are far fewer of them than channels"""
+    __slots__ = ("buckets", "sizes")
+    buckets: dict[int, list[Channel]]  # {number of users: channels with that many}, Channel.slot indexes the list
+    sizes: list[int]  # keys of buckets, ascending
+
+    def __init__(self) -> None:
+        self.buckets = {}
+        self.sizes = []
+
+    def insert(self, channel: Channel) -> None:
+        size = len(channel.users)
+        bucket = self.buckets.get(size)
+        if bucket is None:
+            bucket = self.buckets[size] = []
+            insort(self.sizes, size)
+        channel.slot = len(bucket)
+        bucket.append(channel)
+
+    def remove(self, channel: Channel, size: int) -> None:
+        bucket = self.buckets[size]
+        last = bucket.pop()
+        if last is not channel:
+            bucket[channel.slot] = last
+            last.slot = channel.slot
+        elif not bucket:
+            del self.buckets[size]
+            del self.sizes[bisect_left(self.sizes, size)]
+
+    def resized(self, channel: Channel, old_size: int) -> None:
+        self.remove(channel, old_size)
+        self.insert(channel)
+
+    def descending(self, above: int = -1, below: int = sys.maxsize) -> Iterator[Channel]:
+        """Channels with more than above and fewer than below users, largest first. Meant to be consumed over
+        several loop ticks: the position is looked up again on every step, so channels may change in between.
+        Buckets are walked from their end, so a channel keeping its size is never skipped. One changing its size
+        may be yielded twice or not at all, as may one moved into a hole by a removal"""
+        size = below
+        while True:
+            i = bisect_left(self.sizes, size) - 1
+            if i < 0 or self.sizes[i] <= above:
+                return
+            size = self.sizes[i]
+            bucket = self.buckets[size]
+            slot = len(bucket)
+            while True:
+                # The bucket may have shrunk, or been dropped and left empty, since the last step
+                slot = min(slot, len(bucket)) - 1
+                if slot < 0:
+                    break
+                yield bucket[slot]
+
+
+def peers(user: Client) -> set[Client]:
+    """Local users sharing at least one channel with the user, the user itself excluded"""
+    result: set[Client] = set()
+    for channel in user.channels:
+        result.update(channel.users)
+    result.discard(user)
+    return result
+
+
+def broadcast_to_peers(user: Client, line: str, also: Iterable[Client] = ()) -> None:
+    """Sends a line once to everyone sharing a channel with the user, however many channels they share"""
+    data = (line + "\r\n").encode("UTF-8")
+    count = 0
+    for peer in peers(user).union(also):
+        if not peer.is_remote:
+            peer.write(data)
+            count += 1
+    metrics.output(len(data), count)
+    metrics.fanout_recipients.observe(count)
+    if Channel.fanout is not None:
+        Channel.fanout.charge(len(data) * count)
+
+
+def leave_all(user: Client) -> None:
+    """Removes the user from every channel it is on"""
+    for channel in user.channels:
+        del channel.users[user]
+        channel.invalidate_names()
+        channel.sizes.resized(channel, len(channel.users) + 1)
+    user.channels.clear()
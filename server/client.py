@@ -1,23 +1,91 @@
+import os
+from collections import deque
+from itertools import islice
 from socket import socket
-from typing import Iterable
-from time import time_ns
+from ssl import SSLSocket
+from typing import TYPE_CHECKING, Callable, Iterable
+from time import monotonic
 import config
 import log
+import metrics
+from flood import TokenBucket
+from framing import LineBuffer
+from registry import fold
+from tls import WOULD_BLOCK
+
+if TYPE_CHECKING:
+    from channel import Channel
+    from ircmessage import IRCMessage
+
+# User modes, as the bits of Client.mode. The values are the ones of the USER mode parameter
+MODE_WALLOPS = 2
+MODE_INVISIBLE = 8
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")  # buffers a single sendmsg takes
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
 
 
 class Client:
+    # Slotted, there is one of these per connection and an instance __dict__ would be most of its size
+    __slots__ = ("conn", "_nickname", "key", "_username", "_host", "_prefix", "realname", "op", "mode",
+                 "channels", "resolving", "connected_at", "last_interaction", "is_pinged", "inbuf", "sendq",
+                 "sendq_size", "quit_reason", "on_sendq", "flood", "deferred", "resume_at")
     conn: socket
-    nickname: str = "*"  # [1..10]
-    username: str = ""
-    realname: str = ""
-    op: bool = False
-    mode: tuple[bool, bool]
-    last_interaction: int
-    is_pinged: bool = False
-
-    def __init__(self, conn: socket) -> None:
+    _nickname: str  # [1..10]
+    key: str  # folded nickname, the key of Dispatcher.clients
+    _username: str
+    _host: str  # hostname or address the user connected from
+    _prefix: str | None  # cached, reset whenever the nickname, username or host changes
+    realname: str
+    op: bool
+    is_remote: bool = False  # connected to another server of the cluster, see link.RemoteClient
+    sendq_max: int = config.SENDQ_MAX
+    corked: bool = False  # writes are only queued, the engine flushes them once per loop tick, see Server.want_write
+    mode: int  # MODE_* bits
+    channels: set["Channel"]  # channels the user is on, Channel.users is the other side of the index
+    resolving: bool  # the host is being looked up, nothing is read from the client until it is known
+    connected_at: float  # monotonic time
+    last_interaction: float  # monotonic time
+    is_pinged: bool
+    inbuf: LineBuffer
+    sendq: deque[bytes | memoryview] | None  # data the socket did not accept yet, only allocated once needed
+    sendq_size: int
+    quit_reason: str | None  # set when the client has to be disconnected once the current handler is done
+    on_sendq: Callable[["Client"], None] | None  # notifies the server that sendq or quit_reason has changed
+    flood: TokenBucket  # pays for the commands of the client
+    deferred: "IRCMessage | None"  # message held back by flood control, nothing is read until it has been handled
+    resume_at: float  # monotonic time at which the deferred message can be handled
+
+    def __init__(self, conn: socket, on_sendq: Callable[["Client"], None] | None = None,
+                 host: str = config.HOSTNAME) -> None:
         self.conn = conn
-        self.last_interaction = time_ns()
+        self.init_user(host=host)
+        self.resolving = False
+        self.connected_at = monotonic()
+        self.last_interaction = self.connected_at
+        self.is_pinged = False
+        self.inbuf = LineBuffer()
+        self.sendq = None
+        self.sendq_size = 0
+        self.quit_reason = None
+        self.on_sendq = on_sendq
+        self.flood = TokenBucket(config.FLOOD_RATE, config.FLOOD_BURST)
+        self.deferred = None
+        self.resume_at = 0.0
+
+    def init_user(self, nickname: str = "*", username: str = "", realname: str = "", host: str = config.HOSTNAME) -> None:
+        """Sets the user state, which local and remote users have in common"""
+        self._nickname = nickname
+        self.key = fold(nickname)
+        self._username = username
+        self._host = host
+        self._prefix = None
+        self.realname = realname
+        self.op = False
+        self.mode = 0
+        self.channels = set()
 
     @property
     # TODO: refactor this function. Remove default values and use something that makes sense
@@ -26,46 +94,154 @@ class Client:
         return self.nickname != "*" and self.username != ""
 
     @property
-    def is_alive(self) -> bool:
-        """The user is active and has sent/received PING or other messages"""
+    def deadline(self) -> float:
+        """Time at which the user has to be sent a PING, or timed out if it has been pinged already"""
         if not self.is_pinged:
-            return (time_ns() - self.last_interaction) < 60 * 1000 * 1000 * 1000  # 60 seconds
+            return self.last_interaction + config.PING_INTERVAL
         else:
-            return (time_ns() - self.last_interaction) < 15 * 1000 * 1000 * 1000  # 15 seconds
+            return self.last_interaction + config.PING_TIMEOUT
 
     def update_last_interaction(self) -> None:
         """'Interact' with the user, updating the timestamp of last interaction and setting is_pinged to False again"""
-        self.last_interaction = time_ns()
+        self.last_interaction = monotonic()
         self.is_pinged = False
 
+    @property
+    def nickname(self) -> str:
+        return self._nickname
+
+    @nickname.setter
+    def nickname(self, nickname: str) -> None:
+        self._nickname = nickname
+        self.key = fold(nickname)
+        self._prefix = None
+        for channel in self.channels:
+            channel.invalidate_names()
+
+    @property
+    def username(self) -> str:
+        return self._username
+
+    @username.setter
+    def username(self, username: str) -> None:
+        self._username = username
+        self._prefix = None
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @host.setter
+    def host(self, host: str) -> None:
+        self._host = host
+        self._prefix = None
+
+    @property
+    def closed(self) -> bool:
+        return self.conn.fileno() == -1
+
+    def write(self, data: bytes) -> None:
+        '''Writes raw bytes to the connection without blocking. Every send_* method goes through here.
+        Whatever the socket does not accept right away is queued until it becomes writable.'''
+        if self.quit_reason is not None:
+            return
+
+        if not self.sendq and not self.corked:
+            metrics.send_calls.inc()
+            try:
+                sent = self.conn.send(data)
+            except WOULD_BLOCK:
+                sent = 0
+            except OSError as e:
+                self.fail(f"Write error: {e.strerror}")
+                return
+            if sent == len(data):
+                return
+            data = memoryview(data)[sent:]
+
+        if self.sendq is None:
+            self.sendq = deque()
+        # The engine only has to hear about the first buffer, it flushes the rest along with it
+        notify = not self.sendq
+        self.sendq.append(data)
+        self.sendq_size += len(data)
+        if self.sendq_size > self.sendq_max:
+            self.sendq.clear()
+            self.sendq_size = 0
+            self.fail("SendQ exceeded")
+        elif notify and self.on_sendq is not None:
+            self.on_sendq(self)
+
+    def flush(self) -> None:
+        '''Sends as much of the queued data as the socket accepts. The buffers are handed to a single
+        sendmsg (writev) without being joined, TLS sockets can not do that and get them joined instead'''
+        sendq = self.sendq
+        while sendq:
+            chunks = list(islice(sendq, IOV_MAX))
+            metrics.send_calls.inc()
+            try:
+                if isinstance(self.conn, SSLSocket):
+                    sent = self.conn.send(b"".join(chunks) if len(chunks) > 1 else chunks[0])
+                else:
+                    sent = self.conn.sendmsg(chunks)
+            except WOULD_BLOCK:
+                return
+            except OSError as e:
+                self.fail(f"Write error: {e.strerror}")
+                return
+            self.sendq_size -= sent
+            for data in chunks:
+                if sent < len(data):
+                    sendq[0] = memoryview(data)[sent:]
+                    return
+                sent -= len(data)
+                sendq.popleft()
+
+    def fail(self, reason: str) -> None:
+        '''Marks the client for disconnection. Quitting right away could modify channels in the middle of a fan-out'''
+        if self.quit_reason is None:
+            self.quit_reason = reason
+            if self.on_sendq is not None:
+                self.on_sendq(self)
+
+    def close(self) -> None:
+        self.conn.close()
+
     def send_with_prefix(self, data: str) -> None:
         '''Sends a string to the user. Adds a server prefix.'''
-        log.debug(f"[SEND_PREFIX] SENDING TO {self.nickname} {data=}")
+        log.debug("[SEND_PREFIX] SENDING TO %s data=%r", self.nickname, data)
 
-        self.conn.sendall(f":{config.HOSTNAME} {data}\r\n".encode("UTF-8"))
+        encoded = f":{config.HOSTNAME} {data}\r\n".encode("UTF-8")
+        metrics.output(len(encoded))
+        self.write(encoded)
 
     def send_iter_with_prefix(self, data: Iterable[str]) -> None:
         '''Sends an iterable of strings to the user. Adds a server prefix.'''
-        log.debug(f"[SEND_PREFIX_ITER] SENDING TO {self.nickname} {data=}")
-
-        msg = ""
-        for s in data:
-            msg += f":{config.HOSTNAME} {s}\r\n"
+        log.debug("[SEND_PREFIX_ITER] SENDING TO %s data=%r", self.nickname, data)
 
-        self.conn.sendall(msg.encode("UTF-8"))
+        # join sizes the result once, however many lines there are
+        encoded = "".join([f":{config.HOSTNAME} {s}\r\n" for s in data]).encode("UTF-8")
+        metrics.output(len(encoded))
+        self.write(encoded)
 
     def send(self, data: str) -> None:
         '''Sends a string to the user. Does not add a prefix.'''
-        log.debug(f"[SEND] SENDING TO {self.nickname} {data=}")
+        log.debug("[SEND] SENDING TO %s data=%r", self.nickname, data)
 
-        self.conn.sendall((data + '\r\n').encode("UTF-8"))
+        encoded = (data + '\r\n').encode("UTF-8")
+        metrics.output(len(encoded))
+        self.write(encoded)
 
     def send_iter(self, data: Iterable[str]) -> None:
         '''Sends an iterable of strings to the user. Does not add a prefix.'''
-        log.debug(f"[SEND_ITER] SENDING TO {self.nickname} {data=}")
+        log.debug("[SEND_ITER] SENDING TO %s data=%r", self.nickname, data)
 
-        self.conn.sendall(('\r\n'.join(data) + '\r\n').encode("UTF-8"))
+        encoded = ('\r\n'.join(data) + '\r\n').encode("UTF-8")
+        metrics.output(len(encoded))
+        self.write(encoded)
 
     @property
     def prefix(self) -> str:
-        return f":{self.nickname}!{self.username}@{config.HOSTNAME}"
+        if self._prefix is None:
+            self._prefix = f":{self._nickname}!{self._username}@{self._host}"
+        return self._prefix
@@ -0,0 +1,274 @@
+"""Runs the server as several worker processes sharing one port.
+
+Every worker is a normal Server bound with SO_REUSEPORT, so the kernel spreads new connections
+between them. The workers are connected to a hub in the parent process over a Unix socket.
+The hub owns the nickname registry and channel membership of the whole cluster, relays state
+changes to every worker and channel messages only to the workers which have members in the
+channel.
+
+Usage: python cluster.py [--workers N] [--host HOST] [--port PORT]
+"""
+import argparse
+import multiprocessing
+import os
+import selectors
+import signal
+import sys
+import tempfile
+from socket import AF_UNIX, SOCK_STREAM, socket
+from typing import Callable
+
+import config
+import log
+import profiler
+import tls
+from client import Client
+from framing import LineBuffer
+from ircmessage import IRCMessage
+from link import LINK_MAX_LINE, Link
+from registry import fold
+from server import Server
+
+
+class WorkerConnection(Client):
+    """Connection from the hub to a worker. Reuses the buffered, non-blocking writes of Client"""
+    # A worker can fall behind during a burst, it should not be disconnected like a slow user
+    __slots__ = ()
+    sendq_max = 64 * 1024 * 1024
+
+    def __init__(self, conn: socket, on_sendq: Callable[[Client], None]) -> None:
+        super().__init__(conn, on_sendq)
+        self.inbuf = LineBuffer(64 * 1024, LINK_MAX_LINE)
+
+
+class HubUser:
+    prefix: str
+    server: str
+    realname: str
+    worker: WorkerConnection
+    channels: set[str]
+
+    def __init__(self, prefix: str, server: str, realname: str, worker: WorkerConnection) -> None:
+        self.prefix = prefix
+        self.server = server
+        self.realname = realname
+        self.worker = worker
+        self.channels = set()
+
+
+class Hub:
+    """Keeps the state shared by the workers and relays lines between them"""
+    listener: socket
+    selector: selectors.BaseSelector
+    workers: dict[int, WorkerConnection]  # {fd: worker}
+    nicknames: dict[str, WorkerConnection]  # every claimed nickname and the worker it was claimed by
+    users: dict[str, HubUser]  # registered users
+    interest: dict[str, dict[WorkerConnection, int]]  # {channel: {worker: members on that worker}}
+    pending_workers: set[WorkerConnection]
+
+    def __init__(self, path: str) -> None:
+        self.listener = socket(AF_UNIX, SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.workers = {}
+        self.nicknames = {}
+        self.users = {}
+        self.interest = {}
+        self.pending_workers = set()
+
+    def run(self) -> None:
+        while True:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.accept_worker()
+                    continue
+
+                worker = self.workers.get(key.fd)
+                if worker is None:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    worker.flush()
+                    if not worker.sendq:
+                        self.selector.modify(worker.conn, selectors.EVENT_READ)
+                if mask & selectors.EVENT_READ:
+                    self.read_worker(worker)
+
+            while self.pending_workers:
+                worker = self.pending_workers.pop()
+                if worker.closed:
+                    continue
+                if worker.quit_reason is not None:
+                    self.remove_worker(worker)
+                elif worker.sendq:
+                    self.selector.modify(worker.conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def accept_worker(self) -> None:
+        conn, _ = self.listener.accept()
+        conn.setblocking(False)
+        worker = WorkerConnection(conn, self.pending_workers.add)
+        self.workers[conn.fileno()] = worker
+        self.selector.register(conn, selectors.EVENT_READ)
+
+        # Bring the new worker up to date
+        for user in self.users.values():
+            worker.send(f"{user.prefix} INTRO {user.server} :{user.realname}")
+            for channel in user.channels:
+                worker.send(f"{user.prefix} JOIN {channel}")
+
+    def remove_worker(self, worker: WorkerConnection) -> None:
+        print(f"[HUB] Lost worker {worker.conn}")
+        del self.workers[worker.conn.fileno()]
+        self.selector.unregister(worker.conn)
+        worker.close()
+
+        for nickname, user in list(self.users.items()):
+            if user.worker is worker:
+                self.handle_line(worker, f"{user.prefix} QUIT :*.net *.split")
+        for nickname, owner in list(self.nicknames.items()):
+            if owner is worker:
+                del self.nicknames[nickname]
+
+    def read_worker(self, worker: WorkerConnection) -> None:
+        try:
+            received = worker.inbuf.recv_from(worker.conn)
+        except OSError:
+            received = 0
+        if received == 0:
+            self.remove_worker(worker)
+            return
+
+        for line in worker.inbuf.lines():
+            self.handle_line(worker, line)
+
+    def relay(self, origin: WorkerConnection, line: str) -> None:
+        """Sends a line to every worker except the one it came from"""
+        data = (line + "\r\n").encode("UTF-8")
+        for worker in self.workers.values():
+            if worker is not origin:
+                worker.write(data)
+
+    def handle_line(self, worker: WorkerConnection, line: str) -> None:
+        log.debug("[HUB] %s", line)
+        if line.startswith("CLAIM "):
+            _, nickname, old_nickname = line.split(" ")
+            owner = self.nicknames.setdefault(nickname, worker)
+            if owner is worker:
+                if old_nickname != nickname and self.nicknames.get(old_nickname) is worker:
+                    del self.nicknames[old_nickname]
+                worker.send(f"CLAIMED {nickname} 1")
+            else:
+                worker.send(f"CLAIMED {nickname} 0")
+            return
+        if line.startswith("RELEASE "):
+            nickname = line[len("RELEASE "):]
+            if self.nicknames.get(nickname) is worker:
+                del self.nicknames[nickname]
+            return
+        if line.startswith("TO "):
+            owner = self.nicknames.get(line.split(" ", 2)[1])
+            if owner is not None:
+                owner.send(line)
+            return
+
+        msg = IRCMessage.parse(line)
+        if msg is None or msg.prefix is None or not msg.params:
+            return
+        nickname, _, userhost = msg.prefix.partition("!")
+        user = self.users.get(nickname)
+        if user is None and msg.command != "INTRO":
+            return
+
+        match msg.command:
+            case "INTRO":
+                self.users[nickname] = HubUser(f":{msg.prefix}", msg.params[0], msg.params[-1], worker)
+            case "JOIN":
+                user.channels.add(msg.params[0])
+                members = self.interest.setdefault(msg.params[0], {})
+                members[worker] = members.get(worker, 0) + 1
+            case "PART":
+                self.leave(user, msg.params[0])
+            case "QUIT":
+                for channel in list(user.channels):
+                    self.leave(user, channel)
+                del self.users[nickname]
+                # Nicknames are claimed by their folded key
+                if self.nicknames.get(fold(nickname)) is user.worker:
+                    del self.nicknames[fold(nickname)]
+            case "NICK":
+                del self.users[nickname]
+                self.users[msg.params[0]] = user
+                user.prefix = f":{msg.params[0]}!{userhost}"
+            case "PRIVMSG":
+                # Only the workers with members in the channel need channel messages
+                data = (line + "\r\n").encode("UTF-8")
+                for member_worker in self.interest.get(msg.params[0], ()):
+                    if member_worker is not worker:
+                        member_worker.write(data)
+                return
+
+        self.relay(worker, line)
+
+    def leave(self, user: HubUser, channel: str) -> None:
+        if channel not in user.channels:
+            return
+        user.channels.remove(channel)
+        members = self.interest[channel]
+        members[user.worker] -= 1
+        if members[user.worker] == 0:
+            del members[user.worker]
+            if not members:
+                del self.interest[channel]
+
+
+def run_worker(hub_path: str, host: str, port: int, ipv6: bool, flood_control: bool) -> None:
+    # Workers are spawned, they do not inherit configuration changed at runtime
+    config.FLOOD_CONTROL = flood_control
+    # Every worker would append to the same journal
+    config.CHANNEL_STORE = None
+    # Every worker is profiled on its own, kill -USR1 <worker pid>
+    profiler.install_signals()
+    server = Server()
+    server.bind(host, port, ipv6, reuse_port=True)
+    if config.TLS_CERT is not None:
+        server.bind_tls(tls.create_context(config.TLS_CERT, config.TLS_KEY), host, config.TLS_PORT, ipv6, reuse_port=True)
+    server.attach_link(Link(hub_path, server))
+    server.run()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Runs the IRC server as several worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--no-flood-control", action="store_true", help="for benchmarks which pipeline commands")
+    args = parser.parse_args()
+
+    hub_path = os.path.join(tempfile.mkdtemp(), "hub.sock")
+    hub = Hub(hub_path)
+
+    context = multiprocessing.get_context("spawn")
+    flood_control = config.FLOOD_CONTROL and not args.no_flood_control
+    workers = [context.Process(target=run_worker, args=(hub_path, args.host, args.port, ":" in args.host, flood_control),
+                               daemon=True)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    print(f"[CLUSTER] Started {args.workers} workers on port {args.port}")
+    # Make sure the workers are stopped with the hub
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        print("[CLUSTER] KeyboardInterrupt received. Quitting...")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        os.unlink(hub_path)
+        os.rmdir(os.path.dirname(hub_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,3 +3,57 @@ PORT = 6667
 HOSTNAME = "Group12Serv"
 VER = "0.0.1"
 DEBUG = False
+NICKLEN = 9
+WHO_MAX_REPLIES = 200  # WHO <mask> replies a user gets before ERR_TOOMANYMATCHES, operators are limited by SENDQ_MAX
+STREAM_BATCH = 1000  # channels of a LIST, or members of a WHO #channel, looked at per batch of replies
+ENGINE = "selectors"  # "selectors" or "asyncio"
+PING_INTERVAL = 60  # seconds of silence before a client is sent a PING
+PING_TIMEOUT = 15  # seconds a client has to answer a PING
+REGISTRATION_TIMEOUT = 30  # seconds a connection has to complete NICK/USER
+MOTD_FILE = "motd.txt"  # relative to the server directory
+SENDQ_MAX = 512 * 1024  # bytes queued for a client before it is disconnected with "SendQ exceeded"
+CORK_OUTPUT = True  # selectors engine: hold writes until the end of the loop tick, then one sendmsg per client
+
+# Flood control. Every command costs tokens, a client which runs out is not read from until it has enough again
+FLOOD_CONTROL = True
+FLOOD_RATE = 4.0  # tokens a client gets per second
+FLOOD_BURST = 20.0  # tokens a client can save up
+COMMAND_COST = 1.0  # cost of the commands missing from COMMAND_COSTS
+COMMAND_COSTS = {"PING": 0.25, "PONG": 0.25, "JOIN": 3.0, "NAMES": 5.0, "WHO": 5.0, "LIST": 10.0, "STATS": 5.0}
+FLOOD_MAX_DEFERRALS = 100  # times a client may run out without ever filling up again before "Excess Flood"
+FANOUT_RATE = 64 * 1024 * 1024  # bytes per second all channel broadcasts together may queue
+FANOUT_COMMANDS = {"PRIVMSG", "JOIN", "PART", "NICK", "TOPIC"}  # deferred while the fan-out budget is exhausted
+
+# TLS listener, started by server.py when a certificate is configured
+TLS_PORT = 6697
+TLS_CERT = None  # path of a PEM certificate chain, None disables TLS
+TLS_KEY = None  # path of the PEM private key, None if it is in TLS_CERT
+TLS_HANDSHAKE_TIMEOUT = 10  # seconds a client has to complete the handshake
+TLS_MAX_HANDSHAKES = 1000  # handshakes in progress before new TLS connections are refused
+TLS_THREADS = 4  # run the steps of TLS handshakes, the crypto, off the loop. 0 runs them on the loop
+
+# Blocking work (DNS lookups) runs on a thread pool, see offload.py
+OFFLOAD_THREADS = 4  # 0 runs it on the event loop, only useful to compare against in benchmarks
+OFFLOAD_MAX_PENDING = 256  # jobs queued or running before lookups are skipped
+RESOLVE_HOSTS = True  # look up the hostname of every client, registration waits for the lookup
+
+RESTART_TIMEOUT = 10  # seconds a hot restart waits for the new process to take over, see restart.py
+
+# Links to other servers of the network, see peer.py. Only the selectors engine links
+LINK_PORT = None  # port server.py accepts links from other servers on, None to accept none
+LINK_PASSWORD = None  # shared by every server of the network, sent in the clear. None disables linking
+LINKS = []  # [(host, port)] of the servers server.py links to at startup
+LINK_CONNECT_TIMEOUT = 10  # seconds to connect to another server
+
+# Channel topics kept across restarts, see store.py. Cluster workers keep them in memory only
+CHANNEL_STORE = None  # directory of the journal and snapshot, relative to the server directory. None disables it
+STORE_FLUSH_INTERVAL = 0.05  # seconds changes are collected for before they are written and fsynced at once
+STORE_COMPACT_BYTES = 4 * 1024 * 1024  # journal size at which it is merged into the snapshot
+
+# Instrumentation, see metrics.py
+METRICS_ADDR = ("127.0.0.1", 9667)  # (address, port) server.py serves /metrics on in Prometheus format, None to disable
+OPERATORS = {}  # {name: password} accepted by OPER, operators may use STATS and PROFILE
+PROFILE_SECONDS = 10  # length of the window opened by SIGUSR1 or a PROFILE without a length, see profiler.py
+PROFILE_INTERVAL = 0.005  # seconds of CPU time between two stack samples
+PROFILE_TOP = 20  # rows of the tables written when a window closes
+PROFILE_DIR = "profiles"  # relative to the server directory
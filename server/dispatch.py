@@ -0,0 +1,864 @@
+import hmac
+import math
+import os
+import re
+import traceback
+from socket import socket
+from time import monotonic, perf_counter_ns, time
+from typing import Callable, Iterable, Iterator
+
+import config
+import log
+import metrics
+import profiler
+from channel import Channel, ChannelSizes, broadcast_to_peers, leave_all
+from client import MODE_INVISIBLE, MODE_WALLOPS, Client
+from flood import TokenBucket
+from framing import MAX_LINE
+from ircmessage import IRCMessage
+from link import Link
+from listing import Listing, Stream, plain_names
+from message import Message
+from offload import Offloader, lookup_host
+from peer import Peer, open_link
+from registry import Registry, compile_mask, fold, literal_prefix
+from store import ChannelStore
+from timers import TimerWheel
+
+RE_NICKNAME = re.compile(r"[A-Za-z][A-Za-z\d\[\]\\\`\_\^\{\|\}]{0,8}")
+
+
+class Dispatcher:
+    """IRC state and command handlers shared by every server engine.
+
+    Engines only deal with the transport: they accept connections, feed received lines
+    to handle_lines and close connections in close_connection."""
+    name: str  # [1..64]
+    channels: dict[str, Channel]  # {folded channel name: Channel}, channels are named in folded form
+    channel_sizes: ChannelSizes  # the same channels by number of users, for LIST
+    streams: dict[Client, Stream]  # replies not sent completely yet (LIST, WHO #channel), continued as their clients read them
+    clients: Registry[Client]  # {folded nickname: Client}, indexed for WHO masks
+    unauthenticated_clients: set[Client]
+    pending_clients: set[Client]  # clients whose send queue changed or which have to be disconnected
+    sendq_evictions: int  # clients disconnected with "SendQ exceeded"
+    write_errors: int  # clients disconnected because writing to them failed
+    flood_deferrals: int  # messages held back because the client ran out of tokens
+    fanout_deferrals: int  # messages held back because broadcasts used up the fan-out budget
+    flood_kills: int  # clients disconnected with "Excess Flood"
+    fanout: TokenBucket  # bytes per second all channel broadcasts together may queue
+    link: Link | None  # relay to the other servers of a cluster, see cluster.py
+    peers: dict[str, Peer]  # {name: linked server}, see peer.py
+    pending_peers: set[Peer]  # links whose send queue changed or which failed
+    handlers: dict[str, tuple[Callable[[Client, IRCMessage], None], bool]]  # {command: (handler, needs registration)}
+    timers: TimerWheel[Client]  # one liveness timer per local client
+    started: float  # wall clock time the server was created at, for STATS u
+    offloader: Offloader  # runs blocking work off the loop, engines watch offloader.wakeup
+    store: ChannelStore | None  # persisted channel state, read when a channel is created
+
+    def __init__(self, name: str = "SERVER") -> None:
+        self.name = name
+        self.channels = {}
+        self.channel_sizes = ChannelSizes()
+        self.streams = {}
+        self.clients = Registry()
+        self.unauthenticated_clients = set()
+        self.pending_clients = set()
+        self.sendq_evictions = 0
+        self.write_errors = 0
+        self.flood_deferrals = 0
+        self.fanout_deferrals = 0
+        self.flood_kills = 0
+        self.fanout = TokenBucket(config.FANOUT_RATE, config.FANOUT_RATE)
+        if config.FLOOD_CONTROL:
+            Channel.fanout = self.fanout
+        self.link = None
+        self.peers = {}
+        self.pending_peers = set()
+        self.timers = TimerWheel(monotonic())
+        self.started = time()
+        self.offloader = Offloader(config.OFFLOAD_THREADS, config.OFFLOAD_MAX_PENDING)
+        self.store = None
+        if config.CHANNEL_STORE is not None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.CHANNEL_STORE)
+            self.store = ChannelStore(directory, config.STORE_FLUSH_INTERVAL, config.STORE_COMPACT_BYTES)
+        Message.compile()
+        self.handlers = {
+            "NICK": (self.cmd_NICK, False),
+            "USER": (self.cmd_USER, False),
+            "PING": (self.cmd_PING, False),
+            "PONG": (self.cmd_PONG, False),
+            "CAP": (self.cmd_CAP, False),
+            "QUIT": (self.cmd_QUIT, False),
+            "JOIN": (self.cmd_JOIN, True),
+            "PART": (self.cmd_PART, True),
+            "TOPIC": (self.cmd_TOPIC, True),
+            "MOTD": (self.cmd_MOTD, True),
+            "NAMES": (self.cmd_NAMES, True),
+            "WHO": (self.cmd_WHO, True),
+            "LIST": (self.cmd_LIST, True),
+            "PRIVMSG": (self.cmd_PRIVMSG, True),
+            "OPER": (self.cmd_OPER, True),
+            "STATS": (self.cmd_STATS, True),
+            "PROFILE": (self.cmd_PROFILE, True),
+            "RESTART": (self.cmd_RESTART, True),
+            "CONNECT": (self.cmd_CONNECT, True),
+        }
+        self.register_metrics()
+
+    def register_metrics(self) -> None:
+        """Exposes the state and counters of the server, they are read whenever the metrics are rendered"""
+        metrics.Value("irc_clients", "Registered users, remote ones included", lambda: len(self.clients))
+        metrics.Value("irc_unregistered_clients", "Connections which have not completed NICK/USER",
+                      lambda: len(self.unauthenticated_clients))
+        metrics.Value("irc_channels", "Channels", lambda: len(self.channels))
+        metrics.Value("irc_offload_pending", "Jobs queued or running on the offload threads", lambda: self.offloader.pending)
+        metrics.Value("irc_sendq_evictions_total", "Clients disconnected with \"SendQ exceeded\"",
+                      lambda: self.sendq_evictions, "counter")
+        metrics.Value("irc_write_errors_total", "Clients disconnected because writing to them failed",
+                      lambda: self.write_errors, "counter")
+        metrics.Value("irc_flood_deferrals_total", "Messages held back by per client flood control",
+                      lambda: self.flood_deferrals, "counter")
+        metrics.Value("irc_fanout_deferrals_total", "Messages held back by the fan-out budget",
+                      lambda: self.fanout_deferrals, "counter")
+        metrics.Value("irc_flood_kills_total", "Clients disconnected with \"Excess Flood\"",
+                      lambda: self.flood_kills, "counter")
+        metrics.Value("irc_servers", "Servers of the network, this one included", self.server_count)
+
+    def sendq_changed(self, client: Client) -> None:
+        """Passed to every Client as on_sendq"""
+        self.pending_clients.add(client)
+
+    def process_pending(self) -> None:
+        """Disconnects clients which failed while being written to and lets the engine wait for writability of the rest.
+        Must be called between handlers, never in the middle of a fan-out"""
+        while self.pending_clients:
+            client = self.pending_clients.pop()
+            if client.closed:
+                continue
+
+            if client.quit_reason is not None:
+                if client.quit_reason == "SendQ exceeded":
+                    self.sendq_evictions += 1
+                else:
+                    self.write_errors += 1
+                log.debug("[CLIENT] Disconnecting %s: %s", client.nickname, client.quit_reason)
+                self.quit_client(client, client.quit_reason)
+            elif client.sendq or client in self.streams:
+                self.want_write(client)
+
+        while self.pending_peers:
+            peer = self.pending_peers.pop()
+            if peer.closed:
+                continue
+            if peer.writer.corked:
+                peer.writer.flush()
+            if peer.writer.quit_reason is not None:
+                self.split(peer, peer.writer.quit_reason)
+            else:
+                self.watch_peer(peer)
+
+    def want_write(self, client: Client) -> None:
+        """Called when a client has queued data. Engines which flush the queue themselves should override this"""
+
+    def input_ready(self, client: Client) -> None:
+        """Called when the hostname lookup of a client is done. Engines must not read from a client while
+        client.resolving is set, so that it registers with its final host"""
+
+    def request_restart(self) -> bool:
+        """Asks for a hot restart once the current loop iteration is done. Returns False if the engine can not
+        hand its connections over, engines which can should override this"""
+        return False
+
+    def pause(self, client: Client) -> None:
+        """Called when a message of the client was deferred. The engine must stop reading from it and call resume
+        once client.resume_at has passed"""
+
+    def link_lost(self) -> None:
+        """Continues without the rest of the cluster. Engines which watch the link should override this"""
+        if self.link is not None:
+            self.link.close()
+            self.link = None
+
+    def propagate(self, line: str, origin: Peer | None = None) -> None:
+        """Relays a state change of a local user to the rest of the cluster, or a change learnt from a linked
+        server (origin) to the other ones"""
+        if self.link is not None:
+            self.link.send_line(line)
+        if self.peers:
+            data = (line + "\r\n").encode("UTF-8")
+            for peer in self.peers.values():
+                if peer is not origin:
+                    peer.send_raw(data)
+
+    def propagate_channel(self, key: str, line: str, origin: Peer | None = None) -> None:
+        """Relays a channel message, only to the linked servers with members of the channel behind them.
+        The cluster hub does the same for its workers"""
+        if self.link is not None:
+            self.link.send_line(line)
+        data = None
+        for peer in self.peers.values():
+            if peer is not origin and key in peer.interest:
+                if data is None:
+                    data = (line + "\r\n").encode("UTF-8")
+                peer.send_raw(data)
+
+    def server_count(self) -> int:
+        return 1 + sum(len(peer.servers) for peer in self.peers.values())
+
+    def connect_peer(self, host: str, port: int) -> bool:
+        """Links to another server, the connection is made on an offload thread. Returns False if linking is disabled"""
+        if config.LINK_PASSWORD is None:
+            return False
+        print(f"[PEER] Connecting to {host}:{port}")
+        self.offloader.submit(open_link, (host, port),
+                              lambda conn: self.attach_peer(conn, True) if conn is not None else None)
+        return True
+
+    def attach_peer(self, conn: socket, outgoing: bool) -> None:
+        """Starts a link over a connected socket. Engines which can watch links should override this"""
+        print("[PEER] This engine can not link to other servers")
+        conn.close()
+
+    def watch_peer(self, peer: Peer) -> None:
+        """Called when the send queue of a link changed. Engines wait for writability while it has queued data"""
+
+    def detach_peer(self, peer: Peer) -> None:
+        """Stops watching a link which is about to be closed"""
+
+    def peer_linked(self, peer: Peer) -> None:
+        """The other side of a link has introduced itself"""
+        assert peer.name is not None
+        print(f"[PEER] Linked to {peer.name}")
+        self.peers[peer.name] = peer
+        peer.burst()
+        self.propagate(f"S {peer.name} {config.HOSTNAME}", peer)
+
+    def split(self, peer: Peer, reason: str) -> None:
+        """Drops a link, the servers behind it and their users"""
+        if peer.closed:
+            return
+        if peer.name is not None and self.peers.get(peer.name) is peer:
+            print(f"[PEER] Lost {peer.name}: {reason}")
+            del self.peers[peer.name]
+            self.propagate(f"SQUIT {peer.name} :{config.HOSTNAME} {peer.name}", peer)
+        self.detach_peer(peer)
+        peer.close()
+
+    def add_client(self, client: Client, address: str | None = None) -> None:
+        """Starts tracking a newly accepted connection, and looks up the hostname of its address if there is one"""
+        self.unauthenticated_clients.add(client)
+        self.timers.schedule(client.connected_at + min(config.REGISTRATION_TIMEOUT, config.PING_INTERVAL), client)
+        if address is not None and config.RESOLVE_HOSTS:
+            # Set first, without offload threads the lookup completes inside submit
+            client.resolving = True
+            if not self.offloader.submit(lookup_host, (address,), lambda host: self.host_resolved(client, host)):
+                client.resolving = False
+
+    def host_resolved(self, client: Client, host: str | None) -> None:
+        client.resolving = False
+        if client.closed:
+            return
+        if host is not None:
+            client.host = host
+        self.input_ready(client)
+
+    def check_clients(self) -> None:
+        """Sends PING to and disconnects unresponsive clients. Only the clients whose timer has expired are looked at,
+        so this is cheap enough to run on every loop iteration"""
+        now = monotonic()
+        for client in self.timers.expire(now):
+            self.check_client(client, now)
+
+    def check_client(self, client: Client, now: float) -> None:
+        if client.closed:
+            return
+
+        deadline = client.deadline
+        if client in self.unauthenticated_clients:
+            registration_deadline = client.connected_at + config.REGISTRATION_TIMEOUT
+            if registration_deadline <= now:
+                self.quit_client(client, "Registration timed out")
+                return
+            deadline = min(deadline, registration_deadline)
+
+        if deadline > now:
+            # The client was active since the timer was scheduled
+            self.timers.schedule(deadline, client)
+        elif client.is_pinged:
+            # Client timed out
+            self.quit_client(client, "Timed out")
+        else:
+            client.send_with_prefix(Message.CMD_PING())
+            client.update_last_interaction()
+            client.is_pinged = True
+            self.timers.schedule(client.deadline, client)
+
+    def handle_lines(self, sender: Client, lines: Iterable[str]) -> None:
+        """Handles the complete lines received from a client"""
+        sender.update_last_interaction()
+        if sender in self.streams:
+            # Handled once the stream is done, see continue_stream
+            return
+
+        for line in lines:
+            msg = IRCMessage.parse(line)
+            if msg is not None:
+                # Unknown commands share a label, so that clients can not create series at will
+                command = msg.command if msg.command in self.handlers else "unknown"
+                metrics.messages_in.inc(command)
+                metrics.bytes_in.inc(command, len(line) + 2)
+                if not self.admit(sender, msg):
+                    # The rest of the lines stay in the buffer until the client is resumed
+                    break
+                self.handle_message(sender, msg)
+            if sender.closed:
+                # The client has quit, the rest of the chunk is meaningless
+                break
+            if sender in self.streams:
+                # The rest of the lines stay in the buffer until the stream is done
+                break
+
+    def admit(self, sender: Client, msg: IRCMessage) -> bool:
+        """Charges a message to the flood control of its sender. A message which can not be paid for yet
+        is deferred and the sender paused until it can"""
+        if not config.FLOOD_CONTROL:
+            return True
+
+        now = monotonic()
+        if msg.command in config.FANOUT_COMMANDS:
+            wait = self.fanout.take(0, now)
+            if wait > 0:
+                self.fanout_deferrals += 1
+                self.defer(sender, msg, now + wait)
+                return False
+
+        wait = sender.flood.take(config.COMMAND_COSTS.get(msg.command, config.COMMAND_COST), now)
+        if wait == 0:
+            return True
+        if sender.flood.deferrals > config.FLOOD_MAX_DEFERRALS:
+            # Never let up since it last had a full bucket
+            self.flood_kills += 1
+            self.quit_client(sender, "Excess Flood")
+            return False
+        self.flood_deferrals += 1
+        self.defer(sender, msg, now + wait)
+        return False
+
+    def defer(self, sender: Client, msg: IRCMessage, resume_at: float) -> None:
+        log.debug("[FLOOD] Deferring %s from %s until %.3f", msg.command, sender.nickname, resume_at)
+        sender.deferred = msg
+        sender.resume_at = resume_at
+        self.pause(sender)
+
+    def resume(self, client: Client) -> None:
+        """Handles the deferred message of a client and whatever it sent after it, unless it has to be deferred again"""
+        msg = client.deferred
+        client.deferred = None
+        if msg is None or client.closed:
+            return
+        if not self.admit(client, msg):
+            return
+        self.handle_message(client, msg)
+        if not client.closed:
+            self.handle_lines(client, client.inbuf.lines())
+
+    def handle_message(self, sender: Client, msg: IRCMessage) -> None:
+        """Main message handler"""
+        handler = self.handlers.get(msg.command)
+        if handler is None:
+            log.debug("[CMD][NOT_HANDLED] %r", msg)
+            # TODO: the docs say it should be returned to "a registered client". should check for auth?
+            sender.send_with_prefix(Message.ERR_UNKNOWNCOMMAND(sender, msg.command))
+            return
+
+        cmd, needs_registration = handler
+        if needs_registration and sender in self.unauthenticated_clients:
+            sender.send_with_prefix(Message.ERR_NOTREGISTERED(sender))
+            return
+        metrics.handler = msg.command
+        start = perf_counter_ns()
+        try:
+            if profiler.session is None:
+                cmd(sender, msg)
+            else:
+                profiler.session.call(cmd, sender, msg)
+        except Exception as e:
+            # A bug in one handler must not take the server and every other connection down with it
+            print(f"[CMD] {msg.command} from {sender.nickname} failed: {e!r}")
+            traceback.print_exc()
+        metrics.handler_seconds.observe((perf_counter_ns() - start) / 1e9, msg.command)
+        metrics.handler = "none"
+
+    def cmd_NICK(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        nickname = msg.params[0][:config.NICKLEN]
+        if RE_NICKNAME.fullmatch(nickname):
+            # Nicknames keep the case they were given in, but are unique regardless of it
+            key = fold(nickname)
+            owner = self.clients.get(key)
+            # Other servers of a cluster might be registering the same nickname right now, the hub decides who gets it
+            if (owner is not None and owner is not sender) or \
+                    (self.link is not None and not self.link.claim(key, sender.key)):
+                log.debug("[CMD][NICK] Tried to set a name that is already taken: %s", nickname)
+                sender.send_with_prefix(Message.ERR_NICKNAMEINUSE(sender, nickname))
+                return
+
+            # TODO: avoid greeting users who have already been greeted (which is those who are changing their name)
+            if owner is None and self.clients.get(sender.key) is sender:
+                del self.clients[sender.key]
+            if sender not in self.unauthenticated_clients:
+                nick_msg = f"{sender.prefix} NICK {nickname}"
+                broadcast_to_peers(sender, nick_msg, also=(sender,))
+                self.propagate(nick_msg)
+            sender.nickname = nickname
+            self.clients[key] = sender
+            log.debug("[CMD][NICK] SET VALID NAME \"%s\"", nickname)
+        else:
+            # TODO: verify that the regex above is correct and that this response is valid
+            log.debug("[CMD][NICK] Tried to set an invalid name: %s", nickname)
+            sender.send_with_prefix(Message.ERR_ERRONEUSNICKNAME(sender, nickname))
+
+        # TODO: store is_greeted
+        if sender.is_authenticated:
+            self.greet(sender)
+
+    def cmd_USER(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 4:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        # TODO: validation of all fields
+        sender.username = msg.params[0]
+
+        try:
+            sender.mode = int(msg.params[1]) & (MODE_WALLOPS | MODE_INVISIBLE)
+        except ValueError:
+            # TODO: handle invalid modes
+            sender.mode = 0
+
+        sender.realname = msg.params[3]
+
+        log.debug("[CMD][USER] SET USER \"%s\", w=%s, i=%s, %s", sender.username, bool(sender.mode & MODE_WALLOPS),
+                  bool(sender.mode & MODE_INVISIBLE), sender.realname)
+        if sender.is_authenticated:
+            self.greet(sender)
+
+    def greet(self, sender: Client) -> None:
+        """Sends the greeting and completes the registration of a client, shared by NICK and USER"""
+        greeting = Message.greeting(sender, len(self.clients), self.server_count())
+        metrics.output(len(greeting))
+        sender.write(greeting)
+        if sender in self.unauthenticated_clients:
+            self.unauthenticated_clients.remove(sender)
+            self.clients[sender.key] = sender
+            self.propagate(f"{sender.prefix} INTRO {config.HOSTNAME} :{sender.realname}")
+
+    def cmd_PING(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+        # TODO: this is a placeholder
+        sender.send_with_prefix(Message.CMD_PONG(msg.params[0]))
+
+    def cmd_PONG(self, sender: Client, msg: IRCMessage) -> None:
+        pass
+
+    def cmd_CAP(self, sender: Client, msg: IRCMessage) -> None:
+        pass
+
+    def cmd_MOTD(self, sender: Client, msg: IRCMessage) -> None:
+        motd = Message.motd(sender)
+        metrics.output(len(motd))
+        sender.write(motd)
+
+    def cmd_JOIN(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        # TODO: handle invalid channel names
+        channels = list(filter(lambda x: x != '', msg.params[0].split(',')))
+        for c in channels:
+            c = fold(c)
+            self.join_channel(sender, c)
+            channel = self.channels[c]
+            join_msg = Message.CMD_JOIN(sender, c)
+            channel.broadcast(join_msg)
+            self.propagate(join_msg)
+
+            if channel.topic != "":
+                sender.send_with_prefix(Message.RPL_TOPIC(sender, channel))
+            else:
+                sender.send_with_prefix(Message.RPL_NOTOPIC(sender, channel))
+
+            self.send_names(sender, channel)
+
+    def send_names(self, sender: Client, channel: Channel) -> None:
+        reply = [Message.RPL_NAMREPLY(sender, channel, names) for names in channel.names()]
+        reply.append(Message.RPL_ENDOFNAMES(sender, channel.name))
+        sender.send_iter_with_prefix(reply)
+
+    def cmd_NAMES(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            end = Message.RPL_ENDOFNAMES(sender, "*")
+            self.start_stream(sender, Stream(self.names_all(sender, end), end))
+            return
+
+        for c in msg.params[0].split(','):
+            channel = self.channels.get(fold(c))
+            if channel is not None:
+                self.send_names(sender, channel)
+            else:
+                sender.send_with_prefix(Message.RPL_ENDOFNAMES(sender, c))
+
+    def names_all(self, sender: Client, end: str) -> Iterator[str | None]:
+        """353 for every channel, then for the users on none who are not invisible, sent as a stream.
+        Channels and users which appear since the NAMES are not listed"""
+        for channel in list(self.channels.values()):
+            names = channel.names()
+            if not names:
+                yield None
+            for payload in names:
+                yield Message.RPL_NAMREPLY(sender, channel, payload)
+
+        budget = MAX_LINE - len("\r\n") - len(f":{config.HOSTNAME} 353 {'x' * config.NICKLEN} * * :")
+        payload = ""
+        for user in list(self.clients.values()):
+            if user.channels or user in self.unauthenticated_clients or self.clients.get(user.key) is not user or \
+                    (user.mode & MODE_INVISIBLE and user is not sender):
+                yield None
+            elif payload and len(payload) + 1 + len(user.nickname) > budget:
+                yield Message.RPL_NAMREPLY_NOCHANNEL(sender, payload)
+                payload = user.nickname
+            else:
+                payload = f"{payload} {user.nickname}" if payload else user.nickname
+        if payload:
+            yield Message.RPL_NAMREPLY_NOCHANNEL(sender, payload)
+        yield end
+
+    def join_channel(self, sender: Client, channel: str) -> None:
+        """Add user to a channel with given name, which has to be folded already"""
+        if channel not in self.channels:
+            # TODO: validate channel name
+            topic = self.store.get(channel).get("topic", "") if self.store is not None else ""
+            self.channels[channel] = Channel(channel, self.channel_sizes, topic)
+        self.channels[channel].add_user(sender)
+
+    def cmd_PART(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        channels = msg.params[0].split(',')
+        message = msg.params[1] if len(msg.params) > 1 else ""
+
+        for c in channels:
+            channel = self.channels.get(fold(c))
+            if channel is not None:
+                if sender in channel.users:
+                    part_msg = f"{sender.prefix} PART {channel.name} :{message}"
+                    channel.broadcast(part_msg)
+                    self.propagate(part_msg)
+                    channel.remove_user(sender)
+                else:
+                    # TODO: return ERR_NOTONCHANNEL
+                    pass
+            else:
+                # TODO: return ERR_NOSUCHCHANNEL
+                pass
+
+        log.debug("[CMD][PART] %s is leaving channels %s with message=%r", sender.username, msg.params[0], message)
+
+    def cmd_TOPIC(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        channel = self.channels.get(fold(msg.params[0]))
+        if channel is None:
+            sender.send_with_prefix(Message.ERR_NOSUCHCHANNEL(sender, msg.params[0]))
+            return
+        if len(msg.params) < 2:
+            if channel.topic != "":
+                sender.send_with_prefix(Message.RPL_TOPIC(sender, channel))
+            else:
+                sender.send_with_prefix(Message.RPL_NOTOPIC(sender, channel))
+            return
+        if sender not in channel.users:
+            sender.send_with_prefix(Message.ERR_NOTONCHANNEL(sender, channel))
+            return
+
+        # A bare CR ends the line for most clients, only CR LF is stripped by LineBuffer
+        self.set_topic(channel, msg.params[1].replace("\r", ""))
+        topic_msg = f"{sender.prefix} TOPIC {channel.name} :{channel.topic}"
+        channel.broadcast(topic_msg)
+        self.propagate(topic_msg)
+
+    def set_topic(self, channel: Channel, topic: str) -> None:
+        channel.topic = topic
+        if self.store is not None:
+            self.store.set(channel.name, "topic", topic)
+
+    def cmd_QUIT(self, sender: Client, msg: IRCMessage) -> None:
+        self.quit_client(sender, msg.params[0] if msg.params else "")
+
+    def quit_client(self, sender: Client, message: str) -> None:
+        """Disconnects a client and tells everyone who shares a channel with it"""
+        log.debug("[CMD][QUIT] %s quit with message=%r", sender.username, message)
+
+        registered = sender not in self.unauthenticated_clients
+        self.remove_client(sender)
+        quit_msg = f"{sender.prefix} QUIT :{message}"
+        if registered:
+            self.propagate(quit_msg)
+        elif self.link is not None and sender.nickname != "*":
+            self.link.release(sender.key)
+        # Every peer gets the QUIT once, only the channels the user is on are touched
+        broadcast_to_peers(sender, quit_msg)
+        leave_all(sender)
+
+    def remove_client(self, client: Client) -> None:
+        """Remove user from the server"""
+        if self.clients.get(client.key) is client:
+            del self.clients[client.key]
+        self.unauthenticated_clients.discard(client)
+        self.streams.pop(client, None)
+
+        if not client.closed:
+            self.close_connection(client)
+
+    def close_connection(self, client: Client) -> None:
+        """Closes the transport of a client. Engines which track connections should override this"""
+        client.close()
+
+    def cmd_WHO(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 1:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        mask = msg.params[0]
+        if not mask:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+        operators_only = len(msg.params) > 1 and msg.params[1] == "o"
+        channel = self.channels.get(fold(mask))
+        if channel is not None:
+            end = Message.RPL_ENDOFWHO(sender, channel.name)
+            self.start_stream(sender, Stream(self.who_channel(sender, channel, operators_only, end), end))
+        elif mask[0] in "#&":
+            sender.send_with_prefix(Message.ERR_NOSUCHSERVER(sender, fold(mask)))
+        else:
+            self.who_mask(sender, mask, operators_only)
+
+    def who_channel(self, sender: Client, channel: Channel, operators_only: bool, end: str) -> Iterator[str | None]:
+        """352 for every member of a channel, sent as a stream. Members who left since the WHO are skipped,
+        ones who joined since are not listed"""
+        for user in list(channel.users):
+            if user in channel.users and (user.op or not operators_only):
+                yield Message.RPL_WHOREPLY(sender, user, channel)
+        yield end
+
+    def who_mask(self, sender: Client, mask: str, operators_only: bool) -> None:
+        """WHO for the users whose nickname matches a mask, or whose nick!user@host does if the mask has a ! or @.
+        Only the nicknames starting with the literal start of the mask are looked at. Users with mode +i are left
+        out unless they share a channel with the sender. Users get at most config.WHO_MAX_REPLIES replies,
+        operators as many as fit into their send queue"""
+        nickname, _, userhost = mask.partition("!")
+        if "@" in nickname:
+            nickname, userhost = "*", mask
+        username, _, host = userhost.rpartition("@") if "@" in userhost else (userhost, "", "")
+        nickname_match = compile_mask(nickname)
+        username_match = compile_mask(username) if username else None
+        host_match = compile_mask(host) if host else None
+
+        if sender.op:
+            budget = max(0, sender.sendq_max - sender.sendq_size) // 2
+            limit = budget // len(Message.RPL_WHOREPLY(sender, sender, None)) if budget else 0
+        else:
+            limit = config.WHO_MAX_REPLIES
+        reply = []
+        shared = None
+        for user in self.clients.prefixed(literal_prefix(nickname)):
+            if (nickname_match is not None and not nickname_match.fullmatch(user.key)) or \
+                    (username_match is not None and not username_match.fullmatch(fold(user.username))) or \
+                    (host_match is not None and not host_match.fullmatch(fold(user.host))) or \
+                    (operators_only and not user.op) or user in self.unauthenticated_clients:
+                continue
+            if user.mode & MODE_INVISIBLE and user is not sender:
+                if shared is None:
+                    shared = {member for channel in sender.channels for member in channel.users}
+                if user not in shared:
+                    continue
+            if len(reply) == limit:
+                reply.append(Message.ERR_TOOMANYMATCHES(sender, "WHO"))
+                break
+            reply.append(Message.RPL_WHOREPLY(sender, user, None))
+        reply.append(Message.RPL_ENDOFWHO(sender, mask))
+        sender.send_iter_with_prefix(reply)
+
+    def cmd_LIST(self, sender: Client, msg: IRCMessage) -> None:
+        filters = [item for item in msg.params[0].split(",") if item] if msg.params else []
+        if plain_names(filters):
+            reply = [Message.RPL_LISTSTART(sender)]
+            reply.extend(Message.RPL_LIST(sender, self.channels[name]) for name in map(fold, filters)
+                         if name in self.channels)
+            reply.append(Message.RPL_LISTEND(sender))
+            sender.send_iter_with_prefix(reply)
+            return
+
+        sender.send_with_prefix(Message.RPL_LISTSTART(sender))
+        end = Message.RPL_LISTEND(sender)
+        self.start_stream(sender, Stream(self.list_channels(sender, Listing(self.channel_sizes, filters), end), end))
+
+    def list_channels(self, sender: Client, listing: Listing, end: str) -> Iterator[str | None]:
+        """322 for every channel a LIST matches, sent as a stream"""
+        for channel in listing.channels:
+            yield Message.RPL_LIST(sender, channel) if listing.matches(channel) else None
+        yield end
+
+    def start_stream(self, sender: Client, stream: Stream) -> None:
+        """Sends the first batch of a stream of replies, the engine sends the rest as the client reads them.
+        Nothing else the client sent is handled until the stream is done, so that replies never interleave"""
+        self.streams[sender] = stream
+        if not self.send_batch(sender):
+            # The engine has to come back for the rest even if everything so far went out at once
+            self.pending_clients.add(sender)
+
+    def continue_stream(self, sender: Client) -> None:
+        """Sends the next batch of a stream. Engines call this whenever the client has read what it was sent,
+        once the stream is done the lines the client sent meanwhile are handled"""
+        if self.send_batch(sender):
+            self.handle_lines(sender, sender.inbuf.lines())
+
+    def send_batch(self, sender: Client) -> bool:
+        """Sends the replies of the next config.STREAM_BATCH entries of a stream, or fewer if they would fill more
+        than half of the free space in the send queue. Returns whether the stream is done"""
+        budget = max(0, sender.sendq_max - sender.sendq_size) // 2
+        reply = []
+        looked_at = 0
+        for line in self.streams[sender].replies:
+            looked_at += 1
+            if line is not None:
+                reply.append(line)
+                budget -= len(line)
+            if budget <= 0 or looked_at == config.STREAM_BATCH:
+                break
+        else:
+            del self.streams[sender]
+        if reply:
+            sender.send_iter_with_prefix(reply)
+        return sender not in self.streams
+
+    def cmd_PRIVMSG(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 2:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        target = fold(msg.params[0])
+        message = msg.params[1]
+
+        if target in self.clients:
+            target_client = self.clients[target]
+            log.debug("[CMD][PRIVMSG] Client %s PRIVMSG to %s message=%r", sender.nickname, target_client.nickname, message)
+            self.send_privmsg_line(sender, target_client, target_client.nickname, message)
+            return
+        elif target in self.channels:
+            # TODO: ERR_CANNOTSENDTOCHAN when not on channel
+            channel = self.channels[target]
+            log.debug("[CMD][PRIVMSG] Client %s PRIVMSG to channel %s message=%r", sender.nickname, channel.name, message)
+            privmsg = f"{sender.prefix} PRIVMSG {target} :{message}"
+            channel.broadcast(privmsg, exclude=sender)
+            self.propagate_channel(target, privmsg)
+        else:
+            # TODO: handle invalid target name
+            pass
+
+    def send_privmsg_line(self, sender: Client, target_client: Client, target_name: str, message: str) -> None:
+        # Write errors do not raise, the client is disconnected by process_pending afterwards
+        target_client.send(f"{sender.prefix} PRIVMSG {target_name} :{message}")
+
+    def cmd_OPER(self, sender: Client, msg: IRCMessage) -> None:
+        if len(msg.params) < 2:
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        password = config.OPERATORS.get(msg.params[0])
+        if password is None or not hmac.compare_digest(password.encode("UTF-8"), msg.params[1].encode("UTF-8")):
+            sender.send_with_prefix(Message.ERR_PASSWDMISMATCH(sender))
+            return
+        log.debug("[CMD][OPER] Client %s is now an operator as %s", sender.nickname, msg.params[0])
+        sender.op = True
+        sender.send_with_prefix(Message.RPL_YOUREOPER(sender))
+
+    def cmd_STATS(self, sender: Client, msg: IRCMessage) -> None:
+        if not sender.op:
+            sender.send_with_prefix(Message.ERR_NOPRIVILEGES(sender))
+            return
+
+        query = msg.params[0][:1] if msg.params else ""
+        reply = []
+        if query == "m":
+            for command, count in sorted(metrics.messages_in.values.items()):
+                reply.append(Message.RPL_STATSCOMMANDS(sender, command, count, metrics.bytes_in.values[command]))
+        elif query == "u":
+            reply.append(Message.RPL_STATSUPTIME(sender, int(time() - self.started)))
+        elif query == "P":
+            # Same text as the HTTP endpoint, for servers which do not run it
+            reply.extend(f"NOTICE {sender.nickname} :{line}" for line in metrics.render().splitlines() if line[0] != "#")
+        reply.append(Message.RPL_ENDOFSTATS(sender, query or "*"))
+        sender.send_iter_with_prefix(reply)
+
+    def cmd_PROFILE(self, sender: Client, msg: IRCMessage) -> None:
+        """PROFILE [seconds] opens a profiling window, PROFILE STOP closes it early. The results are sent when it closes"""
+        if not sender.op:
+            sender.send_with_prefix(Message.ERR_NOPRIVILEGES(sender))
+            return
+
+        if msg.params and msg.params[0].upper() == "STOP":
+            profiler.end_early()
+            return
+
+        try:
+            seconds = float(msg.params[0]) if msg.params else 0.0
+        except ValueError:
+            seconds = 0.0
+        if not math.isfinite(seconds) or seconds < 0:
+            # nan and inf parse as floats, but the window would never close
+            seconds = 0.0
+
+        def report(lines: list[str]) -> None:
+            if not sender.closed:
+                sender.send_iter_with_prefix(f"NOTICE {sender.nickname} :{line}" for line in lines)
+
+        if profiler.start(seconds, report):
+            sender.send_with_prefix(f"NOTICE {sender.nickname} :Profiling for {seconds or config.PROFILE_SECONDS}s")
+        else:
+            sender.send_with_prefix(f"NOTICE {sender.nickname} :A profile is already running")
+
+    def cmd_CONNECT(self, sender: Client, msg: IRCMessage) -> None:
+        """CONNECT <host> <port> links to another server"""
+        if not sender.op:
+            sender.send_with_prefix(Message.ERR_NOPRIVILEGES(sender))
+            return
+        if len(msg.params) < 2 or not msg.params[1].isdigit():
+            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg.command))
+            return
+
+        if self.connect_peer(msg.params[0], int(msg.params[1])):
+            sender.send_with_prefix(f"NOTICE {sender.nickname} :Connecting to {msg.params[0]}:{msg.params[1]}")
+        else:
+            sender.send_with_prefix(f"NOTICE {sender.nickname} :Linking is disabled, there is no LINK_PASSWORD")
+
+    def cmd_RESTART(self, sender: Client, msg: IRCMessage) -> None:
+        """Hot restart, the connections are handed over to a new process, see restart.py"""
+        if not sender.op:
+            sender.send_with_prefix(Message.ERR_NOPRIVILEGES(sender))
+            return
+
+        if self.request_restart():
+            sender.send_with_prefix(f"NOTICE {sender.nickname} :Restarting")
+        else:
+            sender.send_with_prefix(f"NOTICE {sender.nickname} :This server can not restart without disconnecting")
@@ -0,0 +1,41 @@
+from time import monotonic
+
+
+class TokenBucket:
+    """Allows rate units per second on average and bursts of up to burst units.
+
+    Used per client for the cost of its commands, see Dispatcher.admit, and once per server
+    for the bytes queued by channel broadcasts."""
+    __slots__ = ("rate", "burst", "tokens", "updated", "deferrals")
+    rate: float
+    burst: float
+    tokens: float  # negative while a charge() has not been paid off yet
+    updated: float  # monotonic time of the last refill
+    deferrals: int  # times take() failed since the bucket was last full
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.deferrals = 0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens == self.burst:
+            self.deferrals = 0
+
+    def take(self, cost: float, now: float) -> float:
+        """Takes cost units if there are enough of them and returns 0. Otherwise nothing is taken
+        and the number of seconds until there will be enough is returned"""
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        self.deferrals += 1
+        return (cost - self.tokens) / self.rate
+
+    def charge(self, amount: float) -> None:
+        """Takes units which have already been spent, the bucket may go into debt"""
+        self.tokens -= amount
@@ -0,0 +1,91 @@
+from socket import socket
+from typing import Iterator
+
+MAX_LINE = 512  # RFC 1459 line limit, including the trailing CR-LF
+
+
+class LineBuffer:
+    """Receive buffer of a single connection which splits the incoming byte stream into lines.
+
+    Data is received straight into a preallocated bytearray, lines are found in place and
+    each complete line is decoded exactly once. A line split over several reads is kept
+    until the rest of it arrives. Lines longer than max_line are truncated."""
+    __slots__ = ("buffer", "view", "start", "end", "discarding", "max_line")
+    buffer: bytearray
+    view: memoryview
+    start: int  # start of the first line which has not been returned yet
+    end: int  # end of the received data
+    discarding: bool  # the current line was too long and is skipped until its end
+    max_line: int
+
+    def __init__(self, size: int = 4 * MAX_LINE, max_line: int = MAX_LINE) -> None:
+        self.buffer = bytearray(size)
+        self.max_line = max_line
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.discarding = False
+
+    @property
+    def free(self) -> int:
+        """Number of bytes which can be received without overwriting unprocessed data"""
+        self.compact()
+        return len(self.buffer) - self.end
+
+    def compact(self) -> None:
+        """Moves unprocessed data to the front of the buffer"""
+        if self.start == 0:
+            return
+        remaining = self.end - self.start
+        # Only the unfinished tail is copied, which is less than a line
+        self.buffer[:remaining] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = remaining
+
+    def recv_from(self, conn: socket) -> int:
+        """Receives as much as fits into the buffer. Returns the number of bytes received, 0 means EOF.
+        Returns -1 without reading if the buffer is full because lines() was not run to completion"""
+        free = self.free
+        if free == 0:
+            return -1
+        received = conn.recv_into(self.view[self.end:], free)
+        self.end += received
+        return received
+
+    def feed(self, data: bytes) -> None:
+        """Appends data received by other means. It must not be longer than free"""
+        self.compact()
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def lines(self) -> Iterator[str]:
+        """Yields every complete line without the line terminator. Accepts both '\\r\\n' and '\\n'"""
+        buffer = self.buffer
+        while True:
+            newline = buffer.find(b"\n", self.start, self.end)
+            if newline == -1:
+                if self.discarding:
+                    self.start = self.end
+                elif self.end - self.start >= self.max_line:
+                    # Keep the start of an overlong line and skip the rest of it
+                    line = str(self.view[self.start:self.start + self.max_line - 2], "UTF-8", "replace")
+                    self.start = self.end
+                    self.discarding = True
+                    yield line
+                break
+
+            start = self.start
+            self.start = newline + 1
+            if self.discarding:
+                self.discarding = False
+                continue
+
+            line_end = newline
+            if line_end > start and buffer[line_end - 1] == 13:  # '\r'
+                line_end -= 1
+            line_end = min(line_end, start + self.max_line - 2)
+            if line_end > start:
+                yield str(self.view[start:line_end], "UTF-8", "replace")
+
+        if self.start == self.end:
+            self.start = self.end = 0
@@ -0,0 +1,53 @@
+class IRCMessage:
+    """A parsed IRC line: [':' prefix ' '] command *(' ' param) [' :' trailing]
+
+    params holds every parameter, the trailing one included, so handlers do not have to care
+    whether the client used a ':' or not. trailing is kept separately for the commands where
+    it makes a difference."""
+    __slots__ = ("prefix", "command", "params", "trailing")
+    prefix: str | None
+    command: str  # upper case
+    params: list[str]
+    trailing: str | None
+
+    def __init__(self, prefix: str | None, command: str, params: list[str], trailing: str | None = None) -> None:
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+
+    def line(self) -> str:
+        """The message as a line without CR-LF, parse() gives an equal message back"""
+        words = [":" + self.prefix] if self.prefix is not None else []
+        words.append(self.command)
+        if self.trailing is not None:
+            words.extend(self.params[:-1])
+            words.append(":" + self.trailing)
+        else:
+            words.extend(self.params)
+        return " ".join(words)
+
+    def __repr__(self) -> str:
+        return f"IRCMessage({self.prefix!r}, {self.command!r}, {self.params!r}, {self.trailing!r})"
+
+    @staticmethod
+    def parse(line: str) -> "IRCMessage | None":
+        """Parses a line in a single pass. Returns None for lines without a command"""
+        # Neither the prefix nor middle parameters can contain ' :', so the first one starts the trailing parameter
+        head, separator, trailing = line.partition(" :")
+        words = head.split(" ")
+        if "" in words:
+            # Repeated, leading or trailing spaces
+            words = [word for word in words if word]
+
+        prefix = None
+        if words and words[0][0] == ":":
+            prefix = words.pop(0)[1:]
+        if not words:
+            return None
+
+        if separator:
+            words.append(trailing)
+        else:
+            trailing = None
+        return IRCMessage(prefix, words.pop(0).upper(), words, trailing)
@@ -0,0 +1,213 @@
+import traceback
+from socket import AF_UNIX, SOCK_STREAM, socket
+from typing import TYPE_CHECKING, Iterable
+
+import log
+import metrics
+from channel import broadcast_to_peers, leave_all, peers
+from client import Client
+from framing import MAX_LINE, LineBuffer
+from ircmessage import IRCMessage
+from registry import fold
+
+if TYPE_CHECKING:
+    from dispatch import Dispatcher
+
+LINK_MAX_LINE = 2 * MAX_LINE
+
+
+class RemoteClient(Client):
+    """A user connected to another server of the cluster, or of the network (see peer.py).
+
+    Only what NAMES, WHO and nickname lookups need is mirrored. Channel broadcasts skip
+    remote users, anything written to one directly is forwarded to the server it is on."""
+    __slots__ = ("link", "server")
+    is_remote = True
+    link: "Link"  # the way to the user
+    server: str  # name of the server the user is connected to
+
+    def __init__(self, link: "Link", nickname: str, username: str, realname: str, host: str, server: str = "") -> None:
+        # Client.__init__ is skipped on purpose, there is no connection, buffer or timer to set up
+        self.link = link
+        self.server = server
+        self.init_user(nickname, username, realname, host)
+
+    @property
+    def closed(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> None:
+        target = b"TO " + self.key.encode("UTF-8") + b" "
+        for line in data.splitlines(keepends=True):
+            self.link.send_raw(target + line)
+
+    def close(self) -> None:
+        pass
+
+
+class Link:
+    """Connection of a worker to the cluster hub, see cluster.py.
+
+    Everything a local user does that other workers need to know about is sent as the IRC
+    line local clients see, prefixed with the user. Lines from the hub are applied to the
+    mirrored state and broadcast to the local members of the channel."""
+    conn: socket
+    server: "Dispatcher"
+    inbuf: LineBuffer
+    backlog: list[str]  # lines received while waiting for a CLAIM reply
+
+    def __init__(self, path: str, server: "Dispatcher") -> None:
+        self.conn = socket(AF_UNIX, SOCK_STREAM)
+        self.conn.connect(path)
+        self.server = server
+        # Relayed lines carry a prefix on top of a full client line
+        self.inbuf = LineBuffer(64 * 1024, LINK_MAX_LINE)
+        self.backlog = []
+
+    def send_line(self, line: str) -> None:
+        self.send_raw((line + "\r\n").encode("UTF-8"))
+
+    def send_raw(self, data: bytes) -> None:
+        # Blocking on purpose: the hub never blocks on a worker and only does a little bookkeeping per line
+        self.conn.sendall(data)
+
+    def claim(self, nickname: str, old_nickname: str) -> bool:
+        """Asks the hub for a nickname, which keeps nicknames unique across workers.
+        Waits for the answer, lines received in the meantime are handled right after it"""
+        self.send_line(f"CLAIM {nickname} {old_nickname}")
+
+        granted: bool | None = None
+        while granted is None:
+            try:
+                received = self.inbuf.recv_from(self.conn)
+            except OSError:
+                received = 0
+            if received == 0:
+                self.server.link_lost()
+                return True
+            # Read every line that has arrived, the selector will not report them again
+            for line in self.inbuf.lines():
+                if line.startswith("CLAIMED "):
+                    granted = line.endswith(" 1")
+                else:
+                    self.backlog.append(line)
+
+        backlog = self.backlog
+        self.backlog = []
+        for line in backlog:
+            self.handle_line_safely(line)
+        return granted
+
+    def release(self, nickname: str) -> None:
+        """Gives up a nickname which was claimed by a client that quit before registering"""
+        self.send_line(f"RELEASE {nickname}")
+
+    def on_readable(self, mask: int) -> None:
+        try:
+            received = self.inbuf.recv_from(self.conn)
+        except OSError:
+            received = 0
+        if received == 0:
+            print("[LINK] Lost the connection to the hub")
+            self.server.link_lost()
+            return
+
+        for line in self.inbuf.lines():
+            self.handle_line_safely(line)
+
+    def handle_line_safely(self, line: str) -> None:
+        """handle_line, but a line it fails on is dropped instead of taking the server down"""
+        try:
+            self.handle_line(line)
+        except Exception as e:
+            print(f"[LINK] Bad line from the hub: {line!r} failed: {e!r}")
+            traceback.print_exc()
+
+    def handle_line(self, line: str) -> None:
+        """Applies a line relayed by the hub"""
+        log.debug("[LINK] %s", line)
+        server = self.server
+
+        if line.startswith("TO "):
+            fields = line.split(" ", 2)
+            if len(fields) != 3:
+                log.debug("[LINK] Malformed line %s", line)
+                return
+            _, nickname, data = fields
+            client = server.clients.get(nickname)
+            # Linked servers pass on what is meant for users further away
+            if client is not None and (not client.is_remote or client.link is not self):
+                client.send(data)
+            return
+
+        msg = IRCMessage.parse(line)
+        if msg is None or msg.prefix is None or not msg.params:
+            return
+        nickname, _, userhost = msg.prefix.partition("!")
+        user = server.clients.get(fold(nickname))
+        if user is None and msg.command != "INTRO":
+            log.debug("[LINK] Unknown user %s", nickname)
+            return
+
+        match msg.command:
+            case "INTRO":
+                # :nick!user@host INTRO <server> :<realname>
+                username, _, host = userhost.partition("@")
+                server.clients[fold(nickname)] = RemoteClient(self, nickname, username, msg.params[-1], host,
+                                                                msg.params[0] if len(msg.params) > 1 else "")
+            case "JOIN":
+                server.join_channel(user, msg.params[0])
+                server.channels[msg.params[0]].broadcast(line)
+            case "PART":
+                channel = server.channels.get(msg.params[0])
+                if channel is not None and user in channel.users:
+                    channel.broadcast(line)
+                    channel.remove_user(user)
+            case "QUIT":
+                self.remove_remote_user(user, line)
+            case "NICK":
+                broadcast_to_peers(user, line)
+                del server.clients[user.key]
+                user.nickname = msg.params[0]
+                server.clients[user.key] = user
+            case "TOPIC":
+                channel = server.channels.get(msg.params[0])
+                if channel is not None and len(msg.params) > 1:
+                    server.set_topic(channel, msg.params[1])
+                    channel.broadcast(line)
+            case "PRIVMSG":
+                channel = server.channels.get(msg.params[0])
+                if channel is not None:
+                    channel.broadcast(line)
+
+    def remove_remote_user(self, user: Client, quit_msg: str) -> None:
+        del self.server.clients[user.key]
+        broadcast_to_peers(user, quit_msg)
+        leave_all(user)
+
+    def close(self) -> None:
+        """Closes the connection and removes every remote user, as in a netsplit"""
+        self.conn.close()
+        split_users(self.server, [c for c in self.server.clients.values() if c.is_remote], "*.net *.split")
+
+
+def split_users(server: "Dispatcher", users: Iterable[Client], reason: str) -> None:
+    """Removes remote users lost in a netsplit. Every local user gets the QUITs of all the users it shared
+    a channel with in a single write, instead of one write per QUIT"""
+    outgoing: dict[Client, list[bytes]] = {}
+    count = 0
+    for user in users:
+        data = f"{user.prefix} QUIT :{reason}\r\n".encode("UTF-8")
+        for peer in peers(user):
+            if not peer.is_remote:
+                outgoing.setdefault(peer, []).append(data)
+        if server.clients.get(user.key) is user:
+            del server.clients[user.key]
+        leave_all(user)
+        count += 1
+    for client, lines in outgoing.items():
+        data = b"".join(lines)
+        client.write(data)
+        metrics.output(len(data))
+    if count:
+        print(f"[LINK] Split {count} users: {reason}")
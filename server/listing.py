@@ -0,0 +1,74 @@
+"""LIST filters, and the streams of replies too long to send at once (LIST, WHO #channel), which the server
+sends a batch at a time as the client reads them.
+
+The first parameter of LIST is a comma separated list of channel names and filters (ELIST=MNU):
+  >N, <N     channels with more than, or fewer than, N users
+  mask       channels whose name matches one of the masks, with * and ? wildcards
+  !mask      channels whose name does not match the mask
+  T:mask     channels whose topic matches one of the masks, not advertised, ELIST has no letter for it
+The user counts only narrow down the buckets of ChannelSizes which are walked, masks are matched against
+every channel of those buckets."""
+import re
+import sys
+from typing import Iterator
+
+from channel import Channel, ChannelSizes
+from registry import WILDCARDS, compile_mask, fold
+
+ELIST = "MNU"
+
+
+class Stream:
+    """Replies the server sends a batch at a time, see Dispatcher.continue_stream"""
+    __slots__ = ("replies", "end")
+    replies: Iterator[str | None]  # the replies, None for every entry looked at which has none, so batches stay short
+    end: str  # the last reply, sent on its own if the stream is cut short
+
+    def __init__(self, replies: Iterator[str | None], end: str) -> None:
+        self.replies = replies
+        self.end = end
+
+
+class Listing:
+    __slots__ = ("channels", "names", "excluded", "topics")
+    channels: Iterator[Channel]  # the candidates not looked at yet, largest first
+    names: list[re.Pattern | None]  # a channel is listed if its name matches one of these, or if there are none
+    excluded: list[re.Pattern | None]  # and it matches none of these
+    topics: list[re.Pattern | None]  # and its topic matches one of these, or there are none
+
+    def __init__(self, sizes: ChannelSizes, filters: list[str]) -> None:
+        above, below = -1, sys.maxsize
+        self.names = []
+        self.excluded = []
+        self.topics = []
+        for item in filters:
+            if item[0] in "<>":
+                if not item[1:].isdigit():
+                    continue
+                if item[0] == ">":
+                    above = max(above, int(item[1:]))
+                else:
+                    below = min(below, int(item[1:]))
+            elif item[0] == "!":
+                self.excluded.append(compile_mask(item[1:]))
+            elif item.startswith("T:"):
+                self.topics.append(compile_mask(item[2:]))
+            else:
+                self.names.append(compile_mask(item))
+        self.channels = sizes.descending(above, below)
+
+    def matches(self, channel: Channel) -> bool:
+        if self.names and not any(mask is None or mask.fullmatch(channel.name) for mask in self.names):
+            return False
+        if any(mask is None or mask.fullmatch(channel.name) for mask in self.excluded):
+            return False
+        if self.topics:
+            topic = fold(channel.topic)
+            return any(mask is None or mask.fullmatch(topic) for mask in self.topics)
+        return True
+
+
+def plain_names(filters: list[str]) -> bool:
+    """Whether LIST was given channel names only, which are looked up instead of walking every channel"""
+    return bool(filters) and not any(item[0] in "<>!" or item.startswith("T:") or WILDCARDS.search(item)
+                                     for item in filters)
@@ -1,6 +1,8 @@
 import config
 
 
-def debug(s: str, end: str = '\n') -> None:
+def debug(s: str, *args: object, end: str = '\n') -> None:
+    """Prints a debug message. Formatting is lazy: pass the values as args and use %-style placeholders,
+    so that nothing is formatted while debugging is off"""
     if config.DEBUG:
-        print(s, end=end)
+        print(s % args if args else s, end=end)
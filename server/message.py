@@ -1,49 +1,116 @@
+import os
+import re
+
 import config
 from client import Client
 from channel import Channel
+from framing import MAX_LINE
+from listing import ELIST
+from registry import CASEMAPPING
+
+RE_FIELD = re.compile(r"\{(\w+)\}")
+
+
+class Template:
+    """Lines whose constant parts are encoded once. Fields are written as {name} and filled in by render,
+    which is a single bytes % operation however many fields and lines there are"""
+    __slots__ = ("data",)
+    data: bytes  # printf-style, with a %(name)b for every field
+
+    def __init__(self, text: str = "") -> None:
+        self.data = RE_FIELD.sub(r"%(\1)b", text.replace("%", "%%")).encode("UTF-8")
+
+    @staticmethod
+    def literal(text: str) -> "Template":
+        """A template without fields, braces in the text are kept as they are"""
+        template = Template()
+        template.data = text.replace("%", "%%").encode("UTF-8")
+        return template
+
+    def __add__(self, other: "Template") -> "Template":
+        template = Template()
+        template.data = self.data + other.data
+        return template
+
+    def render(self, fields: dict[bytes, bytes]) -> bytes:
+        return self.data % fields
+
+
+def numeric(text: str) -> Template:
+    """Template of a whole line sent by the server, including its prefix and CR-LF"""
+    return Template(f":{config.HOSTNAME} {text}\r\n")
+
+
+def load_motd(path: str) -> list[str] | None:
+    """Lines of the message of the day, None if there is no such file. Relative paths are relative to the server"""
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    try:
+        with open(path, encoding="UTF-8", errors="replace") as motd:
+            return [line.rstrip("\r\n") for line in motd]
+    except OSError:
+        return None
 
 
 class Message:
     """Helper class to handle message formatting. Contains mostly static methods"""
+    # Compiled by compile(), once the server is configured
+    GREETING: Template  # 001 to 005, 251 and the MOTD
+    MOTD: Template  # 375/372/376, or 422 if there is no MOTD file
 
     @staticmethod
-    def user_greeting(client: Client, user_count: int = 0) -> list[str]:
-        """List of messages which are sent to greet a user"""
-        return [
-            Message.RPL_WELCOME(client),
-            Message.RPL_YOURHOST(client),
-            Message.RPL_CREATED(client),
-            Message.RPL_MYINFO(client),
-            Message.RPL_LUSERCLIENT(client, user_count),
-            Message.ERR_NOMOTD(client)
-        ]
+    def compile() -> None:
+        """Encodes the constant parts of the greeting and loads the MOTD. Nothing is read again until the next call"""
+        lines = load_motd(config.MOTD_FILE)
+        if lines is None:
+            Message.MOTD = numeric("422 {nick} :MOTD File is missing")
+        else:
+            motd = numeric(f"375 {{nick}} :- {config.HOSTNAME} Message of the day - ")
+            line_prefix = Template(f":{config.HOSTNAME} 372 {{nick}} :- ")
+            # Sized for the longest nickname, the rest of a line which does not fit is cut off
+            budget = MAX_LINE - len("\r\n") - len(line_prefix.render({b"nick": b"x" * config.NICKLEN}))
+            for line in lines:
+                line = line.encode("UTF-8")[:budget].decode("UTF-8", "ignore")
+                motd += line_prefix + Template.literal(line + "\r\n")
+            Message.MOTD = motd + numeric("376 {nick} :End of MOTD command")
+
+        Message.GREETING = (numeric("001 {nick} :Welcome to the Internet Relay Network {userhost}")
+                            + numeric(f"002 {{nick}} :Your host is {config.HOSTNAME}, running version {config.VER}")
+                            + numeric("003 {nick} :This server was created sometime")
+                            + numeric(f"004 {{nick}} {config.HOSTNAME} {config.VER} o o")
+                            + numeric(f"005 {{nick}} CASEMAPPING={CASEMAPPING} ELIST={ELIST} NICKLEN={config.NICKLEN} "
+                                      ":are supported by this server")
+                            + numeric("251 {nick} :There are {count} users and 0 services on {servers} servers")
+                            + Message.MOTD)
 
     @staticmethod
-    def RPL_WELCOME(client: Client) -> str:
-        return f"001 {client.nickname} :Welcome to the Internet Relay Network {client.nickname}!{client.username}@{config.HOSTNAME}"
+    def greeting(client: Client, user_count: int = 0, server_count: int = 1) -> bytes:
+        """Everything which is sent to greet a user, ready to be written"""
+        return Message.GREETING.render({
+            b"nick": client.nickname.encode("UTF-8"),
+            b"userhost": client.prefix[1:].encode("UTF-8"),
+            b"count": b"%d" % user_count,
+            b"servers": b"%d" % server_count})
 
     @staticmethod
-    def RPL_YOURHOST(client: Client) -> str:
-        return f"002 {client.nickname} :Your host is {config.HOSTNAME}, running version {config.VER}"
+    def motd(client: Client) -> bytes:
+        return Message.MOTD.render({b"nick": client.nickname.encode("UTF-8")})
 
     @staticmethod
-    def RPL_CREATED(client: Client) -> str:
-        return f"003 {client.nickname} :This server was created sometime"
+    def RPL_ENDOFWHO(client: Client, mask: str) -> str:
+        return f"315 {client.nickname} {mask} :End of WHO list"
 
     @staticmethod
-    def RPL_MYINFO(client: Client) -> str:
-        return f"004 {client.nickname} {config.HOSTNAME} {config.VER} o o"
+    def RPL_LISTSTART(client: Client) -> str:
+        return f"321 {client.nickname} Channel :Users  Name"
 
     @staticmethod
-    def RPL_LUSERCLIENT(client: Client,
-                        user_count: int = 0,
-                        service_count: int = 0,
-                        server_count: int = 1) -> str:
-        return f"251 {client.nickname} :There are {user_count} users and {service_count} services on {server_count} servers"
+    def RPL_LIST(client: Client, channel: Channel) -> str:
+        return f"322 {client.nickname} {channel.name} {len(channel.users)} :{channel.topic}"
 
     @staticmethod
-    def RPL_ENDOFWHO(client: Client, channel: Channel) -> str:
-        return f"315 {client.nickname} {channel.name} :End of WHO list"
+    def RPL_LISTEND(client: Client) -> str:
+        return f"323 {client.nickname} :End of LIST"
 
     @staticmethod
     def RPL_NOTOPIC(client: Client, channel: Channel) -> str:
@@ -55,29 +122,56 @@ class Message:
 
     @staticmethod
     def RPL_WHOREPLY(client: Client, who_client: Client,
-                     channel: Channel) -> str:
-        # TODO: client address
-        return f"352 {client.nickname} {channel.name} {who_client.nickname} ::1 {config.HOSTNAME} {who_client.username} H :0 {client.realname}"
+                     channel: Channel | None) -> str:
+        return f"352 {client.nickname} {channel.name if channel is not None else '*'} {who_client.nickname} {who_client.host} {config.HOSTNAME} {who_client.username} H :0 {who_client.realname}"
+
+    @staticmethod
+    def RPL_NAMREPLY(client: Client, channel: Channel, names: str) -> str:
+        """One payload of Channel.names()"""
+        return f"353 {client.nickname} = {channel.name} :{names}"
+
+    @staticmethod
+    def RPL_NAMREPLY_NOCHANNEL(client: Client, names: str) -> str:
+        """Users on no channel, listed by NAMES without parameters"""
+        return f"353 {client.nickname} * * :{names}"
+
+    @staticmethod
+    def RPL_ENDOFNAMES(client: Client, channel_name: str) -> str:
+        return f"366 {client.nickname} {channel_name} :End of NAMES list"
+
+    @staticmethod
+    def RPL_STATSCOMMANDS(client: Client, command: str, count: int, byte_count: int) -> str:
+        return f"212 {client.nickname} {command} {count} {byte_count} 0"
+
+    @staticmethod
+    def RPL_ENDOFSTATS(client: Client, query: str) -> str:
+        return f"219 {client.nickname} {query} :End of STATS report"
 
     @staticmethod
-    def RPL_NAMREPLY(client: Client, channel: Channel) -> str:
-        return f"353 {client.nickname} = {channel.name} :{' '.join([c.nickname for c in channel.users])}"
+    def RPL_STATSUPTIME(client: Client, seconds: int) -> str:
+        days, seconds = divmod(seconds, 86400)
+        hours, seconds = divmod(seconds, 3600)
+        return f"242 {client.nickname} :Server Up {days} days {hours}:{seconds // 60:02}:{seconds % 60:02}"
 
     @staticmethod
-    def RPL_ENDOFNAMES(client: Client, channel: Channel) -> str:
-        return f"366 {client.nickname} {channel.name} :End of NAMES list"
+    def RPL_YOUREOPER(client: Client) -> str:
+        return f"381 {client.nickname} :You are now an IRC operator"
 
     @staticmethod
     def ERR_NOSUCHSERVER(client: Client, server_name: str) -> str:
         return f"402 {client.nickname} {server_name} :No such server"
 
     @staticmethod
-    def ERR_UNKNOWNCOMMAND(client: Client, command: str) -> str:
-        return f"421 {client.nickname} {command.upper()} :Unknown command"
+    def ERR_TOOMANYMATCHES(client: Client, command: str) -> str:
+        return f"416 {client.nickname} {command} :Too many lines in the output, restrict your query"
 
     @staticmethod
-    def ERR_NOMOTD(client: Client) -> str:
-        return f"422 {client.nickname} :MOTD File is missing"
+    def ERR_NOSUCHCHANNEL(client: Client, channel_name: str) -> str:
+        return f"403 {client.nickname} {channel_name} :No such channel"
+
+    @staticmethod
+    def ERR_UNKNOWNCOMMAND(client: Client, command: str) -> str:
+        return f"421 {client.nickname} {command.upper()} :Unknown command"
 
     @staticmethod
     def ERR_ERRONEUSNICKNAME(client: Client, name: str) -> str:
@@ -87,10 +181,26 @@ class Message:
     def ERR_NICKNAMEINUSE(client: Client, name: str) -> str:
         return f"433 {client.nickname} {name} :Nickname is already in use"
 
+    @staticmethod
+    def ERR_NOTONCHANNEL(client: Client, channel: Channel) -> str:
+        return f"442 {client.nickname} {channel.name} :You're not on that channel"
+
+    @staticmethod
+    def ERR_NOTREGISTERED(client: Client) -> str:
+        return f"451 {client.nickname} :You have not registered"
+
     @staticmethod
     def ERR_NEEDMOREPARAMS(command: str) -> str:
         return f"461 {command.upper()} :Not enough parameters"
 
+    @staticmethod
+    def ERR_PASSWDMISMATCH(client: Client) -> str:
+        return f"464 {client.nickname} :Password incorrect"
+
+    @staticmethod
+    def ERR_NOPRIVILEGES(client: Client) -> str:
+        return f"481 {client.nickname} :Permission Denied- You're not an IRC operator"
+
     @staticmethod
     def CMD_PING() -> str:
         return f"PING :{config.HOSTNAME}"
@@ -104,5 +214,4 @@ class Message:
     @staticmethod
     # TODO: remove?
     def CMD_JOIN(client: Client, channel: str) -> str:
-        # TODO: client address
-        return f":{client.nickname}!{client.username}@::1 JOIN {channel}"
+        return f"{client.prefix} JOIN {channel}"
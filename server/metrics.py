@@ -0,0 +1,163 @@
+"""Counters and histograms of the server, rendered in the Prometheus text format.
+
+Metrics live at module level like config, so any module can update them without a reference
+to the server. They are only updated from the event loop thread; the HTTP endpoint reads
+them from its own thread, which at worst sees a scrape that is a few updates old."""
+import socket
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+registry: dict[str, "Metric"] = {}
+
+# Command whose handler is running, output written meanwhile is attributed to it
+handler = "none"
+
+server: ThreadingHTTPServer | None = None  # the /metrics endpoint, once serve() or adopt() started it
+
+
+class Metric:
+    name: str
+    help: str
+    type: str
+    label: str | None  # name of the only label, if there is one
+
+    def __init__(self, name: str, help: str, label: str | None = None) -> None:
+        self.name = name
+        self.help = help
+        self.label = label
+        registry[name] = self
+
+    def series_name(self, key: str, suffix: str = "", extra: str = "") -> str:
+        labels = [f'{self.label}="{key}"'] if self.label is not None else []
+        if extra:
+            labels.append(extra)
+        return f"{self.name}{suffix}{{{','.join(labels)}}}" if labels else f"{self.name}{suffix}"
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self.samples()]
+
+
+class Counter(Metric):
+    type = "counter"
+    values: dict[str, int]
+
+    def __init__(self, name: str, help: str, label: str | None = None) -> None:
+        super().__init__(name, help, label)
+        self.values = {}
+
+    def inc(self, key: str = "", amount: int = 1) -> None:
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.series_name(key)} {value}" for key, value in list(self.values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: list[float]  # upper bounds
+    counts: dict[str, list[int]]  # per label value, one count per bucket plus one for +Inf
+    sums: dict[str, float]
+
+    def __init__(self, name: str, help: str, buckets: list[float], label: str | None = None) -> None:
+        super().__init__(name, help, label)
+        self.buckets = buckets
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value: float, key: str = "") -> None:
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, counts in list(self.counts.items()):
+            total = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.series_name(key, '_bucket', le)} {total}")
+            lines.append(f"{self.series_name(key, '_sum')} {self.sums[key]}")
+            lines.append(f"{self.series_name(key, '_count')} {total}")
+        return lines
+
+
+class Value(Metric):
+    """A metric whose value is read from the server when it is rendered, e.g. the number of clients"""
+    read: Callable[[], float]
+
+    def __init__(self, name: str, help: str, read: Callable[[], float], type: str = "gauge") -> None:
+        super().__init__(name, help)
+        self.read = read
+        self.type = type
+
+    def samples(self) -> list[str]:
+        return [f"{self.name} {self.read()}"]
+
+
+def render() -> str:
+    return "".join(line + "\n" for metric in list(registry.values()) for line in metric.render())
+
+
+LATENCY_BUCKETS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.1, 1.0]
+SIZE_BUCKETS = [1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000]
+
+messages_in = Counter("irc_messages_in_total", "Messages received, by command", "command")
+bytes_in = Counter("irc_bytes_in_total", "Bytes of the messages received, by command", "command")
+writes_out = Counter("irc_writes_out_total", "Buffers queued for clients, by the command whose handler queued them", "command")
+bytes_out = Counter("irc_bytes_out_total", "Bytes queued for clients, by the command whose handler queued them", "command")
+handler_seconds = Histogram("irc_handler_seconds", "Time spent in command handlers", LATENCY_BUCKETS, "command")
+send_calls = Counter("irc_send_calls_total", "send/sendmsg calls writing to clients, selectors engine only")
+wakeups = Counter("irc_wakeups_total", "Returns from select/epoll, selectors engine only")
+wakeup_events = Counter("irc_wakeup_events_total", "Ready sockets reported by select/epoll, selectors engine only")
+tls_handshakes = Counter("irc_tls_handshakes_total", "TLS handshakes, by result (ok, failed, rejected)", "result")
+fanout_recipients = Histogram("irc_fanout_recipients", "Local users each broadcast was written to, senders and remote users excluded", SIZE_BUCKETS)
+
+
+def output(size: int, recipients: int = 1) -> None:
+    """Counts a buffer of size bytes queued for each of recipients clients. Called once per send or broadcast,
+    not per Client.write, so that fan-outs are counted in bulk"""
+    writes_out.inc(handler, recipients)
+    bytes_out.inc(handler, size * recipients)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def serve(addr: str, port: int) -> ThreadingHTTPServer:
+    """Serves /metrics on a thread of its own. Meant for a loopback address, there is no authentication"""
+    global server
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def adopt(listener: socket.socket) -> ThreadingHTTPServer:
+    """Serves /metrics on a listening socket handed over by a hot restart"""
+    global server
+    server = ThreadingHTTPServer(listener.getsockname()[:2], MetricsHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
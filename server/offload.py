@@ -0,0 +1,101 @@
+"""Blocking work (DNS lookups), and CPU heavy work which releases the GIL (the steps of TLS handshakes), runs
+on bounded thread pools, off the event loop.
+
+Results are handed back to the loop through a socketpair: workers queue the result and write a
+byte, the engine watches the other end and runs the callbacks on the loop thread, where they
+can touch the server state like any handler."""
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import log
+
+
+class Offloader:
+    executor: ThreadPoolExecutor | None  # None runs the work inline, blocking the loop (for comparison in benchmarks)
+    max_pending: int  # jobs queued or running before submit refuses more
+    pending: int
+    done: deque[tuple[Callable[[Any], None], Any]]  # (callback, result) of the finished jobs, appended by the workers
+    wakeup: socket.socket  # readable when done has entries, the engine passes its events to on_readable
+    notify: socket.socket  # written to by the workers
+
+    def __init__(self, threads: int, max_pending: int) -> None:
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="offload") if threads > 0 else None
+        self.max_pending = max_pending
+        self.pending = 0
+        self.done = deque()
+        self.wakeup, self.notify = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.notify.setblocking(False)
+
+    def submit(self, fn: Callable[..., Any], args: tuple, callback: Callable[[Any], None]) -> bool:
+        """Runs fn(*args) on a worker thread and callback(result) on the loop once it is done.
+        fn should catch its own errors, if it raises the callback gets None.
+        Returns False without running anything if too many jobs are pending"""
+        if self.executor is None:
+            callback(self.run(fn, args))
+            return True
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        self.executor.submit(self.work, fn, args, callback)
+        return True
+
+    @staticmethod
+    def run(fn: Callable[..., Any], args: tuple) -> Any:
+        try:
+            return fn(*args)
+        except Exception as e:
+            print(f"[OFFLOAD] {fn.__name__} failed: {e!r}")
+            return None
+
+    def work(self, fn: Callable[..., Any], args: tuple, callback: Callable[[Any], None]) -> None:
+        """Runs on a worker thread"""
+        self.done.append((callback, self.run(fn, args)))
+        try:
+            self.notify.send(b"\0")
+        except BlockingIOError:
+            # The socket is full of wakeups the loop has not read yet, it will see this result too
+            pass
+
+    def on_readable(self, mask: int = 0) -> None:
+        """Runs the callbacks of the finished jobs on the loop thread"""
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.done:
+            callback, result = self.done.popleft()
+            self.pending -= 1
+            log.debug("[OFFLOAD] Done: %r", result)
+            callback(result)
+
+
+def unmap(address: str) -> str:
+    """IPv4 clients of a dual-stack socket show up as ::ffff:a.b.c.d"""
+    if address.startswith("::ffff:") and "." in address:
+        return address[len("::ffff:"):]
+    return address
+
+
+def format_host(address: str) -> str:
+    """Makes an IP address usable as the host of a prefix, which must not start with ':'
+    or it would be read as a trailing parameter"""
+    address = unmap(address)
+    return "0" + address if address.startswith(":") else address
+
+
+def lookup_host(address: str) -> str | None:
+    """Reverse DNS lookup of a client address. The name is only used if it resolves back to the address,
+    otherwise anyone with control over their reverse zone could pick their host. Blocks, runs on a worker"""
+    address = unmap(address)
+    try:
+        name = socket.getnameinfo((address, 0), socket.NI_NAMEREQD)[0]
+        addresses = {info[4][0] for info in socket.getaddrinfo(name, None, proto=socket.IPPROTO_TCP)}
+    except (OSError, UnicodeError):
+        return None
+    if address not in addresses or len(name) > 63 or name.startswith(":"):
+        return None
+    return name
@@ -0,0 +1,374 @@
+"""Links between independent servers over TCP, which together form one IRC network.
+
+Servers are linked in a tree: every server relays what it learns from one link to its other
+links. A link reuses the line protocol of the cluster hub (link.py): users are mirrored as
+RemoteClients, and their lines are sent as the IRC lines local clients see, prefixed with the
+user. On top of that:
+
+    SERVER <name> <password> :<version>   first line in both directions, config.LINK_PASSWORD
+    S <name> <parent>                      a server reachable through the link
+    U <nick> <user> <host> <server> :<realname>
+    C <channel> :<nick> <nick> ...         members, many per line
+    T <channel> :<topic>
+    EOB                                    end of the burst
+    SQUIT <name> :<reason>                 the server and everything behind it is gone
+    KILL <nick> :<reason>                  nickname collision, the server of the user disconnects it
+    PING <token> / PONG <token>
+
+When a link comes up both sides send their state as a burst of S, U, C and T lines, written at
+once. Channel messages only go to the links which have members of the channel behind them,
+counted in Peer.interest. A lost link is announced with a single SQUIT, every server removes the
+users behind it itself and local users get their QUITs batched (link.split_users)."""
+import hmac
+import selectors
+import socket
+import traceback
+from time import perf_counter
+from typing import TYPE_CHECKING, Callable
+
+import config
+import log
+from channel import Channel
+from client import Client
+from framing import LineBuffer
+from link import LINK_MAX_LINE, Link, RemoteClient, split_users
+from registry import fold
+
+if TYPE_CHECKING:
+    from dispatch import Dispatcher
+
+
+class PeerConnection(Client):
+    """Buffered, non-blocking writes to a linked server, like cluster.WorkerConnection"""
+    # A burst is written at once, the peer should not be dropped like a slow user while it reads it
+    __slots__ = ()
+    sendq_max = 256 * 1024 * 1024
+
+    def __init__(self, conn: socket.socket, on_sendq: Callable[[Client], None]) -> None:
+        super().__init__(conn, on_sendq)
+        self.inbuf = LineBuffer(64 * 1024, LINK_MAX_LINE)
+
+
+class Peer(Link):
+    name: str | None  # of the server at the other end, known once its SERVER line arrived
+    writer: PeerConnection
+    outgoing: bool  # we connected to it
+    servers: dict[str, str]  # {name: name of the server it is linked to} of every server behind the link
+    interest: dict[str, int]  # {channel: members behind the link}
+    linked_at: float  # perf_counter when the SERVER line arrived, for timing the burst
+
+    def __init__(self, conn: socket.socket, server: "Dispatcher", outgoing: bool) -> None:
+        # Link.__init__ is skipped on purpose, it connects to the cluster hub
+        conn.setblocking(False)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.conn = conn
+        self.server = server
+        self.writer = PeerConnection(conn, lambda _: server.pending_peers.add(self))
+        self.inbuf = self.writer.inbuf
+        self.backlog = []
+        self.name = None
+        self.outgoing = outgoing
+        self.servers = {}
+        self.interest = {}
+        self.linked_at = 0.0
+        self.send_line(f"SERVER {config.HOSTNAME} {config.LINK_PASSWORD} :{config.VER}")
+
+    def __repr__(self) -> str:
+        return f"Peer({self.name or self.conn})"
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.closed
+
+    def send_raw(self, data: bytes) -> None:
+        self.writer.write(data)
+
+    def on_readable(self, mask: int) -> None:
+        """Selector callback, for reads and writes"""
+        if mask & selectors.EVENT_WRITE:
+            self.writer.flush()
+            self.server.watch_peer(self)
+        if not mask & selectors.EVENT_READ or self.closed:
+            return
+        try:
+            received = self.inbuf.recv_from(self.conn)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+        if received == 0:
+            self.server.split(self, "Connection closed")
+            return
+        for line in self.inbuf.lines():
+            try:
+                self.handle_line(line)
+            except Exception as e:
+                # A line this server does not understand must not take it down, only the link goes
+                print(f"[PEER] Bad line from {self.name}: {line!r} failed: {e!r}")
+                traceback.print_exc()
+                self.error("Malformed line")
+            if self.closed:
+                return
+
+    def error(self, reason: str) -> None:
+        self.send_line(f"ERROR :{reason}")
+        self.server.split(self, reason)
+
+    def handle_line(self, line: str) -> None:
+        server = self.server
+        command, _, rest = line.partition(" ")
+        if self.name is None:
+            self.handshake(command, rest)
+            return
+
+        match command:
+            case "U":
+                self.introduce(rest)
+            case "C":
+                self.join_members(rest)
+            case "T":
+                channel_name, _, topic = rest.partition(" :")
+                channel = server.channels.get(channel_name)
+                # Whichever side has a topic wins, ours if both do
+                if channel is not None and channel.topic == "" and topic:
+                    server.set_topic(channel, topic)
+                    server.propagate(line, self)
+            case "S":
+                fields = rest.split(" ", 2)
+                if len(fields) != 2:
+                    self.error("Malformed S line")
+                    return
+                name, parent = fields
+                if name == config.HOSTNAME or name in server.peers or \
+                        any(name in p.servers for p in server.peers.values()):
+                    self.error(f"Server {name} already exists")
+                    return
+                self.servers[name] = parent
+                server.propagate(line, self)
+            case "SQUIT":
+                name, _, reason = rest.partition(" :")
+                self.squit(name, reason)
+                server.propagate(line, self)
+            case "KILL":
+                nickname, _, reason = rest.partition(" :")
+                user = server.clients.get(fold(nickname))
+                if user is None:
+                    return
+                if not user.is_remote:
+                    server.quit_client(user, f"Killed ({reason})")
+                elif user.link is not self:
+                    user.link.send_line(line)
+            case "EOB":
+                print(f"[PEER] Burst from {self.name} received in {perf_counter() - self.linked_at:.3f}s")
+            case "PING":
+                self.send_line(f"PONG {rest}")
+            case "PONG":
+                pass
+            case "ERROR":
+                print(f"[PEER] {self.name}: {rest}")
+                server.split(self, rest.lstrip(":"))
+            case _:
+                self.relay(line)
+
+    def handshake(self, command: str, rest: str) -> None:
+        server = self.server
+        if command == "ERROR":
+            print(f"[PEER] Link refused: {rest.lstrip(':')}")
+            server.split(self, rest.lstrip(":"))
+            return
+        if command != "SERVER":
+            self.error("Expected SERVER")
+            return
+        name, password, _ = (rest.split(" ", 2) + ["", ""])[:3]
+        if config.LINK_PASSWORD is None or \
+                not hmac.compare_digest(password.encode("UTF-8"), config.LINK_PASSWORD.encode("UTF-8")):
+            self.error("Bad password")
+        elif name == config.HOSTNAME or name in server.peers or any(name in p.servers for p in server.peers.values()):
+            # Linking it again would make a loop
+            self.error(f"Server {name} already exists")
+        else:
+            self.name = name
+            self.servers[name] = config.HOSTNAME
+            self.linked_at = perf_counter()
+            server.peer_linked(self)
+
+    def burst(self) -> None:
+        """Sends everything the other side needs to know, in one write"""
+        server = self.server
+        start = perf_counter()
+        lines = []
+        for peer in server.peers.values():
+            if peer is not self:
+                lines.extend(f"S {name} {parent}" for name, parent in peer.servers.items())
+
+        for user in server.clients.values():
+            if not user.is_remote:
+                lines.append(f"U {user.nickname} {user.username} {user.host} {config.HOSTNAME} :{user.realname}")
+            elif user.link is not self:
+                lines.append(f"U {user.nickname} {user.username} {user.host} {user.server} :{user.realname}")
+
+        budget = LINK_MAX_LINE - len("\r\n")
+        for channel in server.channels.values():
+            members = [user.nickname for user in channel.users if not user.is_remote or user.link is not self]
+            header = f"C {channel.name} :"
+            line = ""
+            for nickname in members:
+                if line and len(header) + len(line) + 1 + len(nickname) > budget:
+                    lines.append(header + line)
+                    line = ""
+                line = f"{line} {nickname}" if line else nickname
+            if line:
+                lines.append(header + line)
+            if channel.topic:
+                lines.append(f"T {channel.name} :{channel.topic}")
+
+        lines.append("EOB")
+        data = ("\r\n".join(lines) + "\r\n").encode("UTF-8")
+        self.send_raw(data)
+        print(f"[PEER] Burst of {len(lines)} lines ({len(data)} bytes) to {self.name} built in "
+              f"{perf_counter() - start:.3f}s")
+
+    def introduce(self, rest: str) -> None:
+        """U <nick> <user> <host> <server> :<realname>"""
+        server = self.server
+        fields, _, realname = rest.partition(" :")
+        fields = fields.split(" ", 4)
+        if len(fields) != 4:
+            self.error("Malformed U line")
+            return
+        nickname, username, host, user_server = fields
+        key = fold(nickname)
+        # Unregistered clients hold their nickname already
+        existing = server.clients.get(key)
+        if existing is not None:
+            self.collide(nickname, existing)
+            return
+        server.clients[key] = RemoteClient(self, nickname, username, realname, host, user_server)
+        server.propagate(f"U {rest}", self)
+
+    def collide(self, nickname: str, existing: Client) -> None:
+        """Two servers gave the same nickname to different users. As neither can tell which was first, both go"""
+        log.debug("[PEER] Nickname collision on %s", nickname)
+        self.send_line(f"KILL {nickname} :Nickname collision")
+        if existing.is_remote:
+            existing.link.send_line(f"KILL {nickname} :Nickname collision")
+        else:
+            self.server.quit_client(existing, "Nickname collision")
+
+    def join_members(self, rest: str) -> None:
+        """C <channel> :<nick> ... The local members get the JOINs of the channel in one write"""
+        server = self.server
+        channel_name, _, nicknames = rest.partition(" :")
+        channel = server.channels.get(channel_name)
+        joins = []
+        for nickname in nicknames.split(" "):
+            user = server.clients.get(fold(nickname))
+            if user is None or not user.is_remote or user.link is not self:
+                continue
+            if channel is None:
+                server.join_channel(user, channel_name)
+                channel = server.channels[channel_name]
+            elif user in channel.users:
+                continue
+            else:
+                channel.add_user(user)
+            self.interest[channel_name] = self.interest.get(channel_name, 0) + 1
+            joins.append(f"{user.prefix} JOIN {channel_name}")
+        if joins:
+            # Channel.broadcast adds the CR-LF of the last line
+            channel.broadcast("\r\n".join(joins))
+            server.propagate(f"C {rest}", self)
+
+    def relay(self, line: str) -> None:
+        """Applies a line of a user behind the link, then passes it on"""
+        server = self.server
+        if line.startswith("TO "):
+            # Delivered, or passed on towards the user
+            super().handle_line(line)
+            return
+        prefix, _, rest = line.partition(" ")
+        command, _, params = rest.partition(" ")
+        if command == "INTRO":
+            self.introduce_intro(line)
+            return
+        user = server.clients.get(fold(prefix[1:].partition("!")[0]))
+        if user is None or not user.is_remote or user.link is not self:
+            log.debug("[PEER] Unknown user in %s", line)
+            return
+
+        target = params.partition(" ")[0]
+        match command:
+            case "JOIN":
+                if target not in server.channels or user not in server.channels[target].users:
+                    self.interest[target] = self.interest.get(target, 0) + 1
+            case "PART":
+                channel = server.channels.get(target)
+                if channel is not None and user in channel.users:
+                    self.lose_interest(channel)
+            case "QUIT":
+                for channel in user.channels:
+                    self.lose_interest(channel)
+            case "NICK":
+                owner = server.clients.get(fold(target))
+                if owner is not None and owner is not user:
+                    # Taken here meanwhile, the user goes instead
+                    self.send_line(f"KILL {user.nickname} :Nickname collision")
+                    return
+
+        super().handle_line(line)
+        if command == "PRIVMSG":
+            # Private messages travel as TO lines, these are channel messages
+            server.propagate_channel(target, line, self)
+        else:
+            server.propagate(line, self)
+
+    def introduce_intro(self, line: str) -> None:
+        """:nick!user@host INTRO <server> :<realname> of a user who registered after the burst"""
+        prefix, _, rest = line.partition(" INTRO ")
+        nickname, _, userhost = prefix[1:].partition("!")
+        username, _, host = userhost.partition("@")
+        user_server, _, realname = rest.partition(" :")
+        self.introduce(f"{nickname} {username} {host} {user_server} :{realname}")
+
+    def lose_interest(self, channel: Channel) -> None:
+        count = self.interest.get(channel.name, 0) - 1
+        if count > 0:
+            self.interest[channel.name] = count
+        else:
+            self.interest.pop(channel.name, None)
+
+    def squit(self, name: str, reason: str) -> None:
+        """Forgets a server behind the link, everything linked through it and their users"""
+        gone = {name} if name in self.servers else set()
+        grew = True
+        while grew:
+            behind = {child for child, parent in self.servers.items() if parent in gone and child not in gone}
+            gone |= behind
+            grew = bool(behind)
+        for server_name in gone:
+            del self.servers[server_name]
+        users = [c for c in self.server.clients.values() if c.is_remote and c.link is self and c.server in gone]
+        for user in users:
+            for channel in user.channels:
+                self.lose_interest(channel)
+        split_users(self.server, users, reason or f"{config.HOSTNAME} {name}")
+
+    def close(self) -> None:
+        """Closes the link and removes every user behind it, as in a netsplit"""
+        if not self.writer.closed:
+            # The ERROR or burst of this tick would otherwise never be sent
+            self.writer.flush()
+            self.writer.close()
+        users = [c for c in self.server.clients.values() if c.is_remote and c.link is self]
+        split_users(self.server, users, f"{config.HOSTNAME} {self.name}")
+        self.servers.clear()
+        self.interest.clear()
+
+
+def open_link(host: str, port: int) -> socket.socket | None:
+    """Connects to another server. Blocks, runs on an offload worker"""
+    try:
+        return socket.create_connection((host, port), timeout=config.LINK_CONNECT_TIMEOUT)
+    except OSError as e:
+        print(f"[PEER] Could not connect to {host}:{port}: {e}")
+        return None
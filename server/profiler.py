@@ -0,0 +1,164 @@
+"""Profiles the running server for a fixed window, started by SIGUSR1 or the PROFILE operator command.
+
+While a window is open the event loop thread's stack is sampled on SIGPROF (ITIMER_PROF, so only
+time spent on the CPU is sampled) and every command handler and loop step is timed in wall and
+CPU time. When the window closes a collapsed-stack file, which flamegraph.pl and speedscope read,
+and a table of the most expensive handlers are written to config.PROFILE_DIR.
+
+While no window is open the only cost is a check of the module level session per handled message."""
+import os
+import signal
+import threading
+from time import monotonic, perf_counter_ns, strftime, thread_time_ns
+from typing import Any, Callable
+
+import config
+
+session: "Session | None" = None  # the open window, if any
+start_requested = False  # by SIGUSR1, the next poll opens a window
+
+
+class Session:
+    """One profiling window"""
+    deadline: float  # monotonic time the window closes at
+    sampling: bool  # False where SIGPROF can not be used, only handler times are recorded then
+    stacks: dict[str, int]  # {"root;...;leaf": samples}
+    calls: dict[str, list[int]]  # {handler name: [calls, wall ns, cpu ns]}
+    on_finish: Callable[[list[str]], None] | None  # called with the report when the window closes
+
+    def __init__(self, seconds: float, on_finish: Callable[[list[str]], None] | None = None) -> None:
+        self.deadline = monotonic() + seconds
+        self.stacks = {}
+        self.calls = {}
+        self.on_finish = on_finish
+        # Signal handlers can only be installed from the main thread, which is the one running the loop
+        self.sampling = hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+    def call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Calls fn and adds its wall and CPU time to its row of the table"""
+        wall = perf_counter_ns()
+        cpu = thread_time_ns()
+        try:
+            return fn(*args)
+        finally:
+            row = self.calls.get(fn.__name__)
+            if row is None:
+                row = self.calls[fn.__name__] = [0, 0, 0]
+            row[0] += 1
+            row[1] += perf_counter_ns() - wall
+            row[2] += thread_time_ns() - cpu
+
+    def sample(self, signum: int, frame: Any) -> None:
+        """SIGPROF handler, records the stack the loop was interrupted in"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        stack = ";".join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def report(self, top: int) -> list[str]:
+        rows = sorted(self.calls.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        lines = [f"{'handler':<20} {'calls':>8} {'wall ms':>10} {'cpu ms':>10} {'mean us':>10}"]
+        for name, (calls, wall, cpu) in rows:
+            lines.append(f"{name:<20} {calls:>8} {wall / 1e6:>10.1f} {cpu / 1e6:>10.1f} {wall / calls / 1e3:>10.1f}")
+
+        if self.stacks:
+            # Self time: the samples of the innermost frame of each stack
+            leaves: dict[str, int] = {}
+            for stack, count in self.stacks.items():
+                leaf = stack.rpartition(";")[2]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            total = sum(leaves.values())
+            lines.append(f"{'function':<40} {'samples':>8} {'self %':>7}")
+            for leaf, count in sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:top]:
+                lines.append(f"{leaf:<40} {count:>8} {count / total * 100:>7.1f}")
+        return lines
+
+    def dump(self, top: int) -> list[str]:
+        """Writes the collapsed stacks and the table, returns the table followed by the paths written"""
+        directory = config.PROFILE_DIR
+        if not os.path.isabs(directory):
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"profile-{strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+
+        lines = self.report(top)
+        with open(base + ".txt", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        paths = [base + ".txt"]
+        if self.stacks:
+            with open(base + ".folded", "w") as file:
+                for stack, count in self.stacks.items():
+                    file.write(f"{stack} {count}\n")
+            paths.append(base + ".folded")
+        return lines + [f"Wrote {path}" for path in paths]
+
+
+def start(seconds: float = 0.0, on_finish: Callable[[list[str]], None] | None = None) -> bool:
+    """Opens a window of seconds (config.PROFILE_SECONDS by default). Returns False if one is already open"""
+    global session
+    if session is not None:
+        return False
+    session = Session(seconds or config.PROFILE_SECONDS, on_finish)
+    if session.sampling:
+        signal.signal(signal.SIGPROF, session.sample)
+        signal.setitimer(signal.ITIMER_PROF, config.PROFILE_INTERVAL, config.PROFILE_INTERVAL)
+    print(f"[PROFILE] Profiling for {seconds or config.PROFILE_SECONDS}s")
+    return True
+
+
+def stop() -> None:
+    """Closes the open window early or once its time is up, and writes its results"""
+    global session
+    if session is None:
+        return
+    current = session
+    session = None
+    if current.sampling:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    lines = current.dump(config.PROFILE_TOP)
+    for line in lines:
+        print(f"[PROFILE] {line}")
+    if current.on_finish is not None:
+        current.on_finish(lines)
+
+
+def poll() -> None:
+    """Opens the window SIGUSR1 asked for, and closes the open one once its time is up. Engines call this from
+    their loop"""
+    global start_requested
+    if start_requested:
+        start_requested = False
+        start()
+    if session is not None and monotonic() >= session.deadline:
+        stop()
+
+
+def call(fn: Callable[[], Any]) -> Any:
+    """Runs a loop step, timed if a window is open"""
+    if session is None:
+        return fn()
+    return session.call(fn)
+
+
+def end_early() -> None:
+    """Makes the next poll close the open window"""
+    if session is not None:
+        session.deadline = 0.0
+
+
+def request_start() -> None:
+    """Makes the next poll open a window"""
+    global start_requested
+    start_requested = True
+
+
+def install_signals() -> None:
+    """SIGUSR1 opens a window, SIGUSR2 closes it early. The handlers run on the main thread between two bytecodes
+    of whatever the loop was doing, so both leave the work, and the printing, to the next poll"""
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: request_start())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: end_early())
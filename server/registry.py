@@ -0,0 +1,104 @@
+"""Nickname and channel name casemapping, and the registry of users with its index for WHO masks.
+
+Names compare under RFC 1459 casemapping: A-Z and []\\~ are the upper case of a-z and {}|^.
+Every name is folded once, when it is registered, and kept as the key of its Client or Channel;
+only the names users send are folded on lookup. Characters outside ASCII are left as they are."""
+import re
+import string
+from bisect import bisect_left
+from typing import Generic, TypeVar
+
+CASEMAPPING = "rfc1459"
+TABLE = str.maketrans(string.ascii_uppercase + "[]\\~", string.ascii_lowercase + "{}|^")
+SPECIALS = str.maketrans("[]\\~", "{}|^")
+WILDCARDS = re.compile(r"[*?]")
+
+V = TypeVar("V")
+
+
+def fold(name: str) -> str:
+    """The key of a name under RFC 1459 casemapping"""
+    if name.isascii():
+        # lower() is several times faster than translate(), only the four specials are left to map
+        lower = name.lower()
+        if "[" in lower or "]" in lower or "\\" in lower or "~" in lower:
+            return lower.translate(SPECIALS)
+        return lower
+    return name.translate(TABLE)
+
+
+def compile_mask(mask: str) -> re.Pattern | None:
+    """Matcher of the folded names a mask with * and ? wildcards covers, None if it covers everything"""
+    mask = fold(mask)
+    if mask.strip("*") == "":
+        return None
+    return re.compile("".join(".*" if part == "*" else "." if part == "?" else re.escape(part)
+                              for part in re.split(r"([*?])", mask) if part))
+
+
+def literal_prefix(mask: str) -> str:
+    """The folded start of a mask up to its first wildcard, every name it covers starts with it"""
+    return fold(WILDCARDS.split(mask, 1)[0])
+
+
+class Registry(dict[str, V], Generic[V]):
+    """Dict from folded names to what they name, which also keeps its keys sorted for prefix lookups.
+
+    Keeping a sorted list up to date would cost a list insert per change, which adds up during a
+    burst of thousands of users. Changes are collected in added and removed instead, and merged into
+    keys_sorted by the first lookup which finds more than MERGE_AFTER of them, sorting a list which is
+    sorted but for its tail. Only the lookup methods below use the index, the rest is a plain dict.
+    Entries must only be changed with [] and del, which keep the index in step."""
+    MERGE_AFTER = 64
+
+    keys_sorted: list[str]  # may still contain removed keys and lack added ones
+    added: set[str]  # keys missing from keys_sorted
+    removed: set[str]  # keys in keys_sorted which are gone
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.keys_sorted = []
+        self.added = set()
+        self.removed = set()
+
+    def __setitem__(self, key: str, value: V) -> None:
+        if key not in self:
+            if key in self.removed:
+                self.removed.discard(key)
+            else:
+                self.added.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        if key in self.added:
+            self.added.discard(key)
+        else:
+            self.removed.add(key)
+
+    def merge(self) -> None:
+        removed = self.removed
+        keys = [key for key in self.keys_sorted if key not in removed] if removed else self.keys_sorted
+        keys.extend(self.added)
+        keys.sort()
+        self.keys_sorted = keys
+        self.added = set()
+        self.removed = set()
+
+    def prefixed(self, prefix: str) -> list[V]:
+        """Values whose key starts with prefix, which has to be folded already. Without a prefix that is
+        everything, in no particular order"""
+        if not prefix:
+            return list(self.values())
+        if len(self.added) + len(self.removed) > self.MERGE_AFTER:
+            self.merge()
+        keys = self.keys_sorted
+        removed = self.removed
+        matches = []
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            if keys[i] not in removed:
+                matches.append(self[keys[i]])
+            i += 1
+        matches.extend(self[key] for key in self.added if key.startswith(prefix))
+        return matches
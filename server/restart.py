@@ -0,0 +1,218 @@
+"""Hot restart: hands the listening sockets, every client connection and the server state over to a new process.
+
+The running server spawns a fresh interpreter with one end of a Unix socketpair, and sends it a
+JSON snapshot of its state followed by the file descriptors (SCM_RIGHTS). The new process rebuilds
+the clients and channels around the same sockets and acknowledges. Only then does the old process
+exit, without closing anything, so clients see no disconnect. If the new process fails to come up
+the old one keeps serving.
+
+TLS connections can not be handed over, their session state lives inside OpenSSL. They are
+disconnected before the snapshot is taken and have to reconnect."""
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+from time import monotonic
+from typing import TYPE_CHECKING, Any
+
+import config
+import metrics
+import tls
+from channel import Channel
+from client import Client
+from ircmessage import IRCMessage
+
+if TYPE_CHECKING:
+    from server import Server
+
+SNAPSHOT_VERSION = 1
+MESSAGE_SIZE = 64 * 1024  # snapshot chunk per SOCK_SEQPACKET message
+FD_BATCH = 250  # descriptors per message, Linux allows at most 253 (SCM_MAX_FD)
+
+
+def snapshot(server: "Server") -> tuple[dict[str, Any], list[socket.socket]]:
+    """State of the server and the sockets it refers to by index. Must run between loop iterations"""
+    now = monotonic()
+    sockets = [server.server]
+    if server.tls_server is not None:
+        sockets.append(server.tls_server)
+    if server.link_server is not None:
+        sockets.append(server.link_server)
+    if metrics.server is not None:
+        # Binding the port again in the new process would race with the old one closing it
+        sockets.append(metrics.server.socket)
+
+    clients = []
+    index: dict[Client, int] = {}
+    for client in server.connections.values():
+        index[client] = len(clients)
+        sockets.append(client.conn)
+        inbuf = client.inbuf
+        clients.append({
+            "nickname": client.nickname,
+            "username": client.username,
+            "host": client.host,
+            "realname": client.realname,
+            "op": client.op,
+            "mode": client.mode,
+            "registered": client not in server.unauthenticated_clients,
+            # Unregistered clients can hold a nickname already
+            "owns_nickname": server.clients.get(client.key) is client,
+            "connected": now - client.connected_at,
+            "idle": now - client.last_interaction,
+            "is_pinged": client.is_pinged,
+            "inbuf": base64.b64encode(inbuf.buffer[inbuf.start:inbuf.end]).decode("ascii"),
+            "discarding": inbuf.discarding,
+            "sendq": base64.b64encode(b"".join(client.sendq or ())).decode("ascii"),
+            "tokens": client.flood.tokens,
+            "deferrals": client.flood.deferrals,
+            "deferred": client.deferred.line() if client.deferred is not None else None,
+            "resume_in": client.resume_at - now,
+        })
+
+    channels = [{"key": key, "name": channel.name, "topic": channel.topic,
+                 "users": [[index[user], modes] for user, modes in channel.users.items()]}
+                for key, channel in server.channels.items()]
+
+    # The new process reads config.py again, settings changed at runtime have to be carried over
+    state = {"version": SNAPSHOT_VERSION, "started": server.started, "tls": server.tls_server is not None,
+             "links": server.link_server is not None, "metrics": metrics.server is not None,
+             "flood_control": config.FLOOD_CONTROL, "clients": clients, "channels": channels}
+    return state, sockets
+
+
+def restore(server: "Server", state: dict[str, Any], fds: list[int]) -> None:
+    """Rebuilds the state of snapshot() in a freshly created server, around the sockets it was sent"""
+    if state["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"snapshot version {state['version']} is not supported")
+    now = monotonic()
+    fds = list(fds)
+    server.started = state["started"]
+    config.FLOOD_CONTROL = state["flood_control"]
+    Channel.fanout = server.fanout if config.FLOOD_CONTROL else None
+    server.adopt(socket.socket(fileno=fds.pop(0)))
+    if state["tls"]:
+        tls_server = socket.socket(fileno=fds.pop(0))
+        if config.TLS_CERT is not None:
+            server.adopt_tls(tls_server, tls.create_context(config.TLS_CERT, config.TLS_KEY))
+        else:
+            tls_server.close()
+    # Missing from the snapshots of servers older than the link listener
+    if state.get("links", False):
+        server.adopt_links(socket.socket(fileno=fds.pop(0)))
+    if state.get("metrics", False):
+        metrics.adopt(socket.socket(fileno=fds.pop(0)))
+
+    clients = []
+    for fd, saved in zip(fds, state["clients"]):
+        conn = socket.socket(fileno=fd)
+        conn.setblocking(False)
+        client = Client(conn, server.sendq_changed, saved["host"])
+        client.nickname = saved["nickname"]
+        client.username = saved["username"]
+        client.realname = saved["realname"]
+        client.op = saved["op"]
+        client.mode = saved["mode"]
+        client.connected_at = now - saved["connected"]
+        client.last_interaction = now - saved["idle"]
+        client.is_pinged = saved["is_pinged"]
+        client.inbuf.feed(base64.b64decode(saved["inbuf"]))
+        client.inbuf.discarding = saved["discarding"]
+        sendq = base64.b64decode(saved["sendq"])
+        if sendq:
+            client.write(sendq)
+        client.flood.tokens = saved["tokens"]
+        client.flood.deferrals = saved["deferrals"]
+
+        server.connections[conn.fileno()] = client
+        if saved["registered"]:
+            server.clients[client.key] = client
+            server.timers.schedule(client.deadline, client)
+        else:
+            server.unauthenticated_clients.add(client)
+            if saved["owns_nickname"]:
+                server.clients[client.key] = client
+            server.timers.schedule(min(client.deadline, client.connected_at + config.REGISTRATION_TIMEOUT), client)
+        clients.append(client)
+
+    for saved in state["channels"]:
+        channel = server.channels[saved["key"]] = Channel(saved["name"], server.channel_sizes, saved["topic"])
+        for index, modes in saved["users"]:
+            channel.add_user(clients[index], modes)
+
+    for client, saved in zip(clients, state["clients"]):
+        if saved["deferred"] is not None:
+            client.deferred = IRCMessage.parse(saved["deferred"])
+            client.resume_at = now + saved["resume_in"]
+            server.pause(client)
+        else:
+            server.update_events(client)
+            if saved["inbuf"]:
+                # Complete lines left in the buffer would otherwise wait for the client to send more
+                server.handle_lines(client, client.inbuf.lines())
+
+
+def send(sock: socket.socket, state: dict[str, Any], sockets: list[socket.socket]) -> None:
+    data = json.dumps(state, separators=(",", ":")).encode("UTF-8")
+    for start in range(0, len(data), MESSAGE_SIZE):
+        sock.sendall(b"S" + data[start:start + MESSAGE_SIZE])
+    fds = [s.fileno() for s in sockets]
+    for start in range(0, len(fds), FD_BATCH):
+        socket.send_fds(sock, [b"F"], fds[start:start + FD_BATCH])
+    sock.sendall(b"E")
+
+
+def receive(sock: socket.socket) -> tuple[dict[str, Any], list[int]]:
+    chunks = []
+    fds: list[int] = []
+    while True:
+        data, received, _, _ = socket.recv_fds(sock, MESSAGE_SIZE + 1, FD_BATCH)
+        fds.extend(received)
+        if not data or data == b"E":
+            break
+        if data[:1] == b"S":
+            chunks.append(data[1:])
+    return json.loads(b"".join(chunks)), fds
+
+
+def take_over(server: "Server", fd: int) -> None:
+    """Runs in the new process: restores the state sent over the inherited socket, acknowledges,
+    and waits for the old process to exit before serving"""
+    sock = socket.socket(fileno=fd)
+    state, fds = receive(sock)
+    restore(server, state, fds)
+    sock.sendall(b"R")
+    sock.settimeout(config.RESTART_TIMEOUT)
+    try:
+        # EOF once the old process is gone
+        sock.recv(1)
+    except OSError:
+        pass
+    sock.close()
+    print(f"[RESTART] Took over {len(state['clients'])} connections")
+
+
+def options() -> list[str]:
+    """The command line options of this process but --resume, the new one needs the same name and links"""
+    result = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg == "--resume":
+            skip = True
+        elif not arg.startswith("--resume="):
+            result.append(arg)
+    return result
+
+
+def spawn() -> tuple[socket.socket, subprocess.Popen]:
+    """Starts the new server process, it waits for the handoff on the returned socket"""
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    proc = subprocess.Popen([sys.executable, server_py, *options(), "--resume", str(child.fileno())],
+                            pass_fds=(child.fileno(),), cwd=os.path.dirname(server_py))
+    child.close()
+    return parent, proc
@@ -1,324 +1,421 @@
-import re
-import select
+import argparse
+import heapq
+import os
+import selectors
+import signal
+import ssl
+from collections import deque
 from socket import AF_INET, AF_INET6, create_server, socket
+from time import monotonic
 
 import config
-import log
-from channel import Channel
+import metrics
+import profiler
+import restart
+import tls
 from client import Client
-from message import Message
+from dispatch import Dispatcher
+from link import Link
+from offload import Offloader, format_host
+from peer import Peer
 
-RE_NICKNAME = re.compile(r"[A-Za-z][A-Za-z\d\[\]\\\`\_\^\{\|\}]{0,8}")
 
-
-class Server:
+class Server(Dispatcher):
     server: socket
-    name: str  # [1..64]
-    channels: dict[str, Channel]  # {channel_name: Channel}
-    clients: dict[str, Client]
-    unauthenticated_clients: set[Client]
+    tls_server: socket | None
+    tls_context: ssl.SSLContext | None
+    link_server: socket | None  # accepts links from other servers
+    handshakes: dict[ssl.SSLSocket, str]  # {TLS connection: address} of the handshakes in progress
+    handshake_deadlines: deque[tuple[float, ssl.SSLSocket]]  # (deadline, connection), in order since the timeout is fixed
+    handshake_steps: set[ssl.SSLSocket]  # connections whose handshake is being stepped on a worker right now
+    tls_offloader: Offloader  # steps handshakes, a pool of its own so that a storm does not hold up host lookups
+    selector: selectors.BaseSelector
+    connections: dict[int, Client]  # {fd: Client}, both registered and unauthenticated
+    paused: list[tuple[float, int, Client]]  # heap of (resume_at, fd, client) of the clients held back by flood control
+    restart_requested: bool  # hot restart once the current loop iteration is done
 
     def __init__(self, name: str = "SERVER") -> None:
-        self.name = name
-        self.channels = {}
-        self.clients = {}
-        self.unauthenticated_clients = set()
-
-    def bind(self, addr: str = "127.0.0.1", port: int = 6667, ipv6: bool = True) -> None:
+        super().__init__(name)
+        # epoll on Linux, kqueue on BSD/macOS, falls back to select elsewhere
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self.paused = []
+        self.tls_server = None
+        self.tls_context = None
+        self.link_server = None
+        self.handshakes = {}
+        self.handshake_deadlines = deque()
+        self.handshake_steps = set()
+        self.tls_offloader = Offloader(config.TLS_THREADS, config.TLS_MAX_HANDSHAKES)
+        self.restart_requested = False
+        Client.corked = config.CORK_OUTPUT
+        self.selector.register(self.offloader.wakeup, selectors.EVENT_READ, self.offloader.on_readable)
+        self.selector.register(self.tls_offloader.wakeup, selectors.EVENT_READ, self.tls_offloader.on_readable)
+
+    def bind(self, addr: str = "127.0.0.1", port: int = 6667, ipv6: bool = True, reuse_port: bool = False) -> None:
         # TODO: should probably reset the connections? Or maybe the whole server. Shouldnt be called more than once, so might just move to __init__
-        self.server = create_server((addr, port), family=AF_INET6 if ipv6 else AF_INET)
+        # reuse_port lets the workers of a cluster listen on the same port, the kernel balances connections between them
+        self.adopt(create_server((addr, port), family=AF_INET6 if ipv6 else AF_INET, reuse_port=reuse_port))
+
+    def adopt(self, listener: socket) -> None:
+        """Accepts connections on a listening socket, which a hot restart may have inherited"""
+        self.server = listener
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+
+    def bind_tls(self, context: ssl.SSLContext, addr: str = "127.0.0.1", port: int = 6697, ipv6: bool = True,
+                 reuse_port: bool = False) -> None:
+        """Listens for TLS connections as well. Their handshakes run on worker threads without blocking them,
+        see accept_tls"""
+        self.adopt_tls(create_server((addr, port), family=AF_INET6 if ipv6 else AF_INET, reuse_port=reuse_port), context)
+
+    def adopt_tls(self, listener: socket, context: ssl.SSLContext) -> None:
+        self.tls_context = context
+        self.tls_server = listener
+        self.tls_server.setblocking(False)
+        self.selector.register(self.tls_server, selectors.EVENT_READ, self.accept_tls)
 
     def run(self) -> None:
         try:
             while True:
-                client_conns: list[socket] = [client.conn for client in self.clients.values()]
-                unauth_client_conns = [client.conn for client in self.unauthenticated_clients]
-                # TODO: some clients might have writes blocked, which is what 'w' is for
-                # In that case there should probably be a write queue for each client?
-                # TODO: store last interaction time for clients and send PING to them. Remove inactive clients.
-                # This function returns every __timeout=5 seconds, even if no messages are received. This should be used to check and send PING
-                r, _, _ = select.select(client_conns + unauth_client_conns + [self.server], [], [], 5)
-
-                i: socket
-                for i in r:
-                    if i is self.server:
-                        conn, _ = self.server.accept()
-                        client = Client(conn)
-                        self.unauthenticated_clients.add(client)
-                    else:
-                        # Search for the client with current socket
-                        # TODO: should handle unauthenticated clients separately. They can not use most of the commands, and must authenticate as soon as possible
-                        sender: Client | None = None
-                        for client in self.clients.values():
-                            if client.conn is i:
-                                sender = client
-                                break
-                        else:
-                            sender = next(client for client in self.unauthenticated_clients if client.conn is i)
-
-                        if sender is None:
-                            # TODO: we dont have a client with such connection, something is really wrong
-                            continue
-
-                        # TODO: make sure disconnection handling works as it should
-                        try:
-                            data = i.recv(2048).decode("UTF-8")
-                        except ConnectionError as e:
-                            print(f"[CLIENT] Connection error while trying to read from {i}: {e}")
-                            self.cmd_QUIT(sender, ["QUIT", ":Leaving"])
-                            continue
-
-                        sender.update_last_interaction()
-                        # There can be multiple '\r\n' separated messages in one chunk of data
-                        messages: list[str] = data.split("\r\n")
-                        # print(f"MSG FROM {i}: {len(data)} {data}, {messages}")
-
-                        for msg in messages:
-                            if msg == "":
-                                continue
-                            self.handle_message(sender, msg.split(" "))
-
-                self.check_clients()
+                # Wake up at least once per timer tick, even if no messages are received
+                timeout = self.timers.resolution
+                if self.paused:
+                    timeout = max(0.0, min(timeout, self.paused[0][0] - monotonic()))
+                events = self.selector.select(timeout)
+                metrics.wakeups.inc()
+                metrics.wakeup_events.inc(amount=len(events))
+
+                for key, mask in events:
+                    if key.fileobj is self.server:
+                        self.accept_client()
+                        continue
+                    if key.data is not None:
+                        # Sockets other than clients (e.g. the cluster link) are registered with a callback
+                        key.data(mask)
+                        continue
+
+                    # Sockets are registered once, so the sender is a single lookup instead of a scan over every client
+                    sender = self.connections.get(key.fd)
+                    if sender is None:
+                        # The client was removed earlier in this batch (e.g. by a failed send)
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.write_client(sender)
+                    if mask & selectors.EVENT_READ and not sender.closed and sender.deferred is None:
+                        self.read_client(sender)
+
+                profiler.call(self.resume_clients)
+                profiler.call(self.check_clients)
+                profiler.call(self.expire_handshakes)
+
+                profiler.call(self.process_pending)
+                profiler.poll()
+                if self.restart_requested:
+                    self.restart_requested = False
+                    self.hot_restart()
         except KeyboardInterrupt:
             print("[SERVER] KeyboardInterrupt received. Quitting...")
+            if self.store is not None:
+                self.store.close()
+            self.selector.close()
             self.server.close()
 
-    def check_clients(self) -> None:
-        """Checks last interaction time with all clients, sends PING, disconnects unresponsive clients"""
-        for client in dict(self.clients).values():      # Check for dead clients
-            if not client.is_alive:
-                if client.is_pinged:
-                    # Client timed out
-                    self.cmd_QUIT(client, ["QUIT", ":Timed out"])
-                else:
-                    client.send_with_prefix(Message.CMD_PING())
-                    client.update_last_interaction()
-                    client.is_pinged = True
-
-    def handle_message(self, sender: Client, msg: list[str]) -> None:
-        """Main message handler"""
-        if len(msg) == 0 or len(msg[0]) == 0:
+    def accept_client(self) -> None:
+        """Accepts a pending connection and registers it with the selector"""
+        try:
+            conn, addr = self.server.accept()
+        except BlockingIOError:
             return
+        self.connect(conn, addr[0])
 
-        msg[0] = msg[0].upper()
-        match msg[0]:
-            case "NICK":
-                self.cmd_NICK(sender, msg)
-            case "USER":
-                self.cmd_USER(sender, msg)
-            case "PING":
-                self.cmd_PING(sender, msg)
-            case "QUIT":
-                self.cmd_QUIT(sender, msg)
-            case "JOIN":
-                self.cmd_JOIN(sender, msg)
-            case "PART":
-                self.cmd_PART(sender, msg)
-            case "WHO":
-                self.cmd_WHO(sender, msg)
-            case "PRIVMSG":
-                self.cmd_PRIVMSG(sender, msg)
-
-            case "PONG":
-                pass
-            case "CAP":
-                pass
-
-            case _:
-                log.debug(f"[CMD][NOT_HANDLED] {msg}")
-                # TODO: the docs say it should be returned to "a registered client". should check for auth?
-                sender.send_with_prefix(Message.ERR_UNKNOWNCOMMAND(sender, msg[0]))
-
-    @staticmethod
-    def join_message_tail(msg: list[str]) -> str:
-        """Joins list of words which are located at the end of a message.
-        Returns the first word if there is no ':' symbol.
-        Returns the whole line if there is a ':' symbol"""
-        message = ' '.join(msg)[1:] if msg[0].startswith(":") else msg[0]
-        return message.strip()
-
-    def cmd_NICK(self, sender: Client, msg: list[str]) -> None:
-        if len(msg) < 2:
-            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg[0]))
+    def accept_tls(self, mask: int) -> None:
+        """Accepts a pending TLS connection and starts its handshake. The handshake is taken a step at a time on
+        tls_offloader, where the crypto does not hold up the loop. Steps never block: in between them the selector
+        waits for the client, so one which is slow to send its part, or never does, holds up nothing but itself"""
+        try:
+            conn, addr = self.tls_server.accept()
+        except BlockingIOError:
             return
-
-        nickname = msg[1][:9].lower()
-        if RE_NICKNAME.fullmatch(nickname):
-            if nickname in self.clients:
-                log.debug(f"[CMD][NICK] Tried to set a name that is already taken: {nickname}")
-                sender.send_with_prefix(Message.ERR_NICKNAMEINUSE(sender, nickname))
+        if len(self.handshakes) >= config.TLS_MAX_HANDSHAKES:
+            # Too many handshakes in flight already, shed the load instead of queueing it
+            metrics.tls_handshakes.inc("rejected")
+            conn.close()
+            return
+        tls_conn = tls.wrap(conn, self.tls_context)
+        if tls_conn is None:
+            metrics.tls_handshakes.inc("failed")
+            return
+        self.handshakes[tls_conn] = addr[0]
+        self.handshake_deadlines.append((monotonic() + config.TLS_HANDSHAKE_TIMEOUT, tls_conn))
+        # Nothing to do before the ClientHello arrives
+        self.selector.register(tls_conn, selectors.EVENT_READ, lambda mask: self.continue_handshake(tls_conn))
+
+    def step_handshake(self, conn: ssl.SSLSocket) -> None:
+        """Has a worker take the handshake as far as the data received so far allows"""
+        self.handshake_steps.add(conn)
+        if not self.tls_offloader.submit(tls.handshake, (conn,), lambda events: self.handshake_stepped(conn, events)):
+            # Can not happen while TLS_MAX_HANDSHAKES bounds both, but the handshake must go on
+            self.handshake_stepped(conn, tls.handshake(conn))
+
+    def continue_handshake(self, conn: ssl.SSLSocket) -> None:
+        """Called whenever a connection in handshake is ready for what the handshake waited for"""
+        # The worker has the socket to itself
+        self.selector.unregister(conn)
+        self.step_handshake(conn)
+
+    def handshake_stepped(self, conn: ssl.SSLSocket, events: int | None) -> None:
+        """Runs on the loop once a worker is done with a step of a handshake"""
+        self.handshake_steps.discard(conn)
+        if conn not in self.handshakes:
+            # Timed out while the step ran
+            conn.close()
+            return
+        if events:
+            self.selector.register(conn, events, lambda mask: self.continue_handshake(conn))
+            return
+        address = self.handshakes.pop(conn)
+        if events is None:
+            metrics.tls_handshakes.inc("failed")
+            conn.close()
+            return
+        metrics.tls_handshakes.inc("ok")
+        self.connect(conn, address)
+
+    def expire_handshakes(self) -> None:
+        """Drops the connections which did not complete their handshake within config.TLS_HANDSHAKE_TIMEOUT"""
+        now = monotonic()
+        while self.handshake_deadlines and self.handshake_deadlines[0][0] <= now:
+            _, conn = self.handshake_deadlines.popleft()
+            if self.handshakes.pop(conn, None) is not None:
+                metrics.tls_handshakes.inc("failed")
+                if conn not in self.handshake_steps:
+                    # Otherwise handshake_stepped closes it once the worker is done with it
+                    self.selector.unregister(conn)
+                    conn.close()
+
+    def connect(self, conn: socket, address: str) -> None:
+        """Starts serving an accepted (and for TLS, handshaken) connection"""
+        conn.setblocking(False)
+        client = Client(conn, self.sendq_changed, format_host(address))
+        self.add_client(client, address)
+        self.connections[conn.fileno()] = client
+        self.update_events(client)
+
+    def read_client(self, sender: Client) -> None:
+        """Reads and handles everything a client has sent"""
+        # TODO: make sure disconnection handling works as it should
+        while True:
+            try:
+                received = sender.inbuf.recv_from(sender.conn)
+            except tls.WOULD_BLOCK:
+                return
+            except OSError as e:
+                # Connection errors, TLS errors, but also ETIMEDOUT and EHOSTUNREACH, which are neither
+                print(f"[CLIENT] Connection error while trying to read from {sender.conn}: {e}")
+                self.quit_client(sender, "Leaving")
                 return
 
-            # TODO: if a user changes their name then a response must be sent
-            # TODO: avoid greeting users who have already been greeted (which is those who are changing their name)
-            if sender.nickname in self.clients:
-                del self.clients[sender.nickname]
-            sender.nickname = nickname
-            self.clients[nickname] = sender
-            log.debug(f"[CMD][NICK] SET VALID NAME \"{nickname}\"")
-        else:
-            # TODO: verify that the regex above is correct and that this response is valid
-            log.debug(f"[CMD][NICK] Tried to set an invalid name: {nickname}")
-            sender.send_with_prefix(Message.ERR_ERRONEUSNICKNAME(sender, nickname))
-
-        # TODO: extract to a function as this is the same as USER greet handler
-        # TODO: store is_greeted
-        if sender.is_authenticated:
-            sender.send_iter_with_prefix(Message.user_greeting(sender, len(self.clients)))
-            if sender in self.unauthenticated_clients:
-                self.unauthenticated_clients.remove(sender)
-                self.clients[sender.nickname] = sender
-
-    def cmd_USER(self, sender: Client, msg: list[str]) -> None:
-        if len(msg) < 5:
-            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg[0]))
-            return
+            if received == 0:
+                # Orderly shutdown from the client side. The socket would stay readable forever otherwise
+                self.quit_client(sender, "Connection closed")
+                return
 
-        # TODO: validation of all fields
-        sender.username = msg[1]
+            self.handle_lines(sender, sender.inbuf.lines())
+            # What is left of a TLS record after the buffer filled up is not signalled again by the selector
+            if sender.closed or sender.deferred is not None or sender in self.streams or not tls.buffered(sender.conn):
+                return
 
+    def write_client(self, client: Client) -> None:
+        """Flushes the send queue of a writable client and stops waiting for writability once it is empty.
+        A client with a stream of replies in progress is sent its next batch instead, see continue_stream"""
+        client.flush()
+        if not client.sendq and client in self.streams:
+            self.continue_stream(client)
+            if not client.closed and client.deferred is None and client not in self.streams and \
+                    tls.buffered(client.conn):
+                self.read_client(client)
+            if client.closed:
+                return
+        if not client.sendq:
+            self.update_events(client)
+
+    def want_write(self, client: Client) -> None:
+        # Corked output is sent here, everything a client was written during the tick in one sendmsg
+        if client.corked:
+            client.flush()
+        self.update_events(client)
+
+    def input_ready(self, client: Client) -> None:
+        self.update_events(client)
+        if tls.buffered(client.conn):
+            self.read_client(client)
+
+    def pause(self, client: Client) -> None:
+        heapq.heappush(self.paused, (client.resume_at, client.conn.fileno(), client))
+        self.update_events(client)
+
+    def resume_clients(self) -> None:
+        """Resumes the paused clients whose time has come"""
+        now = monotonic()
+        while self.paused and self.paused[0][0] <= now:
+            _, _, client = heapq.heappop(self.paused)
+            if client.closed:
+                continue
+            self.resume(client)
+            if not client.closed and client.deferred is None and tls.buffered(client.conn):
+                self.read_client(client)
+            if not client.closed:
+                self.update_events(client)
+
+    def update_events(self, client: Client) -> None:
+        """Waits for input unless the client is paused by flood control, a lookup or a stream of replies, and for
+        writability while it has queued data or a stream of replies to continue"""
+        reading = client.deferred is None and not client.resolving and client not in self.streams
+        writing = client.sendq or client in self.streams
+        events = (selectors.EVENT_READ if reading else 0) | (selectors.EVENT_WRITE if writing else 0)
+        key = self.selector.get_map().get(client.conn.fileno())
+        if key is None:
+            if events:
+                self.selector.register(client.conn, events)
+        elif not events:
+            self.selector.unregister(client.conn)
+        elif key.events != events:
+            self.selector.modify(client.conn, events)
+
+    def request_restart(self) -> bool:
+        if self.link is not None or self.peers:
+            # The hub or the linked servers would see this one vanish and split its users off
+            return False
+        self.restart_requested = True
+        return True
+
+    def hot_restart(self) -> None:
+        """Hands the connections and state over to a new process and exits, see restart.py.
+        Keeps serving if the new process does not take over within config.RESTART_TIMEOUT"""
+        for client in [c for c in self.connections.values() if isinstance(c.conn, ssl.SSLSocket)]:
+            self.quit_client(client, "Server restarting")
+        for client, stream in self.streams.items():
+            # The cursor of a stream can not be handed over, its client gets the end of it instead of waiting forever.
+            # What the client sent meanwhile is still in its buffer, the new process handles it
+            client.send_with_prefix(stream.end)
+        self.streams.clear()
+        self.process_pending()
+        for client in self.connections.values():
+            # Whatever is flushed now does not have to be copied
+            client.flush()
+
+        if self.store is not None:
+            # The new process opens the store itself, it has to find every change on disk
+            self.store.sync()
+        state, sockets = restart.snapshot(self)
+        sock, proc = restart.spawn()
         try:
-            mode = int(msg[2])
-            sender.mode = (bool(mode & 2), bool(mode & 8))
-        except ValueError:
-            # TODO: handle invalid modes
-            sender.mode = (False, False)
-
-        if msg[4].startswith(":"):
-            sender.realname = ' '.join(msg[4:])[1:]
-        else:
-            sender.realname = msg[4]
-
-        log.debug(f"[CMD][USER] SET USER \"{sender.username}\", w={sender.mode[0]}, i={sender.mode[1]}, {sender.realname}")
-        if sender.is_authenticated:
-            sender.send_iter_with_prefix(Message.user_greeting(sender, len(self.clients)))
-            if sender in self.unauthenticated_clients:
-                self.unauthenticated_clients.remove(sender)
-                self.clients[sender.nickname] = sender
-
-    def cmd_PING(self, sender: Client, msg: list[str]) -> None:
-        # TODO: this is a placeholder
-        sender.send_with_prefix(Message.CMD_PONG(msg[1]))
-
-    def cmd_JOIN(self, sender: Client, msg: list[str]) -> None:
-        # TODO: handle invalid command usage (such as no channels given or invalid channel name)
-        channels = list(filter(lambda x: x != '', msg[1].split(',')))
-        for c in channels:
-            c = c.lower()
-            self.join_channel(sender, c)
-            channel = self.channels[c]
-            for c_user in channel.users:
-                c_user.send(Message.CMD_JOIN(sender, c))
-
-            if channel.topic != "":
-                sender.send_with_prefix(Message.RPL_TOPIC(sender, channel))
-            else:
-                sender.send_with_prefix(Message.RPL_NOTOPIC(sender, channel))
-
-            sender.send_iter_with_prefix([
-                Message.RPL_NAMREPLY(sender, channel),
-                Message.RPL_ENDOFNAMES(sender, channel)])
-
-    def join_channel(self, sender: Client, channel: str) -> None:
-        """Add user to a channel with given name"""
-        if channel not in self.channels:
-            # TODO: validate channel name
-            self.channels[channel] = Channel(channel)
-        self.channels[channel].add_user(sender)
-
-    def cmd_PART(self, sender: Client, msg: list[str]) -> None:
-        if len(msg) < 2:
-            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg[0]))
+            restart.send(sock, state, sockets)
+            sock.settimeout(config.RESTART_TIMEOUT)
+            ack = sock.recv(1)
+        except OSError as e:
+            print(f"[RESTART] Handoff failed: {e}")
+            ack = b""
+        if ack != b"R":
+            print("[RESTART] The new process did not take over, still serving")
+            proc.kill()
+            sock.close()
             return
+        print(f"[RESTART] Handed {len(state['clients'])} connections over to pid {proc.pid}", flush=True)
+        # Nothing may be closed or shut down on the way out, the sockets are shared with the new process now
+        os._exit(0)
 
-        channels = msg[1].split(',')
-        message = self.join_message_tail(msg[2:])
-
-        for c in channels:
-            channel = self.channels.get(c.lower())
-            if channel is not None:
-                if sender in channel.users:
-                    part_msg = f"{sender.prefix} PART {channel.name} :{message}"
-                    for user in channel.users:
-                        user.send(part_msg)
-                    channel.remove_user(sender)
-                else:
-                    # TODO: return ERR_NOTONCHANNEL
-                    pass
-            else:
-                # TODO: return ERR_NOSUCHCHANNEL
-                pass
-
-        log.debug(f"[CMD][PART] {sender.username} is leaving channels {msg[1]} with message {message=}")
-
-    def cmd_QUIT(self, sender: Client, msg: list[str]) -> None:
-        log.debug(f"[CMD][QUIT] {sender.username} quit with message {msg=}")
-
-        self.remove_client(sender)
-        for c in self.channels.values():
-            if sender in c.users:
-                c.remove_user(sender)
-
-            message = self.join_message_tail(msg[1:])
-
-            quit_msg = f"{sender.prefix} QUIT :{message}"
-            for user in c.users:
-                user.send(quit_msg)
-
-    def remove_client(self, client: Client) -> None:
-        """Remove user from the server"""
-        self.clients[client.nickname].conn.close()
-        del self.clients[client.nickname]
-
-    def cmd_WHO(self, sender: Client, msg: list[str]) -> None:
-        if len(msg) < 2:
-            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg[0]))
-            return
+    def bind_links(self, addr: str, port: int, ipv6: bool) -> None:
+        """Accepts links from other servers, see peer.py"""
+        self.adopt_links(create_server((addr, port), family=AF_INET6 if ipv6 else AF_INET))
+
+    def adopt_links(self, listener: socket) -> None:
+        self.link_server = listener
+        self.link_server.setblocking(False)
+        self.selector.register(self.link_server, selectors.EVENT_READ, self.accept_peer)
 
-        channel = self.channels.get(msg[1].lower())
-        if channel is None:
-            sender.send_with_prefix(Message.ERR_NOSUCHSERVER(sender, msg[1].lower()))
+    def accept_peer(self, mask: int) -> None:
+        try:
+            conn, _ = self.link_server.accept()
+        except BlockingIOError:
             return
+        self.attach_peer(conn, False)
 
-        reply = [Message.RPL_WHOREPLY(sender, who_client, channel) for who_client in channel.users]
-        reply.append(Message.RPL_ENDOFWHO(sender, channel))
-        sender.send_iter_with_prefix(reply)
+    def attach_peer(self, conn: socket, outgoing: bool) -> None:
+        peer = Peer(conn, self, outgoing)
+        self.selector.register(conn, selectors.EVENT_READ, peer.on_readable)
+        self.watch_peer(peer)
 
-    def cmd_PRIVMSG(self, sender: Client, msg: list[str]) -> None:
-        if len(msg) < 3:
-            sender.send_with_prefix(Message.ERR_NEEDMOREPARAMS(msg[0]))
+    def watch_peer(self, peer: Peer) -> None:
+        if peer.closed:
             return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.writer.sendq else 0)
+        if self.selector.get_key(peer.conn).events != events:
+            self.selector.modify(peer.conn, events, peer.on_readable)
 
-        target = msg[1].lower()
-        message = self.join_message_tail(msg[2:])
+    def detach_peer(self, peer: Peer) -> None:
+        if peer.conn.fileno() in self.selector.get_map():
+            self.selector.unregister(peer.conn)
 
-        if target in self.clients:
-            target_client = self.clients[target]
-            log.debug(f"[CMD][PRIVMSG] Client {sender.nickname} PRIVMSG to {target_client.nickname} {message=}")
-            self.send_privmsg_line(sender, target_client, target_client.nickname, message)
-            return
-        elif target in self.channels:
-            # TODO: ERR_CANNOTSENDTOCHAN when not on channel
-            channel = self.channels[target.lower()]
-            log.debug(f"[CMD][PRIVMSG] Client {sender.nickname} PRIVMSG to channel {channel.name} {message=}")
-            for target_client in channel.users:
-                if target_client != sender:
-                    self.send_privmsg_line(sender, target_client, target, message)
-        else:
-            # TODO: handle invalid target name
-            pass
+    def attach_link(self, link: Link) -> None:
+        self.link = link
+        self.selector.register(link.conn, selectors.EVENT_READ, link.on_readable)
 
-    def send_privmsg_line(self, sender: Client, target_client: Client, target_name: str, message: str) -> None:
-        try:
-            target_client.send(f"{sender.prefix} PRIVMSG {target_name.lower()} :{message}")
-        except ConnectionError as e:
-            print(f"[CMD][PRIVMSG] Connection error while trying to send a message to {target_name}: {e}")
-            self.cmd_QUIT(target_client, ["QUIT", ":Leaving"])
+    def link_lost(self) -> None:
+        if self.link is not None:
+            self.selector.unregister(self.link.conn)
+        super().link_lost()
+
+    def close_connection(self, client: Client) -> None:
+        if client.corked and client.quit_reason is None:
+            # Output of this tick would otherwise never be sent
+            client.flush()
+        del self.connections[client.conn.fileno()]
+        if client.conn.fileno() in self.selector.get_map():
+            self.selector.unregister(client.conn)
+        client.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the IRC server")
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--name", default=config.HOSTNAME, help="server name, unique in the network")
+    parser.add_argument("--link-port", type=int, default=config.LINK_PORT, help="accept links from other servers")
+    parser.add_argument("--connect", action="append", default=[], metavar="HOST:PORT", help="link to another server")
+    parser.add_argument("--resume", type=int, metavar="FD", help="take over from a server doing a hot restart")
+    args = parser.parse_args()
+    config.HOSTNAME = args.name
     print("[SERVER] Started...")
 
-    server = Server()
-    server.bind(config.HOST, config.PORT, True)
+    if args.resume is not None:
+        server = Server()
+        restart.take_over(server, args.resume)
+    else:
+        if config.ENGINE == "asyncio":
+            from async_server import AsyncServer
+            server = AsyncServer()
+        else:
+            server = Server()
+        server.bind(args.host, args.port, ":" in args.host)
+        if config.TLS_CERT is not None:
+            server.bind_tls(tls.create_context(config.TLS_CERT, config.TLS_KEY), args.host, config.TLS_PORT, ":" in args.host)
+    if isinstance(server, Server) and config.LINK_PASSWORD is not None:
+        if args.link_port is not None and server.link_server is None:
+            server.bind_links(args.host, args.link_port, ":" in args.host)
+        links = config.LINKS + [(host, int(port)) for host, _, port in (link.rpartition(":") for link in args.connect)]
+        for host, port in links:
+            server.connect_peer(host, port)
+    if hasattr(signal, "SIGHUP"):
+        # kill -HUP <pid> restarts without dropping connections
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.request_restart())
+    # After a hot restart the listener of the old process is served already
+    if config.METRICS_ADDR is not None and metrics.server is None:
+        try:
+            metrics.serve(*config.METRICS_ADDR)
+            print(f"[SERVER] Serving metrics on http://{config.METRICS_ADDR[0]}:{config.METRICS_ADDR[1]}/metrics")
+        except OSError as e:
+            print(f"[SERVER] Could not serve metrics: {e}")
+    profiler.install_signals()
     server.run()
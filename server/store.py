@@ -0,0 +1,245 @@
+"""Persistent channel state: an append-only journal compacted into a sorted snapshot.
+
+Records are lines of the form "<channel> <field> :<value>", the last one written for a channel
+and field wins and an empty value removes the field. Changes are appended to channels.journal
+by a writer thread which collects them for config.STORE_FLUSH_INTERVAL and fsyncs once per batch,
+so the loop only ever appends to a queue. Once the journal outgrows config.STORE_COMPACT_BYTES
+the writer merges it into channels.snapshot, sorted by channel, and starts a new journal.
+
+Opening the store does not read the snapshot, it is memory-mapped and looked up by binary search
+when a channel is created. Only the journal is read at startup, and compaction bounds its size,
+so startup time does not depend on the number of stored channels."""
+import heapq
+import io
+import mmap
+import os
+import queue
+import threading
+import time
+from typing import Iterator
+
+SNAPSHOT = "channels.snapshot"
+JOURNAL = "channels.journal"
+COMPACT = object()  # queued by compact(), ends the current journal
+STOP = object()
+
+
+def format_record(key: str, field: str, value: str) -> bytes:
+    return f"{key} {field} :{value}\n".encode("UTF-8")
+
+
+def parse_record(line: bytes) -> tuple[str, str, str]:
+    key, field, value = line.decode("UTF-8").split(" ", 2)
+    return key, field, value[1:]
+
+
+class Snapshot:
+    """Read-only view of a snapshot file, lines sorted by channel and field"""
+    data: mmap.mmap | bytes
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            # A zero length file can not be mapped
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+
+    def find(self, key: bytes) -> int:
+        """Offset of the first line whose channel is not below key"""
+        data = self.data
+        low, high = 0, len(data)
+        # low and high are line starts, every line before low is below key, none at or after high is
+        while low < high:
+            middle = (low + high) // 2
+            start = data.rfind(b"\n", low, middle) + 1 or low
+            if data[start:data.find(b" ", start)] < key:
+                low = data.find(b"\n", start) + 1
+            else:
+                high = start
+        return low
+
+    def get(self, key: str) -> dict[str, str]:
+        encoded = key.encode("UTF-8")
+        fields = {}
+        data = self.data
+        offset = self.find(encoded)
+        prefix = encoded + b" "
+        while data[offset:offset + len(prefix)] == prefix:
+            end = data.find(b"\n", offset) + 1
+            _, field, value = parse_record(data[offset:end - 1])
+            fields[field] = value
+            offset = end
+        return fields
+
+    def records(self) -> Iterator[tuple[str, str, str]]:
+        data = self.data
+        offset = 0
+        while offset < len(data):
+            end = data.find(b"\n", offset) + 1
+            yield parse_record(data[offset:end - 1])
+            offset = end
+
+
+class ChannelStore:
+    directory: str
+    flush_interval: float  # seconds the writer collects changes before writing and fsyncing them at once
+    compact_bytes: int  # journal size which triggers a compaction
+    snapshot: Snapshot  # replaced by the writer when a compaction is done
+    changes: dict[str, dict[str, str]]  # {channel: {field: value}} written since the snapshot was taken
+    frozen: dict[str, dict[str, str]]  # changes being merged into a new snapshot by the writer
+    compacting: bool
+    journal_bytes: int
+    queue: queue.SimpleQueue  # record lines and COMPACT/STOP/threading.Event markers for the writer
+    journal: io.BufferedWriter  # only touched by the writer once it runs
+    writer: threading.Thread
+
+    def __init__(self, directory: str, flush_interval: float, compact_bytes: int) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        os.makedirs(directory, exist_ok=True)
+        snapshot_path = os.path.join(directory, SNAPSHOT)
+        if not os.path.exists(snapshot_path):
+            open(snapshot_path, "wb").close()
+        self.snapshot = Snapshot(snapshot_path)
+        self.changes = {}
+        self.frozen = {}
+        self.compacting = False
+        self.journal_bytes = self.replay()
+        self.journal = open(os.path.join(directory, JOURNAL), "ab")
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.run, name="store", daemon=True)
+        self.writer.start()
+
+    def replay(self) -> int:
+        """Reads the journal into changes, returns its size. A line torn by a crash is cut off"""
+        path = os.path.join(self.directory, JOURNAL)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return 0
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            print(f"[STORE] Dropping {len(data) - end} bytes of an incomplete journal record")
+            os.truncate(path, end)
+        # Records end with LF only, bytes.splitlines() would also split on a CR or a form feed inside a value
+        for line in data[:end].split(b"\n")[:-1]:
+            key, field, value = parse_record(line)
+            self.changes.setdefault(key, {})[field] = value
+        return end
+
+    def get(self, key: str) -> dict[str, str]:
+        """Stored fields of a channel"""
+        # Read before the snapshot: the writer swaps in the new snapshot before it empties frozen, so either
+        # the old snapshot is read with the frozen changes or the new one which includes them
+        frozen = self.frozen.get(key, ())
+        fields = self.snapshot.get(key)
+        fields.update(frozen)
+        fields.update(self.changes.get(key, ()))
+        return {field: value for field, value in fields.items() if value}
+
+    def set(self, key: str, field: str, value: str) -> None:
+        """Records a change, it is written by the writer thread. Never blocks. Line breaks are removed from the
+        value, a record is a line"""
+        value = value.replace("\r", "").replace("\n", "")
+        self.changes.setdefault(key, {})[field] = value
+        line = format_record(key, field, value)
+        self.queue.put(line)
+        self.journal_bytes += len(line)
+        if self.journal_bytes >= self.compact_bytes and not self.compacting:
+            self.compact()
+
+    def compact(self) -> None:
+        """Hands the changes so far to the writer, to be merged into a new snapshot"""
+        self.compacting = True
+        if self.frozen:
+            # Left over from a failed compaction, the writer is done with it
+            for key, fields in self.changes.items():
+                self.frozen.setdefault(key, {}).update(fields)
+        else:
+            self.frozen = self.changes
+        self.changes = {}
+        self.journal_bytes = 0
+        self.queue.put(COMPACT)
+
+    def sync(self) -> None:
+        """Waits until every change recorded so far is on disk"""
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        self.queue.put(STOP)
+        self.writer.join()
+
+    def run(self) -> None:
+        """Writer thread"""
+        while True:
+            batch = [self.queue.get()]
+            if self.flush_interval:
+                time.sleep(self.flush_interval)
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = []
+            for item in batch:
+                if isinstance(item, bytes):
+                    lines.append(item)
+                    continue
+                self.write(lines)
+                lines = []
+                if item is COMPACT:
+                    self.merge()
+                elif item is STOP:
+                    self.journal.close()
+                    return
+                else:
+                    item.set()
+            self.write(lines)
+
+    def write(self, lines: list[bytes]) -> None:
+        if not lines:
+            return
+        try:
+            self.journal.write(b"".join(lines))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except OSError as e:
+            print(f"[STORE] Could not write the journal: {e}")
+
+    def merge(self) -> None:
+        """Writes the snapshot with the frozen changes applied and starts a new journal. If the process dies half way
+        the old snapshot and journal are still there, replaying a journal which was merged already changes nothing"""
+        start = time.perf_counter()
+        changes = sorted((key, field, value) for key, fields in self.frozen.items() for field, value in fields.items())
+        changed = {(key, field) for key, field, _ in changes}
+        kept = (record for record in self.snapshot.records() if record[:2] not in changed)
+        path = os.path.join(self.directory, SNAPSHOT)
+        count = 0
+        try:
+            with open(path + ".tmp", "wb") as file:
+                for key, field, value in heapq.merge(kept, changes):
+                    if value:
+                        file.write(format_record(key, field, value))
+                        count += 1
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(path + ".tmp", path)
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.snapshot = Snapshot(path)
+            self.journal.truncate(0)
+            os.fsync(self.journal.fileno())
+        except OSError as e:
+            # The changes stay in frozen and the journal, the next compaction tries again
+            print(f"[STORE] Compaction failed: {e}")
+            self.compacting = False
+            return
+        self.frozen = {}
+        self.compacting = False
+        print(f"[STORE] Compacted {count} records in {time.perf_counter() - start:.3f}s")
@@ -0,0 +1,51 @@
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class TimerWheel(Generic[T]):
+    """Hashed timing wheel. Scheduling a timer is O(1) and advancing the wheel only looks at
+    the timers of the slots it passes, no matter how many timers there are in total.
+
+    Timers can not be cancelled, the owner is expected to check whether a timer that fired
+    is still relevant (and schedule a new one if it was merely postponed)."""
+    slots: list[list[tuple[int, T]]]  # (tick at which the timer fires, item)
+    resolution: float  # seconds per tick
+    tick: int  # last tick which was processed
+
+    def __init__(self, now: float, slot_count: int = 128, resolution: float = 1.0) -> None:
+        self.slots = [[] for _ in range(slot_count)]
+        self.resolution = resolution
+        self.tick = int(now / resolution)
+
+    def schedule(self, deadline: float, item: T) -> None:
+        """Fires item at the first tick at or after the deadline (monotonic time)"""
+        tick = -int(-deadline // self.resolution)  # ceil
+        tick = max(tick, self.tick + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+
+    def expire(self, now: float) -> list[T]:
+        """Advances the wheel to now and returns the items whose deadline has passed"""
+        now_tick = int(now / self.resolution)
+        expired: list[T] = []
+        if now_tick <= self.tick:
+            return expired
+
+        # After a long pause every slot is due for a check, but only once
+        first = max(self.tick + 1, now_tick - len(self.slots) + 1)
+        for tick in range(first, now_tick + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                if entry[0] <= now_tick:
+                    expired.append(entry[1])
+                else:
+                    # Scheduled one or more rotations ahead
+                    remaining.append(entry)
+            self.slots[index] = remaining
+
+        self.tick = now_tick
+        return expired
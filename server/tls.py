@@ -0,0 +1,44 @@
+import selectors
+import ssl
+from socket import socket
+
+# Raised by non-blocking sockets instead of blocking. TLS sockets raise the SSL ones, which are not BlockingIOErrors
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+def create_context(cert: str, key: str | None = None) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def wrap(conn: socket, context: ssl.SSLContext) -> ssl.SSLSocket | None:
+    """Wraps an accepted connection in a non-blocking TLS socket, whose handshake is then driven by handshake.
+    Returns None if that failed"""
+    try:
+        conn.setblocking(False)
+        return context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+    except (OSError, ValueError):
+        conn.close()
+        return None
+
+
+def handshake(conn: ssl.SSLSocket) -> int | None:
+    """Takes a handshake as far as the data received so far allows, without blocking. Returns 0 once it is done,
+    the selector event to wait for before calling again if it is not, and None if it failed"""
+    try:
+        conn.do_handshake()
+    except ssl.SSLWantReadError:
+        return selectors.EVENT_READ
+    except ssl.SSLWantWriteError:
+        return selectors.EVENT_WRITE
+    except (OSError, ValueError):
+        return None
+    return 0
+
+
+def buffered(conn: socket) -> bool:
+    """Whether a TLS socket holds decrypted input. The selector can not see it, the socket is readable
+    only when more arrives from the network"""
+    return isinstance(conn, ssl.SSLSocket) and conn.pending() > 0